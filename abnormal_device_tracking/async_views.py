@@ -0,0 +1,78 @@
+# abnormal_device_tracking/async_views.py
+from django.core.paginator import InvalidPage, Paginator
+from django.http import Http404
+from django.shortcuts import render
+from django.views import View
+
+"""
+    只读页面的异步视图基类（ASGI原生，Daphne下在事件循环里执行，不占用线程）
+        1、查询全部用异步ORM（aiterator/acount/aget/afirst/aexists），视图代码中没有sync_to_async；
+           异步ORM目前仍由Django在线程池中执行数据库驱动调用，但请求在等待数据库时不再独占一个线程/worker
+        2、模板渲染前必须把数据全部取出：模板里再触发查询（懒加载的外键、未求值的queryset）会在事件循环里抛SynchronousOnlyOperation，
+           所以外键一律select_related，分页的object_list在这里转成list
+        3、request.user是懒加载对象，模板第一次访问时同步查库：get()开始时先await request.auser()，再赋值回request.user
+        4、前提是MIDDLEWARE中的中间件全部支持异步：只要有一个只支持同步，ASGI下整个中间件栈就降级到Django唯一的同步线程里，
+           异步视图被async_to_sync调用，没有并发（viewflow自动追加的两个同步中间件见workflows/middleware.py的VIEWFLOW_MIDDLEWARE）
+    与同步的ListView保持相同的上下文变量（object_list、page_obj、paginator、is_paginated），同一个模板两种视图都能用
+"""
+
+
+class AsyncTemplateView(View):
+    """异步的TemplateView：子类实现aget_context_data"""
+    template_name = None
+
+    async def get(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        context = await self.aget_context_data(**kwargs)
+        return render(request, self.template_name, context)
+
+    async def aget_context_data(self, **kwargs):
+        kwargs.setdefault('view', self)
+        return kwargs
+
+
+class AsyncListView(AsyncTemplateView):
+    """
+    异步的ListView：aget_queryset()构造查询（需要先查库才能确定查询条件时在这里await），由aget_context_data异步取出
+    分页与ListView一致：?page=N 或 ?page=last，页码无效时404
+    """
+    context_object_name = None
+    paginate_by = None
+    page_kwarg = 'page'
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    async def aget_queryset(self):
+        return self.get_queryset()
+
+    async def apaginate_queryset(self, queryset, page_size):
+        """返回 (paginator, page, object_list, is_paginated)，object_list已从数据库取出"""
+        paginator = Paginator(queryset, page_size)
+        paginator.count = await queryset.acount()  # 预先填好count（cached_property），之后不会再同步COUNT
+        page = self.kwargs.get(self.page_kwarg) or self.request.GET.get(self.page_kwarg) or 1
+        try:
+            page_number = int(page)
+        except ValueError:
+            if page != 'last':
+                raise Http404('页码无效')
+            page_number = paginator.num_pages
+        try:
+            page = paginator.page(page_number)
+        except InvalidPage as e:
+            raise Http404(f'页码无效({page_number}):{e}')
+        page.object_list = [obj async for obj in page.object_list.aiterator(chunk_size=page_size)]
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    async def aget_context_data(self, **kwargs):
+        queryset = await self.aget_queryset()
+        if self.paginate_by:
+            paginator, page, object_list, is_paginated = await self.apaginate_queryset(queryset, self.paginate_by)
+        else:
+            paginator, page, is_paginated = None, None, False
+            object_list = [obj async for obj in queryset.aiterator()]
+        context = {'paginator': paginator, 'page_obj': page, 'is_paginated': is_paginated, 'object_list': object_list}
+        if self.context_object_name:
+            context[self.context_object_name] = object_list
+        context.update(kwargs)
+        return await super().aget_context_data(**context)
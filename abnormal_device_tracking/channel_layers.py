@@ -0,0 +1,71 @@
+# abnormal_device_tracking/channel_layers.py
+import os
+from urllib.parse import quote
+
+"""
+    Channels通道层配置
+    原来settings.py写死了单机的channels_redis.core.RedisChannelLayer（默认capacity/expiry），并且导入settings时直接读取
+    os.environ['REDIS_PASSWORD']，没有配置Redis的环境（测试、脚本）连settings都导入不了。
+    现在通过环境变量选择后端，build_channel_layers()返回CHANNEL_LAYERS：
+        CHANNEL_LAYER_BACKEND = redis（默认）  单个Redis，channels_redis.core.RedisChannelLayer
+                              sharded         多个Redis，同一个RedisChannelLayer按通道名/群组名一致性哈希分片
+                              pubsub          channels_redis.pubsub.RedisPubSubChannelLayer，消息不落Redis列表，延迟更低，
+                                              但没有capacity/expiry，consumer不在线时消息直接丢失
+                              memory          进程内InMemoryChannelLayer，只用于测试/单进程开发
+        CHANNEL_REDIS_URLS      逗号分隔的Redis地址，sharded时每个地址一个分片；
+                                未配置时使用 redis://127.0.0.1:6379/0，密码取REDIS_PASSWORD（可以不配置）
+        CHANNEL_REDIS_MAX_CONNECTIONS  每个分片的连接池上限，默认不限制（与channels_redis默认一致）；
+                                redis.asyncio的ConnectionPool不是阻塞池，连接数达到上限时直接抛"Too many connections"，
+                                所以只在Redis的maxclients需要保护时配置，并按 Daphne进程数 × 峰值并发 留足余量
+        CHANNEL_CAPACITY / CHANNEL_EXPIRY / CHANNEL_GROUP_EXPIRY  见下面的默认值说明
+    通道层选型和Daphne进程数可以用 manage.py benchmark_group_send 的压测数据确定
+"""
+
+BACKENDS = ('redis', 'sharded', 'pubsub', 'memory')
+
+# 每个通道（一个WebSocket连接）在Redis中最多积压的消息数，默认100；
+# 聊天室广播 + 在线状态广播在重连风暴时会瞬间堆积，放大到300，超出时group_send对该连接静默丢弃
+DEFAULT_CAPACITY = 300
+# 消息在通道中的最长保留时间（秒），默认60；聊天消息10秒还没被取走说明连接已经断了，早点过期释放Redis内存
+DEFAULT_EXPIRY = 10
+# 通道在群组中的最长保留时间（秒），默认86400；连接超过这个时间会被移出群组收不到广播，覆盖一个完整班次（12小时）即可
+DEFAULT_GROUP_EXPIRY = 12 * 60 * 60
+
+
+def redis_urls(env=os.environ):
+    urls = [url.strip() for url in env.get('CHANNEL_REDIS_URLS', '').split(',') if url.strip()]
+    if urls:
+        return urls
+    password = env.get('REDIS_PASSWORD')
+    auth = f':{quote(password, safe="")}@' if password else ''
+    return [f'redis://{auth}127.0.0.1:6379/0']
+
+
+def build_channel_layers(env=os.environ):
+    backend = env.get('CHANNEL_LAYER_BACKEND', 'redis').strip().lower()
+    if backend not in BACKENDS:
+        raise ValueError(f'CHANNEL_LAYER_BACKEND不支持:{backend}，可选:{", ".join(BACKENDS)}')
+    if backend == 'memory':
+        return {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+    urls = redis_urls(env)
+    # 每个地址一个连接池（channels_redis按事件循环创建）
+    hosts = [{'address': url} for url in urls]
+    if env.get('CHANNEL_REDIS_MAX_CONNECTIONS'):
+        for host in hosts:
+            host['max_connections'] = int(env['CHANNEL_REDIS_MAX_CONNECTIONS'])
+    if backend == 'pubsub':
+        return {'default': {'BACKEND': 'channels_redis.pubsub.RedisPubSubChannelLayer', 'CONFIG': {'hosts': hosts}}}
+    if backend == 'redis' and len(hosts) > 1:
+        raise ValueError('CHANNEL_REDIS_URLS配置了多个地址，请使用 CHANNEL_LAYER_BACKEND=sharded')
+    return {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': hosts,
+                'capacity': int(env.get('CHANNEL_CAPACITY', DEFAULT_CAPACITY)),
+                'expiry': int(env.get('CHANNEL_EXPIRY', DEFAULT_EXPIRY)),
+                'group_expiry': int(env.get('CHANNEL_GROUP_EXPIRY', DEFAULT_GROUP_EXPIRY)),
+            },
+        },
+    }
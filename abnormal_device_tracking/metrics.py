@@ -0,0 +1,97 @@
+# abnormal_device_tracking/metrics.py
+import os
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest, multiprocess
+
+"""
+    进程内指标（基于prometheus_client）
+    1. 每个进程各自累计，记录时不跨进程加锁，不访问数据库/Redis
+    2. 多worker部署（Gunicorn/多个Daphne）时设置环境变量 PROMETHEUS_MULTIPROC_DIR（指向一个所有worker共享的空目录，
+       每次启动前清空），各进程把指标写进该目录下自己的mmap文件，/metrics 请求时汇总所有进程的文件
+       Gunicorn还需要在配置文件的child_exit钩子中调用 prometheus_client.multiprocess.mark_process_dead(worker.pid)
+    3. /metrics 以Prometheus文本格式输出，需要登录的管理员，或者请求头 Authorization: Bearer <settings.METRICS_TOKEN>
+"""
+
+# 单位：秒。覆盖从几毫秒的SQL到数秒的慢请求
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds',
+    '请求耗时（按URL名称）',
+    ['view', 'method'],
+    buckets=LATENCY_BUCKETS,
+)
+SQL_TIME = Histogram(
+    'http_request_sql_duration_seconds',
+    '单个请求内SQL总耗时（按URL名称，仅统计被PerformanceMiddleware采样的请求）',
+    ['view'],
+    buckets=LATENCY_BUCKETS,
+)
+TRANSITION_LATENCY = Histogram(
+    'workflow_transition_duration_seconds',
+    '工作流状态转换耗时（按节点和转换）',
+    ['node', 'transition'],
+    buckets=LATENCY_BUCKETS,
+)
+CHAT_FANOUT_LATENCY = Histogram(
+    'chat_message_fanout_duration_seconds',
+    'WebSocket消息group_send广播耗时',
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def view_label(request):
+    """URL名称作为标签（如 deviceinvestigation:index），避免把带主键的路径当标签导致时间序列无限增长"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.view_name or match._func_path
+
+
+def observe_request(request, duration, query_stats=None):
+    """PerformanceMiddleware在请求结束时调用"""
+    view = view_label(request)
+    REQUEST_LATENCY.labels(view=view, method=request.method).observe(duration)
+    if query_stats is not None:
+        SQL_TIME.labels(view=view).observe(query_stats.total_time)
+
+
+@contextmanager
+def time_transition(node, transition):
+    """记录一次工作流状态转换的耗时，转换抛异常时也记录"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        TRANSITION_LATENCY.labels(node=node, transition=transition).observe(time.perf_counter() - start)
+
+
+def _registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # 多进程模式：每次导出都新建registry，从共享目录汇总所有worker的指标
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def _is_authorized(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+        if auth.startswith('Bearer ') and constant_time_compare(auth[len('Bearer '):], token):
+            return True
+    user = getattr(request, 'user', None)
+    return bool(user and user.is_authenticated and user.is_staff)
+
+
+def metrics_view(request):
+    """Prometheus拉取接口"""
+    if not _is_authorized(request):
+        return HttpResponseForbidden('无权限访问指标接口')
+    return HttpResponse(generate_latest(_registry()), content_type=CONTENT_TYPE_LATEST)
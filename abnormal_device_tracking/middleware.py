@@ -1,67 +1,138 @@
 # abnormal_device_tracking/middleware.py
+import random
 import time
 import uuid
-from django.db import connection
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils.decorators import sync_and_async_middleware
 import logging
 
+from abnormal_device_tracking import metrics, tracing
+from abnormal_device_tracking.query_stats import QueryCounter, QueryRecorder
+
 logger = logging.getLogger(__name__)
 
 
+@sync_and_async_middleware
 class PerformanceMiddleware:
     """
     性能监控中间件
-    监控每个请求的耗时和数据库查询次数
+    监控每个请求的耗时和数据库查询（次数、总耗时、最慢语句、重复语句）
+    基于 connection.execute_wrapper 统计，不依赖DEBUG模式下的 connection.queries，生产环境同样有效
+    生产环境可通过 PERFORMANCE_MONITOR['SAMPLE_RATE'] 只对部分请求统计SQL，未采样的请求只计时和计数（X-Query-Count照常输出），几乎零开销
+    ASGI下的异步请求只计时，没有X-Query-Count（见__acall__）
     """
+    # 默认配置，可在settings.PERFORMANCE_MONITOR中覆盖部分key
+    DEFAULTS = {
+        'SAMPLE_RATE': 1.0,  # SQL统计的采样率：1.0每个请求都统计，0.0只计时
+        'SLOW_REQUEST_SECONDS': 1.0,  # 耗时超过该值判定为慢请求
+        'DUPLICATE_QUERY_THRESHOLD': 5,  # 同一条语句在一个请求内执行>=该次数，判定为疑似N+1
+    }
+
     # 1. 初始化方法
     def __init__(self, get_response):
         # get_response：Django传入的“下一个中间件/视图函数”的引用
         # 作用：中间件是链式调用的，这个参数用来传递请求到下一个环节
         self.get_response = get_response  # 保存这个引用，供__call__方法使用
+        # ASGI下get_response是协程函数：走__acall__，不需要Django做sync/async适配（同步中间件会让整个请求占住一个线程）
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
         # 知识点：__init__ 只在Django启动时执行1次，不是每个请求都执行！
+        config = dict(self.DEFAULTS, **getattr(settings, 'PERFORMANCE_MONITOR', {}))
+        self.sample_rate = float(config['SAMPLE_RATE'])
+        self.slow_request_seconds = float(config['SLOW_REQUEST_SECONDS'])
+        self.duplicate_threshold = int(config['DUPLICATE_QUERY_THRESHOLD'])
+
+    def _should_sample(self):
+        if self.sample_rate >= 1.0:
+            return True
+        if self.sample_rate <= 0.0:
+            return False
+        return random.random() < self.sample_rate
+
+    def _timing_only(self, request, response, duration, counter=None):
+        metrics.observe_request(request, duration)
+        if duration > self.slow_request_seconds:
+            logger.warning(
+                "慢请求警告 | 路径:%s | 方法:%s | 耗时:%.3f秒 | 查询:%s次（未采样）",
+                request.path, request.method, duration, '?' if counter is None else counter.count
+            )
+        response['X-Request-Duration'] = f'{duration:.3f}s'
+        if counter is not None:
+            response['X-Query-Count'] = str(counter.count)
+        response['Server-Timing'] = f'total;dur={duration * 1000:.1f}'
+        return response
+
+    async def __acall__(self, request):
+        # 异步请求只计时：异步ORM的SQL在线程池里执行，execute_wrapper是按线程挂在连接上的，无法按请求统计
+        start_time = time.perf_counter()
+        response = await self.get_response(request)
+        return self._timing_only(request, response, time.perf_counter() - start_time)
 
     # 2. 核心方法（每个请求都会触发）
     def __call__(self, request):
-        # ===== 【请求处理前】：记录初始数据 =====
-        # 记录请求开始的时间戳（单位：秒，比如 1735689000.123）
-        start_time = time.time()
-        # 获取“当前已执行的SQL查询数量”作为初始值
-        # connection.queries：Django记录的所有SQL查询列表（仅DEBUG=True时生效！）
-        # len() 取列表长度 = 查询次数
-        initial_query_count = len(connection.queries)
-
-        # ===== 核心：调用后续中间件/视图，处理请求 =====
-        # 把请求传递给下一个中间件（或视图），并获取响应结果
-        # 这行代码是中间件的“核心链路”，前面是请求前逻辑，后面是响应后逻辑
-        response = self.get_response(request)
-
-        # ===== 【响应处理后】：计算性能数据 =====
-        # 计算请求总耗时：结束时间 - 开始时间（保留3位小数）
-        duration = time.time() - start_time
-        # 计算本次请求的SQL查询次数：总查询数 - 初始查询数
-        # （避免累计之前请求的查询，只算当前请求的）
-        query_count = len(connection.queries) - initial_query_count
-
-        # ===== 慢请求监控：耗时>1秒打警告日志 =====
-        if duration > 1.0:  # 耗时超过1秒判定为慢请求
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self._should_sample():
+            # ===== 未采样：计时 + 只计数的SQL包装器 =====
+            counter = QueryCounter()
+            start_time = time.perf_counter()
+            with ExitStack() as stack:
+                for conn in connections.all():
+                    stack.enter_context(conn.execute_wrapper(counter))
+                response = self.get_response(request)
+            return self._timing_only(request, response, time.perf_counter() - start_time, counter)
+
+        # ===== 采样：给所有数据库连接挂上SQL记录器，请求结束后自动卸下 =====
+        recorder = QueryRecorder()
+        # 绑定到request上，视图/其他中间件可以读取本次请求的SQL统计
+        request.query_stats = recorder
+        start_time = time.perf_counter()
+        with ExitStack() as stack:
+            for conn in connections.all():  # 只是取连接对象，不会建立数据库连接
+                stack.enter_context(conn.execute_wrapper(recorder))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start_time
+        metrics.observe_request(request, duration, recorder)
+
+        # ===== 慢请求监控 =====
+        if duration > self.slow_request_seconds:
+            logger.warning(
+                "慢请求警告 | 路径:%s | 方法:%s | 耗时:%.3f秒 | 查询:%d次 | SQL耗时:%.3f秒 | 最慢SQL(%.3f秒):%s",
+                request.path, request.method, duration,
+                recorder.count, recorder.total_time,
+                recorder.slowest_time, recorder.slowest_sql
+            )
+
+        # ===== 疑似N+1：同一条语句重复执行过多 =====
+        duplicates = recorder.duplicates(self.duplicate_threshold)
+        if duplicates:
             logger.warning(
-                "慢请求警告 | 路径:%s | 方法:%s | 耗时:%.3f秒 | 查询:%d次",
-                request.path,    # 请求路径（比如 /workflows/1/approve/）
-                request.method,  # 请求方法（GET/POST/PUT等）
-                duration,        # 耗时（保留3位小数）
-                query_count      # 数据库查询次数
+                "重复查询警告 | 路径:%s | 方法:%s | %s",
+                request.path, request.method,
+                ' | '.join(f'{n}次:{sql}' for sql, n in duplicates[:3])
             )
 
         # ===== 响应头添加性能数据（供前端/运维监控），跨端传递性能数据（后端→前端 / 运维 / 监控工具），无侵入式 =====
-        # 给响应头加自定义字段：X-Request-Duration（耗时）
         response['X-Request-Duration'] = f'{duration:.3f}s'
-        # 给响应头加自定义字段：X-Query-Count（查询次数）
-        response['X-Query-Count'] = str(query_count)
+        response['X-Query-Count'] = str(recorder.count)
+        # Server-Timing：浏览器开发者工具的Timing面板可以直接展示
+        response['Server-Timing'] = (
+            f'db;dur={recorder.total_time * 1000:.1f};desc="{recorder.count} queries", '
+            f'total;dur={duration * 1000:.1f}'
+        )
 
         # ===== 返回响应 =====
         # 把响应传递给上一个中间件（或客户端）
         return response
 
 
+@sync_and_async_middleware
 class RequestIDMiddleware:
     """
     请求ID追踪中间件
@@ -73,9 +144,22 @@ class RequestIDMiddleware:
     # 1. 初始化方法（和上面一样）
     def __init__(self, get_response):
         self.get_response = get_response  # 保存下一个中间件/视图的引用
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
 
     # 2. 核心方法（每个请求触发）
     def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        self.process_request(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        self.process_request(request)
+        return self.process_response(request, await self.get_response(request))
+
+    def process_request(self, request):
         # ===== 【请求处理前】：生成/获取请求ID =====
         # 先尝试从请求头获取X-Request-ID（比如前端/网关传过来的ID）
         # Django会把请求头的「X-Request-ID」转成「HTTP_X_REQUEST_ID」（大写+HTTP_前缀）
@@ -103,9 +187,8 @@ class RequestIDMiddleware:
             request.META.get('REMOTE_ADDR', 'unknown')
         )
 
-        # ===== 调用后续中间件/视图 =====
-        response = self.get_response(request)
-
+    def process_response(self, request, response):
+        request_id = request.request_id
         # ===== 【响应处理后】：把请求ID塞到响应头 =====
         # 前端可以从响应头里拿到 X-Request-ID，反馈给后端开发者时只需要说 “ID为req_xxx 的请求报错了”，你直接在日志里搜这个 ID，就能找到该请求的完整处理日志（包括开始时间、IP、状态码、耗时等）
         response['X-Request-ID'] = request_id # 让整个请求的 “发起→处理→响应” 链路可追溯
@@ -118,4 +201,46 @@ class RequestIDMiddleware:
         )
 
         # ===== 返回响应 =====
-        return response
\ No newline at end of file
+        return response
+
+
+@sync_and_async_middleware
+class TracingMiddleware:
+    """
+    调用链追踪中间件（放在RequestIDMiddleware之后）：以request_id为trace_id开始一条链路，头部采样，
+    采样的请求记录视图、状态转换和每条SQL的span，详见abnormal_device_tracking/tracing.py
+    TRACING['ENABLED']为False时抛出MiddlewareNotUsed，Django不加载该中间件，零开销
+    """
+
+    def __init__(self, get_response):
+        if not tracing.CONFIG['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def _start(self, request):
+        return tracing.start_trace('http', trace_id=getattr(request, 'request_id', None),
+                                   method=request.method, path=request.path)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        root = self._start(request)
+        if not root:  # 未采样
+            return self.get_response(request)
+        with root, tracing.db_spans():
+            response = self.get_response(request)
+            root.set(view=metrics.view_label(request), status=response.status_code)
+        return response
+
+    async def __acall__(self, request):
+        # 异步请求不挂db_spans（原因同PerformanceMiddleware.__acall__），视图和状态转换的span照常记录
+        root = self._start(request)
+        if not root:
+            return await self.get_response(request)
+        with root:
+            response = await self.get_response(request)
+            root.set(view=metrics.view_label(request), status=response.status_code)
+        return response
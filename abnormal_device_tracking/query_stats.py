@@ -0,0 +1,69 @@
+# abnormal_device_tracking/query_stats.py
+import re
+import time
+from collections import Counter
+
+"""
+    基于 connection.execute_wrapper 的SQL统计
+    不依赖 connection.queries（只有DEBUG=True才记录，且会无限增长），生产环境同样可用
+    每个请求一个 QueryRecorder，只保存计数、总耗时、最慢语句和指纹计数，不保存完整SQL列表
+    未采样的请求用 QueryCounter，只计数（每条SQL多一次函数调用），X-Query-Count照常输出
+"""
+
+# 把 IN (%s, %s, %s) / VALUES (%s, %s), (%s, %s) 这类长度随参数个数变化的占位符列表折叠成一个，保证同一条语句指纹一致
+_PLACEHOLDER_LIST_RE = re.compile(r'(%s|\?)(\s*,\s*(%s|\?))+')
+_VALUES_ROWS_RE = re.compile(r'(\([^()]*\))(\s*,\s*\([^()]*\))+')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """SQL指纹：execute_wrapper拿到的是参数化前的SQL（参数是%s占位符），只需折叠占位符列表和空白"""
+    sql = _PLACEHOLDER_LIST_RE.sub(r'\1', sql)
+    sql = _VALUES_ROWS_RE.sub(r'\1', sql)
+    return _WHITESPACE_RE.sub(' ', sql).strip()
+
+
+class QueryCounter:
+    """只计数的execute_wrapper：不计时、不算指纹"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class QueryRecorder:
+    """
+    挂到 connection.execute_wrapper 上的记录器
+    用法：
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            ...
+        recorder.count / recorder.total_time / recorder.slowest / recorder.duplicates()
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0  # 秒
+        self.slowest_sql = None
+        self.slowest_time = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.total_time += elapsed
+            if elapsed >= self.slowest_time:
+                self.slowest_time = elapsed
+                self.slowest_sql = sql
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def duplicates(self, threshold=2):
+        """重复执行次数>=threshold的语句指纹（N+1的典型特征），按次数从多到少排列"""
+        return [(sql, n) for sql, n in self.fingerprints.most_common() if n >= threshold]
@@ -15,6 +15,9 @@ from dotenv import load_dotenv
 load_dotenv()  # 加载.env文件的变量
 
 from pathlib import Path
+
+from abnormal_device_tracking.channel_layers import build_channel_layers
+
 # part 1 核心标识 : BASE_DIR SECRET_KEY  DEBUG ALLOWED_HOSTS
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -60,11 +63,14 @@ INSTALLED_APPS = [
     'workflows',
     'notifications',
     'chat',
-    'problem_group'
+    'problem_group',
+    'analytics',
 ]
 MIDDLEWARE = [
     # 请求追踪放在最前面，确保所有后续处理都能用到request_id
     'abnormal_device_tracking.middleware.RequestIDMiddleware',
+    # 调用链追踪（以request_id为trace_id），TRACING['ENABLED']为False时不加载
+    'abnormal_device_tracking.middleware.TracingMiddleware',
 
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -79,12 +85,46 @@ MIDDLEWARE = [
     # workflow权限校验
     'workflows.middleware.NodePermissionMiddleware',
     'workflows.middleware.ThreadLocalMiddleware',
+    # viewflow的两个中间件（原版只支持同步，viewflow会自动追加，WorkflowsConfig.ready()中去掉），换成同步/异步版本，
+    # ASGI下整个中间件栈才是异步的
+    'workflows.middleware.SiteMiddleware',
+    'workflows.middleware.HotwireTurboMiddleware',
 
 ]
 
 
 
 
+# 性能监控中间件配置：生产环境默认只对10%的请求统计SQL，其余请求只计时
+PERFORMANCE_MONITOR = {
+    'SAMPLE_RATE': 1.0 if DEBUG else float(os.environ.get('PERFORMANCE_SAMPLE_RATE', '0.1')),
+    'SLOW_REQUEST_SECONDS': 1.0,
+    'DUPLICATE_QUERY_THRESHOLD': 5,
+}
+
+# 调用链追踪：头部采样，采样的链路结束时写一条JSON到'tracing'日志（后台线程写出，不阻塞请求），详见abnormal_device_tracking/tracing.py
+TRACING = {
+    'ENABLED': os.environ.get('TRACING_ENABLED', 'True' if DEBUG else 'False').lower() == 'true',
+    'SAMPLE_RATE': 1.0 if DEBUG else float(os.environ.get('TRACING_SAMPLE_RATE', '0.01')),
+}
+
+# /metrics 接口的访问令牌（Prometheus抓取时带 Authorization: Bearer <token>），未配置时只有登录的管理员可以访问
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# 邮件：通知汇总邮件由后台任务发送（notifications/engine.py），整个发送任务共用一条SMTP连接
+# 本地调试可以启动 python -m aiosmtpd -n -l localhost:1025 并设 EMAIL_HOST=localhost EMAIL_PORT=1025
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'localhost')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', '25'))
+EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
+EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
+EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'False').lower() == 'true'
+EMAIL_TIMEOUT = 10
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'noreply@localhost')
+# 同一个收件人在这么多秒内的通知合并成一封汇总邮件
+NOTIFICATION_DIGEST_WINDOW = int(os.environ.get('NOTIFICATION_DIGEST_WINDOW', '60'))
+
+
 # part 3  URL 与模板（路由/视图基础）
 ROOT_URLCONF = 'abnormal_device_tracking.urls'
 TEMPLATES = [
@@ -107,15 +147,19 @@ TEMPLATES = [
 # part 4  部署入口
 WSGI_APPLICATION = 'abnormal_device_tracking.wsgi.application'
 ASGI_APPLICATION = "abnormal_device_tracking.asgi.application"
-# django channel通道层配置
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",# 这里选channels_redis实现
-        "CONFIG": {
-            "hosts": [f"redis://:{os.environ['REDIS_PASSWORD']}@127.0.0.1:6379/0"],
+# django channel通道层配置：后端（redis/sharded/pubsub/memory）、Redis地址和capacity/expiry通过环境变量配置，
+# 详见abnormal_device_tracking/channel_layers.py
+CHANNEL_LAYERS = build_channel_layers()
+
+# 缓存：权限快照、聊天室成员、聊天在线状态都放在缓存中，多个Daphne/Gunicorn进程部署时必须配置共享的Redis缓存
+# 未配置CACHE_REDIS_URL时使用Django默认的进程内缓存（单进程开发/测试）
+if os.environ.get('CACHE_REDIS_URL'):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ['CACHE_REDIS_URL'],  # 例如 redis://:password@127.0.0.1:6379/1
         },
-    },
-}
+    }
 
 # 指定唯一用户模型
 AUTH_USER_MODEL = 'accounts.Employee'
@@ -213,6 +257,18 @@ LOGGING = {
         'console': {
             'class': 'logging.StreamHandler',
         },
+        # 追踪记录经有界队列由后台线程写出，请求线程不做I/O
+        'tracing': {
+            'class': 'abnormal_device_tracking.tracing.QueueLogHandler',
+            'maxsize': 10000,
+        },
+    },
+    'loggers': {
+        'tracing': {
+            'handlers': ['tracing'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
     'root': {
         'handlers': ['console'],
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import logging
+from unittest import mock
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connection
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+from django.utils.module_loading import import_string
+from django.views import View
+
+from abnormal_device_tracking import tracing
+from abnormal_device_tracking.channel_layers import build_channel_layers
+from abnormal_device_tracking.metrics import time_transition
+from abnormal_device_tracking.middleware import PerformanceMiddleware, RequestIDMiddleware, TracingMiddleware
+from abnormal_device_tracking.query_stats import QueryRecorder, fingerprint
+from abnormal_device_tracking.utils import TraceViewMixin
+from accounts.models import Employee
+from devices.models import Device
+
+
+class FingerprintTest(TestCase):
+    def test_placeholder_lists_collapse(self):
+        self.assertEqual(
+            fingerprint('SELECT * FROM t WHERE id IN (%s, %s, %s)'),
+            fingerprint('SELECT * FROM t WHERE id IN (%s)'),
+        )
+
+    def test_values_rows_collapse(self):
+        self.assertEqual(
+            fingerprint('INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s)'),
+            fingerprint('INSERT INTO t (a, b) VALUES (%s, %s)'),
+        )
+
+
+class QueryRecorderTest(TestCase):
+    def test_records_count_and_duplicates(self):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            for i in range(3):
+                Device.objects.filter(sn=f'SN{i}').exists()
+            Device.objects.count()
+        self.assertEqual(4, recorder.count)
+        self.assertGreater(recorder.total_time, 0)
+        self.assertIsNotNone(recorder.slowest_sql)
+        self.assertEqual(1, len(recorder.duplicates(threshold=3)))
+        self.assertEqual([], recorder.duplicates(threshold=4))
+
+
+class PerformanceMiddlewareTest(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get('/devices/')
+
+    @staticmethod
+    def view(request):
+        for i in range(6):
+            Device.objects.filter(sn=f'SN{i}').exists()
+        return HttpResponse('ok')
+
+    @override_settings(DEBUG=False, PERFORMANCE_MONITOR={'SAMPLE_RATE': 1.0})
+    def test_counts_queries_without_debug(self):
+        with self.assertLogs('abnormal_device_tracking.middleware', 'WARNING') as logs:
+            response = PerformanceMiddleware(self.view)(self.request)
+        self.assertEqual('6', response['X-Query-Count'])
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertTrue(response['X-Request-Duration'].endswith('s'))
+        self.assertIn('重复查询警告', logs.output[0])
+        self.assertEqual(6, self.request.query_stats.count)
+
+    @override_settings(PERFORMANCE_MONITOR={'SAMPLE_RATE': 0.0})
+    def test_unsampled_request_only_times_and_counts(self):
+        response = PerformanceMiddleware(self.view)(self.request)
+        self.assertEqual('6', response['X-Query-Count'])
+        self.assertNotIn('db;dur=', response['Server-Timing'])
+        self.assertIn('X-Request-Duration', response)
+        self.assertFalse(hasattr(self.request, 'query_stats'))
+
+
+class AsyncMiddlewareStackTest(TestCase):
+    def test_asgi_stack_is_fully_async(self):
+        # 中间件全部支持异步时，ASGIHandler的中间件链是协程函数，不会被整体降级到同步线程；viewflow自动追加的同步版已被替换
+        instances = []
+        init = PerformanceMiddleware.__init__
+
+        def record(self, get_response):
+            init(self, get_response)
+            instances.append(self)
+
+        with mock.patch.object(PerformanceMiddleware, '__init__', record):
+            handler = ASGIHandler()
+        self.assertTrue(iscoroutinefunction(handler._middleware_chain))
+        self.assertTrue(instances[0].async_mode)
+        self.assertFalse(any(path.startswith('viewflow.') for path in settings.MIDDLEWARE))
+        for path in settings.MIDDLEWARE:
+            self.assertTrue(getattr(import_string(path), 'async_capable', False), path)
+
+
+class MetricsViewTest(TestCase):
+    def setUp(self):
+        self.staff = Employee.objects.create_user(
+            username='admin', password='password', email='admin@example.com', number='admin', is_staff=True
+        )
+
+    def test_anonymous_forbidden(self):
+        self.assertEqual(403, self.client.get(reverse('metrics')).status_code)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_bearer_token(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(403, self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code)
+
+    def test_exports_request_and_transition_metrics(self):
+        with time_transition('production_test_fail', 'assign'):
+            pass
+        self.client.force_login(self.staff)
+        self.client.get(reverse('metrics'))  # 经过PerformanceMiddleware，记录一次请求耗时
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('http_request_duration_seconds_count{method="GET",view="metrics"}', body)
+        self.assertIn('workflow_transition_duration_seconds_count{node="production_test_fail",transition="assign"}', body)
+
+
+class ChannelLayerConfigTest(TestCase):
+    def test_default_redis_without_password(self):
+        config = build_channel_layers({})['default']
+        self.assertEqual('channels_redis.core.RedisChannelLayer', config['BACKEND'])
+        self.assertEqual('redis://127.0.0.1:6379/0', config['CONFIG']['hosts'][0]['address'])
+        self.assertEqual(10, config['CONFIG']['expiry'])
+        self.assertNotIn('max_connections', config['CONFIG']['hosts'][0])  # 默认不限制，避免"Too many connections"
+
+    def test_max_connections_only_when_configured(self):
+        config = build_channel_layers({'CHANNEL_REDIS_MAX_CONNECTIONS': '500'})['default']
+        self.assertEqual(500, config['CONFIG']['hosts'][0]['max_connections'])
+
+    def test_password_is_quoted(self):
+        config = build_channel_layers({'REDIS_PASSWORD': 'p@ss/word'})['default']
+        self.assertEqual('redis://:p%40ss%2Fword@127.0.0.1:6379/0', config['CONFIG']['hosts'][0]['address'])
+
+    def test_sharded_and_pubsub(self):
+        env = {'CHANNEL_REDIS_URLS': 'redis://a:6379/0, redis://b:6379/0', 'CHANNEL_CAPACITY': '1000'}
+        sharded = build_channel_layers(dict(env, CHANNEL_LAYER_BACKEND='sharded'))['default']
+        self.assertEqual(['redis://a:6379/0', 'redis://b:6379/0'], [h['address'] for h in sharded['CONFIG']['hosts']])
+        self.assertEqual(1000, sharded['CONFIG']['capacity'])
+        pubsub = build_channel_layers(dict(env, CHANNEL_LAYER_BACKEND='pubsub'))['default']
+        self.assertEqual('channels_redis.pubsub.RedisPubSubChannelLayer', pubsub['BACKEND'])
+        self.assertNotIn('capacity', pubsub['CONFIG'])
+        with self.assertRaises(ValueError):  # 多个地址必须显式选择sharded
+            build_channel_layers(env)
+
+    def test_memory_and_unknown_backend(self):
+        self.assertEqual('channels.layers.InMemoryChannelLayer',
+                         build_channel_layers({'CHANNEL_LAYER_BACKEND': 'memory'})['default']['BACKEND'])
+        with self.assertRaises(ValueError):
+            build_channel_layers({'CHANNEL_LAYER_BACKEND': 'rabbitmq'})
+
+
+class TracingTest(TestCase):
+    class DeviceCountView(TraceViewMixin, View):
+        def get(self, request):
+            with tracing.span('count'):
+                return HttpResponse(str(Device.objects.count()))
+
+    def traced_request(self):
+        middleware = RequestIDMiddleware(TracingMiddleware(self.DeviceCountView.as_view()))
+        return middleware(RequestFactory().get('/devices/', HTTP_X_REQUEST_ID='req_trace'))
+
+    def test_disabled_is_noop(self):
+        with mock.patch.dict(tracing.CONFIG, ENABLED=False):
+            with self.assertRaises(MiddlewareNotUsed):
+                TracingMiddleware(lambda request: None)
+            self.assertIs(tracing.NOOP, tracing.start_trace('job'))
+        self.assertIs(tracing.NOOP, tracing.span('orphan'))
+        self.assertIsNone(tracing.current_trace_id())
+
+    def test_sampled_request_emits_one_structured_record(self):
+        with mock.patch.dict(tracing.CONFIG, ENABLED=True, SAMPLE_RATE=1.0), self.assertLogs('tracing') as logs:
+            response = self.traced_request()
+        self.assertEqual('req_trace', response['X-Request-ID'])
+        self.assertEqual(1, len(logs.records))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(('req_trace', 'http'), (record['trace_id'], record['name']))
+        spans = {span['name']: span for span in record['spans']}
+        self.assertEqual(spans['http']['id'], spans['view.DeviceCountView']['parent'])
+        self.assertEqual(spans['view.DeviceCountView']['id'], spans['count']['parent'])
+        self.assertEqual(spans['count']['id'], spans['db']['parent'])
+        self.assertIn('SELECT COUNT', spans['db']['attrs']['sql'])
+        self.assertEqual(200, spans['http']['attrs']['status'])
+
+    def test_unsampled_request_records_nothing(self):
+        with mock.patch.dict(tracing.CONFIG, ENABLED=True, SAMPLE_RATE=0.0), \
+                mock.patch.object(tracing.logger, 'info') as info:
+            self.assertEqual(200, self.traced_request().status_code)
+        info.assert_not_called()
+
+    def test_error_and_async_spans(self):
+        @tracing.traced('work')
+        async def work():
+            await asyncio.sleep(0)
+            raise ValueError('bad')
+
+        async def run():
+            with tracing.start_trace('ws.test'):
+                await work()
+
+        with mock.patch.dict(tracing.CONFIG, ENABLED=True, SAMPLE_RATE=1.0), self.assertLogs('tracing') as logs:
+            with self.assertRaises(ValueError):
+                asyncio.run(run())
+        spans = {span['name']: span for span in json.loads(logs.records[0].getMessage())['spans']}
+        self.assertEqual('ValueError: bad', spans['work']['error'])
+
+    def test_queue_handler_drops_instead_of_blocking(self):
+        handler = tracing.QueueLogHandler(maxsize=1)
+        handler.listener.stop()  # 没有消费者，队列很快就满
+        for i in range(3):
+            handler.handle(logging.makeLogRecord({'msg': f'trace {i}'}))
+        self.assertEqual(2, handler.dropped)
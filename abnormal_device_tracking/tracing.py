@@ -0,0 +1,232 @@
+# abnormal_device_tracking/tracing.py
+import functools
+import inspect
+import json
+import logging
+import queue
+import random
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueListener
+
+from django.conf import settings
+from django.db import connections
+
+from abnormal_device_tracking.query_stats import fingerprint
+
+"""
+    结构化、采样的调用链追踪（替代请求路径上的print和TraceAllMethods）
+        1、头部采样：一条链路（HTTP请求、WebSocket消息、后台任务）开始时用start_trace()决定是否采样，之后整条链路都遵循这个决定；
+           未采样或TRACING['ENABLED']为False时当前span为None，span()/traced()直接返回共享的空对象，只有一次ContextVar读取
+        2、span：视图（TraceViewMixin）、状态转换（CustomViewActivation）、ORM（db_spans()给采样的请求挂execute_wrapper）、
+           Consumer（TracedConsumerMixin）都挂在当前链路下；用ContextVar保存当前span，线程和asyncio（含sync_to_async）都能正确传递
+        3、输出：链路结束时把全部span拼成一条JSON，写到'tracing'日志；QueueLogHandler只把记录放进有界队列，
+           由后台线程写出，请求线程不做任何I/O，队列满时丢弃并计数
+    HTTP请求的trace_id就是RequestIDMiddleware生成的request_id，日志和响应头X-Request-ID可以直接对上
+"""
+logger = logging.getLogger('tracing')
+
+DEFAULTS = {
+    'ENABLED': False,
+    'SAMPLE_RATE': 0.01,  # 头部采样率
+    'MAX_SPANS': 500,  # 单条链路最多记录的span数，超过只计数（避免循环里的查询撑爆内存）
+}
+CONFIG = dict(DEFAULTS, **getattr(settings, 'TRACING', {}))
+
+_current = ContextVar('tracing_span', default=None)
+
+
+class _NoopSpan:
+    """未采样时的span：所有操作都是空操作"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+    def __bool__(self):
+        return False
+
+
+NOOP = _NoopSpan()
+
+
+class Trace:
+    """一条链路：收集span，根span结束时输出"""
+    __slots__ = ('trace_id', 'spans', 'dropped', 'start')
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.spans = []
+        self.dropped = 0
+        self.start = time.perf_counter()
+
+    def add(self, span):
+        if len(self.spans) < CONFIG['MAX_SPANS']:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+    def emit(self, root):
+        record = {
+            'trace_id': self.trace_id, 'name': root.name, 'duration_ms': root.duration_ms,
+            'spans': [span.as_dict(self.start) for span in self.spans], 'dropped': self.dropped,
+        }
+        logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'attrs', 'start', 'duration_ms', 'error', '_token')
+
+    def __init__(self, trace, name, parent=None, attrs=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attrs = attrs or {}
+        self.start = None
+        self.duration_ms = None
+        self.error = None
+        self._token = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration_ms = round((time.perf_counter() - self.start) * 1000, 3)
+        if exc is not None:
+            self.error = f'{exc_type.__name__}: {exc}'
+        _current.reset(self._token)
+        self.trace.add(self)
+        if self.parent_id is None:
+            self.trace.emit(self)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def as_dict(self, origin):
+        data = {
+            'id': self.span_id, 'parent': self.parent_id, 'name': self.name,
+            'start_ms': round((self.start - origin) * 1000, 3), 'duration_ms': self.duration_ms,
+        }
+        if self.error:
+            data['error'] = self.error
+        if self.attrs:
+            data['attrs'] = self.attrs
+        return data
+
+
+def _sampled():
+    if not CONFIG['ENABLED']:
+        return False
+    rate = CONFIG['SAMPLE_RATE']
+    return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+
+def start_trace(name, trace_id=None, **attrs):
+    """开始一条链路（采样时返回根span，否则返回NOOP）；已经在链路中时作为子span"""
+    parent = _current.get()
+    if parent is not None:
+        return Span(parent.trace, name, parent, attrs)
+    if not _sampled():
+        return NOOP
+    return Span(Trace(trace_id or uuid.uuid4().hex[:16]), name, attrs=attrs)
+
+
+def span(name, **attrs):
+    """当前链路下的子span；不在采样的链路中时返回NOOP"""
+    parent = _current.get()
+    if parent is None:
+        return NOOP
+    return Span(parent.trace, name, parent, attrs)
+
+
+def current_trace_id():
+    current = _current.get()
+    return current.trace.trace_id if current is not None else None
+
+
+def traced(name=None):
+    """装饰器：函数调用作为一个span，支持async函数"""
+    def decorator(func):
+        span_name = name or func.__qualname__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _db_span(execute, sql, params, many, context):
+    if _current.get() is None:
+        return execute(sql, params, many, context)
+    with span('db', sql=fingerprint(sql)[:200], many=many):
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def db_spans():
+    """给当前线程的全部数据库连接挂上execute_wrapper，每条SQL记录为一个span（只在采样的链路中使用）"""
+    with ExitStack() as stack:
+        for conn in connections.all():
+            stack.enter_context(conn.execute_wrapper(_db_span))
+        yield
+
+
+class TracedConsumerMixin:
+    """Consumer的每条消息（连接、收到数据、组消息、断开）作为一条链路，放在Consumer类的最左边"""
+
+    async def dispatch(self, message):
+        with start_trace(f'ws.{type(self).__name__}.{message.get("type", "")}',
+                         channel=getattr(self, 'channel_name', None)):
+            return await super().dispatch(message)
+
+
+class QueueLogHandler(logging.Handler):
+    """
+    非阻塞的日志handler：emit只把记录放进有界队列（满了丢弃并计数），后台线程用StreamHandler写出
+    在settings.LOGGING中配置：{'class': 'abnormal_device_tracking.tracing.QueueLogHandler', 'maxsize': 10000}
+    （不继承logging.handlers.QueueHandler：Python 3.12的dictConfig会按QueueHandler的方式解析它的参数）
+    """
+
+    def __init__(self, maxsize=10000):
+        super().__init__()
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.listener = QueueListener(self.queue, logging.StreamHandler())
+        self.listener.start()
+
+    def close(self):
+        # 进程退出时logging.shutdown()会调用close：等后台线程写完队列里的记录
+        if self.listener._thread is not None:
+            try:
+                self.listener.stop()
+            except queue.Full:  # 队列已满，剩余记录丢弃
+                pass
+        super().close()
+
+    def emit(self, record):
+        try:
+            # 在当前线程格式化好消息，后台线程只负责写出
+            record.msg, record.args, record.exc_info = self.format(record), None, None
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
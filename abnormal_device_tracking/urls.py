@@ -17,6 +17,8 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from abnormal_device_tracking.metrics import metrics_view
+
 
 
 urlpatterns = [
@@ -26,5 +28,7 @@ urlpatterns = [
     path("accounts/", include("accounts.urls")),
     path("chat/", include("chat.urls")),
     path("problem_group/", include("problem_group.urls")),
+    path("analytics/", include("analytics.urls")),
+    path("metrics/", metrics_view, name="metrics"),
 
 ]
@@ -1,53 +1,25 @@
-import functools
+from abnormal_device_tracking import tracing
 
-# 调试用：用于追踪所有方法调用
-class TraceAllMethods:
-    def __getattribute__(self, name):
-        attr = super().__getattribute__(name)
-
-        if callable(attr) and not name.startswith('_') and name not in ['as_view', 'view_class']:
-
-            @functools.wraps(attr)
-            def traced_method(*args, **kwargs):
-                class_name = self.__class__.__name__
-
-                # 查找方法定义在哪个类中
-                defining_class = self._find_method_origin(name)
-
-                if defining_class and defining_class != class_name:
-                    print(f"🎯 [{class_name}.{name}] (来自 {defining_class}) 开始")
-                else:
-                    print(f"🎯 [{class_name}.{name}] 开始")
-
-                try:
-                    result = attr(*args, **kwargs)
-                    print(f"✅ [{class_name}.{name}] 完成")
-                    return result
-                except Exception as e:
-                    print(f"❌ [{class_name}.{name}] 错误: {e}")
-                    raise
-
-            return traced_method
-
-        return attr
-
-    def _find_method_origin(self, method_name):
-        """查找方法最初定义在哪个类中"""
-        # 遍历方法解析顺序(MRO)
-        for cls in self.__class__.mro():
-            if (method_name in cls.__dict__ and
-                    callable(getattr(cls, method_name))):
-                return cls.__name__
-        return None
+"""
+    视图/表单的追踪Mixin：基于abnormal_device_tracking/tracing.py的采样span，
+    未采样或关闭追踪时只多一次ContextVar读取（原来的TraceAllMethods每次属性访问都新建闭包并print）
+"""
 
 
 # 专门针对Django视图的追踪Mixin
-class TraceViewMixin(TraceAllMethods):
-    """Django视图追踪Mixin"""
-    pass
+class TraceViewMixin:
+    """Django视图追踪Mixin：dispatch作为一个span"""
+
+    def dispatch(self, request, *args, **kwargs):
+        with tracing.span(f'view.{type(self).__name__}', method=request.method):
+            return super().dispatch(request, *args, **kwargs)
 
 
 # 专门针对Django表单的追踪Mixin
-class TraceFormMixin(TraceAllMethods):
-    """Django表单追踪Mixin"""
-    pass
\ No newline at end of file
+class TraceFormMixin:
+    """Django表单追踪Mixin：校验（full_clean）作为一个span"""
+
+    def full_clean(self):
+        with tracing.span(f'form.{type(self).__name__}.full_clean') as current:
+            super().full_clean()
+            current.set(errors=len(self._errors or ()))
@@ -1,3 +1,8 @@
 from django.contrib import admin
 
+from analytics.models import NodeRollup, ProcessRollup, Watermark
+
 # Register your models here.
+admin.site.register(NodeRollup)
+admin.site.register(ProcessRollup)
+admin.site.register(Watermark)
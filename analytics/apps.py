@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class AnalyticsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'analytics'
+
+    def ready(self):
+        # 流转时增量更新KPI汇总（详见analytics/rollups.py）
+        from viewflow.workflow.signals import flow_finished, task_finished
+        from .rollups import record_process, record_task
+        task_finished.connect(record_task, dispatch_uid='analytics_record_task')
+        flow_finished.connect(record_process, dispatch_uid='analytics_record_process')
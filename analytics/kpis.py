@@ -0,0 +1,79 @@
+# analytics/kpis.py
+from datetime import datetime, time, timedelta
+
+from django.db.models import Sum
+from django.utils import timezone
+
+from analytics.models import NodeRollup, Period, ProcessRollup
+from analytics.rollups import NODE_FIELDS, PROCESS_FIELDS
+
+"""
+    统计页面的查询：只读analytics的汇总表（analytics/rollups.py），每个查询一条GROUP BY，
+    扫描的行数 = 时间桶数 × 维度取值数，与DeviceTask/AnalysisResults的历史数据量无关
+"""
+
+# 报废率可以按这些维度分组
+SCRAP_DIMENSIONS = ('project', 'fail_station', 'failure_mode')
+DEFAULT_DAYS = 30
+
+
+def time_range(start=None, end=None, days=DEFAULT_DAYS):
+    """日期（含两端）→ 本地时区的[起点, 终点)；不传时为最近days天"""
+    today = timezone.localdate()
+    end = end or today
+    start = start or end - timedelta(days=days - 1)
+    if start > end:
+        raise ValueError('开始日期不能晚于结束日期')
+    return (timezone.make_aware(datetime.combine(start, time.min)),
+            timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min)))
+
+
+def _rows(model, period, start, end, keys, fields, order_by=None, limit=None):
+    # 聚合结果不能与模型字段同名，用sum_前缀，返回时再还原
+    queryset = model.objects.filter(period=period, bucket__gte=start, bucket__lt=end) \
+        .values(*keys).annotate(**{f'sum_{field}': Sum(field) for field in fields}).order_by(*(order_by or keys))
+    if limit is not None:
+        queryset = queryset[:limit]
+    return [dict({key: row[key] for key in keys}, **{field: row[f'sum_{field}'] or 0 for field in fields})
+            for row in queryset]
+
+
+def _average_hours(seconds, count):
+    return round(seconds / count / 3600, 2) if count else None
+
+
+def node_kpis(start, end, period=Period.DAY):
+    """每个节点：完成任务数、平均周期、平均ASSIGNED停留、平均STARTED停留（小时）"""
+    return [{
+        'node': row['node'],
+        'completed': row['completed'],
+        'avg_cycle_hours': _average_hours(row['cycle_seconds'], row['completed']),
+        'avg_assigned_hours': _average_hours(row['assigned_seconds'], row['assigned_count']),
+        'avg_started_hours': _average_hours(row['started_seconds'], row['started_count']),
+    } for row in _rows(NodeRollup, period, start, end, ['node'], NODE_FIELDS)]
+
+
+def _process_kpi(row):
+    finished = row['finished']
+    return {
+        'finished': finished,
+        'scrapped': row['scrapped'],
+        'scrap_rate': round(row['scrapped'] / finished, 4) if finished else None,
+        'avg_retests': round(row['retests'] / finished, 2) if finished else None,
+        'avg_cycle_hours': _average_hours(row['cycle_seconds'], finished),
+    }
+
+
+def scrap_kpis(start, end, by='project', period=Period.DAY):
+    """按维度by统计结束的流程数、报废率、平均复测次数、平均流程周期，group为分组的取值"""
+    if by not in SCRAP_DIMENSIONS:
+        raise ValueError(f'不支持的分组维度:{by}')
+    return [dict(_process_kpi(row), group=row[by])
+            for row in _rows(ProcessRollup, period, start, end, [by], PROCESS_FIELDS)]
+
+
+def bug_clusters(start, end, period=Period.DAY, limit=20):
+    """按 (fail测项, bug号) 聚类的设备数，设备数多的在前；bug号为空表示该测项还有设备没有归到bug"""
+    rows = _rows(ProcessRollup, period, start, end, ['failure_mode', 'bug_number'], PROCESS_FIELDS,
+                 order_by=['-sum_finished', 'failure_mode', 'bug_number'], limit=limit)
+    return [dict(_process_kpi(row), failure_mode=row['failure_mode'], bug_number=row['bug_number']) for row in rows]
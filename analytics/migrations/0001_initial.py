@@ -0,0 +1,64 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Watermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('value', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NodeRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', '小时'), ('day', '天')], max_length=4)),
+                ('bucket', models.DateTimeField(verbose_name='时间桶起点')),
+                ('node', models.CharField(max_length=100, verbose_name='节点名')),
+                ('completed', models.PositiveIntegerField(default=0, verbose_name='完成任务数')),
+                ('cycle_seconds', models.FloatField(default=0, verbose_name='创建→完成总秒数')),
+                ('assigned_count', models.PositiveIntegerField(default=0)),
+                ('assigned_seconds', models.FloatField(default=0, verbose_name='分配→开始总秒数')),
+                ('started_count', models.PositiveIntegerField(default=0)),
+                ('started_seconds', models.FloatField(default=0, verbose_name='开始→完成总秒数')),
+            ],
+            options={
+                'verbose_name': '节点KPI汇总',
+                'verbose_name_plural': '节点KPI汇总',
+                'constraints': [models.UniqueConstraint(fields=('period', 'bucket', 'node'), name='node_rollup_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProcessRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', '小时'), ('day', '天')], max_length=4)),
+                ('bucket', models.DateTimeField(verbose_name='时间桶起点')),
+                ('project', models.CharField(blank=True, default='', max_length=20)),
+                ('fail_station', models.CharField(blank=True, default='', max_length=20)),
+                ('failure_mode', models.CharField(blank=True, default='', max_length=30)),
+                ('bug_number', models.CharField(blank=True, default='', max_length=15)),
+                ('finished', models.PositiveIntegerField(default=0, verbose_name='结束流程数')),
+                ('scrapped', models.PositiveIntegerField(default=0, verbose_name='报废数')),
+                ('retests', models.PositiveIntegerField(default=0, verbose_name='复测次数')),
+                ('cycle_seconds', models.FloatField(default=0, verbose_name='流程总秒数')),
+            ],
+            options={
+                'verbose_name': '流程KPI汇总',
+                'verbose_name_plural': '流程KPI汇总',
+                'constraints': [models.UniqueConstraint(fields=('period', 'bucket', 'project', 'fail_station', 'failure_mode', 'bug_number'), name='process_rollup_unique')],
+            },
+        ),
+    ]
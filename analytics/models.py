@@ -3,4 +3,67 @@ from django.db import models
 # Create your models here.
 '''
 数据统计
-'''
\ No newline at end of file
+    流程KPI的预聚合表（按小时/按天），统计页面只读这些表，不扫DeviceTask/AnalysisResults历史：
+        NodeRollup：每个节点完成的任务数、周期（创建→完成）、ASSIGNED停留（分配→开始）、STARTED停留（开始→完成）
+        ProcessRollup：按专案/fail站位/fail测项/bug号统计结束的流程数、报废数、复测次数、流程周期
+    时长字段存总秒数和样本数，平均值在查询时计算，这样不同时间桶可以直接相加
+    写入与重算见analytics/rollups.py
+'''
+
+
+class Period(models.TextChoices):
+    HOUR = 'hour', '小时'
+    DAY = 'day', '天'
+
+
+class NodeRollup(models.Model):
+    period = models.CharField(max_length=4, choices=Period.choices)
+    bucket = models.DateTimeField(verbose_name='时间桶起点')
+    node = models.CharField(max_length=100, verbose_name='节点名')
+    completed = models.PositiveIntegerField(default=0, verbose_name='完成任务数')
+    cycle_seconds = models.FloatField(default=0, verbose_name='创建→完成总秒数')
+    assigned_count = models.PositiveIntegerField(default=0)
+    assigned_seconds = models.FloatField(default=0, verbose_name='分配→开始总秒数')
+    started_count = models.PositiveIntegerField(default=0)
+    started_seconds = models.FloatField(default=0, verbose_name='开始→完成总秒数')
+
+    class Meta:
+        verbose_name = '节点KPI汇总'
+        verbose_name_plural = '节点KPI汇总'
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'bucket', 'node'], name='node_rollup_unique'),
+        ]
+
+
+class ProcessRollup(models.Model):
+    period = models.CharField(max_length=4, choices=Period.choices)
+    bucket = models.DateTimeField(verbose_name='时间桶起点')
+    # 维度字段用空字符串代替NULL，唯一约束才能生效
+    project = models.CharField(max_length=20, blank=True, default='')
+    fail_station = models.CharField(max_length=20, blank=True, default='')
+    failure_mode = models.CharField(max_length=30, blank=True, default='')
+    bug_number = models.CharField(max_length=15, blank=True, default='')
+    finished = models.PositiveIntegerField(default=0, verbose_name='结束流程数')
+    scrapped = models.PositiveIntegerField(default=0, verbose_name='报废数')
+    retests = models.PositiveIntegerField(default=0, verbose_name='复测次数')
+    cycle_seconds = models.FloatField(default=0, verbose_name='流程总秒数')
+
+    class Meta:
+        verbose_name = '流程KPI汇总'
+        verbose_name_plural = '流程KPI汇总'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['period', 'bucket', 'project', 'fail_station', 'failure_mode', 'bug_number'],
+                name='process_rollup_unique',
+            ),
+        ]
+
+
+class Watermark(models.Model):
+    """回填进度：value之前的整点小时已经按源数据重算过"""
+    name = models.CharField(max_length=50, unique=True)
+    value = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
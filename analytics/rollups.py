@@ -0,0 +1,171 @@
+# analytics/rollups.py
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Exists, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from viewflow.workflow import STATUS
+
+from analytics.models import NodeRollup, Period, ProcessRollup
+from workflows.models import DeviceProcess, DeviceTask
+
+"""
+    流程KPI预聚合的写入与重算
+    两条写入路径，互不重复计数：
+        1、增量：viewflow的task_finished/flow_finished信号（在流转的事务中发出），把这一个任务/流程的贡献
+           用UPDATE ... SET x = x + n 累加到所在的小时桶和天桶，统计失败只记日志，不影响流转
+        2、回填：manage.py rollup_analytics 从水位线开始，按块用源数据重算已经结束的整点小时（先删后写），
+           再由小时汇总重新求和得到涉及到的天汇总；当前小时只由增量路径写入，所以两条路径不会重复
+    统计页面（analytics/kpis.py）只读汇总表，耗时与历史数据量无关
+"""
+logger = logging.getLogger(__name__)
+
+# 复测节点：流程在这些节点上的任务数即复测次数
+RETEST_NODES = ('FAE_initial_retest', 'FAE_final_retest')
+SCRAPPED_NODE = 'scrapped'
+NODE_FIELDS = ['completed', 'cycle_seconds', 'assigned_count', 'assigned_seconds', 'started_count', 'started_seconds']
+PROCESS_KEYS = ['project', 'fail_station', 'failure_mode', 'bug_number']
+PROCESS_FIELDS = ['finished', 'scrapped', 'retests', 'cycle_seconds']
+
+
+def bucket_start(value, period):
+    """value所在时间桶的起点（按本地时区取整点/零点）"""
+    local = timezone.localtime(value).replace(minute=0, second=0, microsecond=0)
+    if period == Period.DAY:
+        local = local.replace(hour=0)
+    return local
+
+
+def _seconds(start, end):
+    return (end - start).total_seconds()
+
+
+def task_values(task):
+    """一个完成的任务对节点汇总的贡献"""
+    values = dict.fromkeys(NODE_FIELDS, 0)
+    values['completed'] = 1
+    values['cycle_seconds'] = _seconds(task.created, task.finished)
+    if task.started:
+        if task.assigned:
+            values['assigned_count'] = 1
+            values['assigned_seconds'] = _seconds(task.assigned, task.started)
+        values['started_count'] = 1
+        values['started_seconds'] = _seconds(task.started, task.finished)
+    return values
+
+
+def process_rows(queryset):
+    """结束的流程 → (维度, 贡献) 列表，报废和复测次数在同一条SQL里用子查询带出"""
+    from workflows.flows import DeviceInvestigationFlow as flow_class  # 避免应用加载时导入流程定义
+
+    node = flow_class.instance.node
+    tasks = DeviceTask.objects.filter(process_id=OuterRef('pk'))
+    retests = tasks.filter(flow_task__in=[node(name) for name in RETEST_NODES]) \
+        .order_by().values('process_id').annotate(count=Count('pk')).values('count')[:1]
+    rows = queryset.annotate(
+        is_scrapped=Exists(tasks.filter(flow_task=node(SCRAPPED_NODE))),
+        retest_count=Coalesce(Subquery(retests), Value(0)),
+    ).values_list(
+        'device__project', 'device__fail_station', 'device__failure_mode', 'device__bug__bug_number',
+        'created', 'finished', 'is_scrapped', 'retest_count',
+    )
+    for project, fail_station, failure_mode, bug_number, created, finished, is_scrapped, retest_count in rows:
+        keys = dict(zip(PROCESS_KEYS, (value or '' for value in (project, fail_station, failure_mode, bug_number))))
+        values = {
+            'finished': 1, 'scrapped': int(is_scrapped), 'retests': retest_count,
+            'cycle_seconds': _seconds(created, finished),
+        }
+        yield finished, keys, values
+
+
+def _increment(model, keys, values):
+    changes = {field: F(field) + value for field, value in values.items() if value}
+    if model.objects.filter(**keys).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**keys, **values)
+    except IntegrityError:  # 并发的第一次写入
+        model.objects.filter(**keys).update(**changes)
+
+
+def record_task(sender, process, task, **kwargs):
+    """task_finished信号的接收器：只统计业务节点（HUMAN）"""
+    if not isinstance(process, DeviceProcess) or task.flow_task_type != 'HUMAN' or task.finished is None:
+        return
+    try:
+        with transaction.atomic():
+            values = task_values(task)
+            for period in Period.values:
+                _increment(NodeRollup, {
+                    'period': period, 'bucket': bucket_start(task.finished, period), 'node': task.flow_task.name,
+                }, values)
+    except Exception:
+        logger.exception("节点KPI增量统计失败，等待回填修正 | task:%s", task.pk)
+
+
+def record_process(sender, process, **kwargs):
+    """flow_finished信号的接收器"""
+    if not isinstance(process, DeviceProcess):
+        return
+    try:
+        with transaction.atomic():
+            for finished, keys, values in process_rows(DeviceProcess.objects.filter(pk=process.pk)):
+                for period in Period.values:
+                    _increment(ProcessRollup, dict(keys, period=period, bucket=bucket_start(finished, period)), values)
+    except Exception:
+        logger.exception("流程KPI增量统计失败，等待回填修正 | process:%s", process.pk)
+
+
+def _accumulate(target, values):
+    for field, value in values.items():
+        target[field] += value
+
+
+def rebuild_hours(start, end):
+    """用源数据重算[start, end)内的小时汇总（start/end为整点），再由小时汇总重算涉及到的天汇总"""
+    nodes = defaultdict(lambda: dict.fromkeys(NODE_FIELDS, 0))
+    tasks = DeviceTask.objects.filter(
+        flow_task_type='HUMAN', status=STATUS.DONE, finished__gte=start, finished__lt=end,
+    ).only('flow_task', 'created', 'assigned', 'started', 'finished')
+    for task in tasks.iterator(chunk_size=2000):
+        _accumulate(nodes[(bucket_start(task.finished, Period.HOUR), task.flow_task.name)], task_values(task))
+
+    processes = defaultdict(lambda: dict.fromkeys(PROCESS_FIELDS, 0))
+    finished_processes = DeviceProcess.objects.filter(status=STATUS.DONE, finished__gte=start, finished__lt=end)
+    for finished, keys, values in process_rows(finished_processes):
+        _accumulate(processes[(bucket_start(finished, Period.HOUR), *keys.values())], values)
+
+    with transaction.atomic():
+        NodeRollup.objects.filter(period=Period.HOUR, bucket__gte=start, bucket__lt=end).delete()
+        NodeRollup.objects.bulk_create([
+            NodeRollup(period=Period.HOUR, bucket=bucket, node=node, **values)
+            for (bucket, node), values in nodes.items()
+        ], batch_size=1000)
+        ProcessRollup.objects.filter(period=Period.HOUR, bucket__gte=start, bucket__lt=end).delete()
+        ProcessRollup.objects.bulk_create([
+            ProcessRollup(period=Period.HOUR, bucket=bucket, **dict(zip(PROCESS_KEYS, keys)), **values)
+            for (bucket, *keys), values in processes.items()
+        ], batch_size=1000)
+        rebuild_days(start, end)
+    return len(nodes), len(processes)
+
+
+def rebuild_days(start, end):
+    """由小时汇总重新求和得到[start, end)涉及到的天汇总"""
+    first_day = bucket_start(start, Period.DAY)
+    last_day = bucket_start(end - timedelta(microseconds=1), Period.DAY) + timedelta(days=1)
+    for model, keys, fields in ((NodeRollup, ['node'], NODE_FIELDS), (ProcessRollup, PROCESS_KEYS, PROCESS_FIELDS)):
+        days = defaultdict(lambda: dict.fromkeys(fields, 0))
+        hours = model.objects.filter(period=Period.HOUR, bucket__gte=first_day, bucket__lt=last_day) \
+            .values_list('bucket', *keys, *fields)
+        for bucket, *row in hours:
+            _accumulate(days[(bucket_start(bucket, Period.DAY), *row[:len(keys)])], dict(zip(fields, row[len(keys):])))
+        model.objects.filter(period=Period.DAY, bucket__gte=first_day, bucket__lt=last_day).delete()
+        model.objects.bulk_create([
+            model(period=Period.DAY, bucket=bucket, **dict(zip(keys, key_values)), **values)
+            for (bucket, *key_values), values in days.items()
+        ], batch_size=1000)
@@ -1,3 +1,123 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+from django.utils import timezone
+from viewflow.workflow import STATUS
+
+from accounts.models import Employee
+from analytics.kpis import bug_clusters, node_kpis, scrap_kpis, time_range
+from analytics.models import NodeRollup, Period, ProcessRollup, Watermark
+from analytics.rollups import bucket_start, record_task
+from devices.models import Device
+from problem_group.models import Bug
+from workflows.flows import DeviceInvestigationFlow
+from workflows.models import DeviceProcess, DeviceTask
 
 # Create your tests here.
+
+
+def create_employee(username):
+    return Employee.objects.create_user(username=username, password='password',
+                                        email=f'{username}@example.com', number=username[:10])
+
+
+class RollupTest(TestCase):
+    def setUp(self):
+        self.user = create_employee('kpi')
+        # 历史数据放在两天前，回填时都属于已经结束的小时
+        self.base = bucket_start(timezone.now() - timedelta(days=2), Period.HOUR)
+
+    def create_process(self, sn, nodes, scrapped=False, project='X2301', bug=None):
+        """构造一个已经结束的流程：nodes中每个节点一个完成的任务，每个任务1小时（分配后等10分钟开始）"""
+        device = Device.objects.create(sn=sn, project=project, fail_station='FCT', failure_mode='wifi_rssi', bug=bug)
+        process = DeviceProcess.objects.create(device=device, flow_class=DeviceInvestigationFlow)
+        if scrapped:
+            nodes = [*nodes, DeviceInvestigationFlow.scrapped]
+        start = self.base
+        for node in nodes:
+            task = DeviceTask.objects.create(process=process, flow_task=node, flow_task_type='HUMAN',
+                                             status=STATUS.DONE, owner=self.user)
+            DeviceTask.objects.filter(pk=task.pk).update(
+                created=start, assigned=start, started=start + timedelta(minutes=10), finished=start + timedelta(hours=1),
+            )
+            start += timedelta(hours=1)
+        DeviceProcess.objects.filter(pk=process.pk).update(created=self.base, finished=start, status=STATUS.DONE)
+        return process
+
+    def rollup(self, **options):
+        out = StringIO()
+        call_command('rollup_analytics', stdout=out, **options)
+        return out.getvalue()
+
+    def test_backfill_is_idempotent_and_moves_watermark(self):
+        flow = DeviceInvestigationFlow
+        bug = Bug.objects.create(bug_number='BUG-1', created_by=self.user)
+        self.create_process('KPI001', [flow.production_test_fail, flow.FAE_initial_retest, flow.X_ray_test,
+                                       flow.FAE_initial_retest], scrapped=True, bug=bug)
+        self.create_process('KPI002', [flow.production_test_fail, flow.FAE_initial_retest])
+        self.assertIn('Successfully rollup', self.rollup())
+        counts = (NodeRollup.objects.count(), ProcessRollup.objects.count())
+        self.rollup(since=self.base.date().isoformat())  # 重算同一时间段，结果不变
+        self.assertEqual(counts, (NodeRollup.objects.count(), ProcessRollup.objects.count()))
+        self.assertEqual(bucket_start(timezone.now(), Period.HOUR), Watermark.objects.get().value)
+
+        start, end = time_range(days=7)
+        nodes = {row['node']: row for row in node_kpis(start, end)}
+        self.assertEqual(3, nodes['FAE_initial_retest']['completed'])
+        self.assertEqual(1.0, nodes['production_test_fail']['avg_cycle_hours'])
+        self.assertEqual(0.17, nodes['production_test_fail']['avg_assigned_hours'])
+        self.assertEqual(0.83, nodes['production_test_fail']['avg_started_hours'])
+        [project] = scrap_kpis(start, end)
+        self.assertEqual(('X2301', 2, 1, 0.5, 1.5), (
+            project['group'], project['finished'], project['scrapped'], project['scrap_rate'], project['avg_retests'],
+        ))
+        self.assertEqual([('wifi_rssi', '', 1), ('wifi_rssi', 'BUG-1', 1)], sorted(
+            (row['failure_mode'], row['bug_number'], row['finished']) for row in bug_clusters(start, end)
+        ))
+        # 小时汇总与天汇总一致
+        hours = node_kpis(start, end, Period.HOUR)
+        self.assertEqual(sorted(nodes.values(), key=lambda row: row['node']), hours)
+
+    def test_backfill_replaces_incremental_counts(self):
+        process = self.create_process('KPI003', [DeviceInvestigationFlow.production_test_fail])
+        task = DeviceTask.objects.get(process=process)
+        record_task(None, process, task)  # 流转时的增量统计
+        self.assertEqual(1, NodeRollup.objects.get(period=Period.DAY).completed)
+        self.rollup()
+        self.assertEqual(1, NodeRollup.objects.get(period=Period.DAY).completed)
+
+    def test_transition_updates_rollup(self):
+        device = Device.objects.create(sn='KPI004')
+        process = DeviceProcess.objects.create(device=device, flow_class=DeviceInvestigationFlow)
+        task = DeviceTask.objects.create(process=process, flow_task=DeviceInvestigationFlow.production_test_fail,
+                                         flow_task_type='HUMAN')
+        activation = task.flow_task.activation_class(task)
+        activation.assign(self.user)
+        activation.start(RequestFactory().get('/'))
+        task.data_submitted = True
+        task.save()
+        activation.complete()
+        for period in Period.values:
+            rollup = NodeRollup.objects.get(period=period, node='production_test_fail')
+            self.assertEqual((1, 1, 1), (rollup.completed, rollup.assigned_count, rollup.started_count))
+
+    def test_kpi_queries_do_not_grow_with_history(self):
+        start, end = time_range(days=7)
+        with self.assertNumQueries(1):
+            node_kpis(start, end)
+        for i in range(5):
+            self.create_process(f'KPI1{i:02d}', [DeviceInvestigationFlow.production_test_fail])
+        self.rollup()
+        with self.assertNumQueries(1):
+            node_kpis(start, end)
+
+    def test_views(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('analytics:kpi', args=['scrap']), {'by': 'fail_station'})
+        self.assertEqual({'rows': []}, response.json())
+        self.assertEqual(400, self.client.get(reverse('analytics:kpi', args=['nodes']), {'start': 'x'}).status_code)
+        self.assertEqual(404, self.client.get(reverse('analytics:kpi', args=['unknown'])).status_code)
+        self.assertContains(self.client.get(reverse('analytics:dashboard')), '节点周期')
@@ -0,0 +1,9 @@
+from django.urls import path
+
+from analytics.views import AnalyticsDashboardView, KpiView
+
+app_name = 'analytics'
+urlpatterns = [
+    path('', AnalyticsDashboardView.as_view(), name='dashboard'),
+    path('kpi/<str:kind>', KpiView.as_view(), name='kpi'),  # 流程KPI的JSON接口
+]
@@ -1,3 +1,67 @@
-from django.shortcuts import render
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.http import JsonResponse
+from django.utils.dateparse import parse_date
+from django.views import View
+from django.views.generic import TemplateView
+
+from analytics.kpis import SCRAP_DIMENSIONS, bug_clusters, node_kpis, scrap_kpis, time_range
+from analytics.models import Period
+
 
 # Create your views here.
+def parse_params(params):
+    """GET ?start=YYYY-MM-DD&end=YYYY-MM-DD&period=day|hour&by=project|fail_station|failure_mode"""
+    days = []
+    for name in ('start', 'end'):
+        value = params.get(name)
+        day = parse_date(value) if value else None
+        if value and day is None:
+            raise ValueError(f'日期格式应为YYYY-MM-DD:{value}')
+        days.append(day)
+    period = params.get('period') or Period.DAY
+    if period not in Period.values:
+        raise ValueError(f'不支持的统计粒度:{period}')
+    start, end = time_range(*days)
+    return start, end, period, params.get('by') or 'project'
+
+
+KPIS = {
+    'nodes': lambda start, end, period, by: node_kpis(start, end, period),
+    'scrap': lambda start, end, period, by: scrap_kpis(start, end, by, period),
+    'clusters': lambda start, end, period, by: bug_clusters(start, end, period),
+}
+
+
+class KpiView(LoginRequiredMixin, View):
+    """流程KPI接口（只读汇总表）：/analytics/kpi/<nodes|scrap|clusters>，返回 {'rows': [...]}"""
+
+    def get(self, request, kind):
+        if kind not in KPIS:
+            return JsonResponse({'error': f'不支持的统计项:{kind}'}, status=404)
+        try:
+            rows = KPIS[kind](*parse_params(request.GET))
+        except ValueError as e:
+            return JsonResponse({'error': f'参数格式错误:{e}'}, status=400)
+        return JsonResponse({'rows': rows})
+
+
+class AnalyticsDashboardView(LoginRequiredMixin, TemplateView):
+    """数据统计页面：节点周期/停留时间、报废率、bug聚类，参数同KpiView"""
+    template_name = 'analytics/dashboard.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['dimensions'] = SCRAP_DIMENSIONS
+        context['params'] = self.request.GET
+        try:
+            params = parse_params(self.request.GET)
+        except ValueError as e:
+            context['error'] = str(e)
+            return context
+        context['by'] = params[-1]
+        for kind, kpi in KPIS.items():
+            try:
+                context[kind] = kpi(*params)
+            except ValueError as e:
+                context['error'] = str(e)
+        return context
@@ -1,7 +1,8 @@
 from django.contrib import admin
 
-from chat.models import Chatroom, Message
+from chat.models import Chatroom, Message, ReadState
 
 # Register your models here.
 admin.site.register(Chatroom)
-admin.site.register(Message)
\ No newline at end of file
+admin.site.register(Message)
+admin.site.register(ReadState)
\ No newline at end of file
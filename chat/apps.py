@@ -7,8 +7,17 @@ class ChatConfig(AppConfig):
 
     def ready(self):
         # 延迟导入
-        from django.db.models.signals import post_save
+        from django.db.models.signals import post_save, post_delete, m2m_changed
         from workflows.models import DeviceProcess
-        from .signals import create_chatroom
+        from workflows.state import device_states_changed
+        from .board import publish_delta
+        from .membership import chatroom_deleted, chatroom_members_changed
+        from .models import Chatroom
+        from .signals import create_chatroom  # 同时注册后台任务chat.ensure_chatroom
         # 手动注册（替代装饰器，更灵活），post_save是django的内置信号
-        post_save.connect(create_chatroom, sender=DeviceProcess,dispatch_uid='chat_create_chatroom') # connect()建立信号与接收者函数的绑定关系，dispatch_uid是（唯一标识），确保一个接收器只注册一次
\ No newline at end of file
+        post_save.connect(create_chatroom, sender=DeviceProcess,dispatch_uid='chat_create_chatroom') # connect()建立信号与接收者函数的绑定关系，dispatch_uid是（唯一标识），确保一个接收器只注册一次
+        # 连接缓存失效：聊天室删除、成员变更时清除ChatConsumer.connect使用的缓存
+        post_delete.connect(chatroom_deleted, sender=Chatroom, dispatch_uid='chat_chatroom_deleted')
+        m2m_changed.connect(chatroom_members_changed, sender=Chatroom.members.through, dispatch_uid='chat_members_changed')
+        # 设备状态投影变化时向实时状态看板推送增量
+        device_states_changed.connect(publish_delta, dispatch_uid='chat_board_publish_delta')
@@ -0,0 +1,181 @@
+# chat/board.py
+import asyncio
+import json
+import logging
+import time
+import weakref
+from collections import Counter, defaultdict
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import Count
+
+from devices.models import DeviceState
+
+"""
+    实时状态看板：按节点/位置/专案统计的设备数（数据来自DeviceState投影表，见workflows/state.py）
+        1、投影在事务提交后发出device_states_changed信号，publish_delta()把变化量group_send到BOARD_GROUP，
+           每次提交一条消息，组里只有每个进程的BoardHub（一个进程一个通道），不是每个看板连接
+        2、BoardHub在本进程第一个看板连接时查一次统计快照（3条GROUP BY），之后只在内存中累加变化量，
+           每BROADCAST_INTERVAL秒把合并后的增量直接发给本进程的全部看板连接；新连接直接拿内存中的快照
+        3、每RESYNC_INTERVAL秒重查一次快照并全量下发，修正快照和增量交错时可能的偏差，同时续期group
+    看板开得再多，数据库开销也只和进程数有关
+"""
+logger = logging.getLogger(__name__)
+
+BOARD_GROUP = 'device_board'
+BROADCAST_INTERVAL = getattr(settings, 'DEVICE_BOARD_BROADCAST_INTERVAL', 1.0)  # 秒
+RESYNC_INTERVAL = getattr(settings, 'DEVICE_BOARD_RESYNC_INTERVAL', 300.0)  # 秒，要小于通道层的group_expiry
+# 看板维度 → DeviceState上的字段
+DIMENSIONS = {'node': 'current_node', 'position': 'current_position', 'project': 'device__project'}
+
+
+def board_snapshot():
+    """{维度: {取值: 设备数}}，空值不统计"""
+    snapshot = {}
+    for dimension, field in DIMENSIONS.items():
+        rows = DeviceState.objects.exclude(**{f'{field}__isnull': True}).exclude(**{field: ''}) \
+            .values_list(field).annotate(count=Count('pk')).order_by()
+        snapshot[dimension] = dict(rows)
+    return snapshot
+
+
+def publish_delta(sender, delta, **kwargs):
+    """device_states_changed信号的接收器，在事务提交后调用；发送失败只记日志，不影响已提交的业务"""
+    try:
+        async_to_sync(get_channel_layer().group_send)(BOARD_GROUP, {"type": "board.delta", "delta": delta})
+    except Exception:
+        logger.exception("看板增量发送失败 | 变化量:%s", delta)
+
+
+class BoardHub:
+    """一个事件循环一个实例，通过get_board()获取"""
+
+    def __init__(self, broadcast_interval=BROADCAST_INTERVAL, resync_interval=RESYNC_INTERVAL):
+        self.broadcast_interval = broadcast_interval
+        self.resync_interval = resync_interval
+        self.consumers = set()
+        self.counts = None  # {维度: Counter}
+        self.pending = defaultdict(Counter)
+        self.channel_name = None
+        self._ready = None  # 订阅并加载快照的Task，并发连接共用
+        self._tasks = []
+
+    async def join(self, consumer):
+        """看板连接加入，返回当前快照"""
+        self.consumers.add(consumer)
+        if self._ready is None:
+            self._ready = asyncio.ensure_future(self._start())
+        ready = self._ready
+        try:
+            await asyncio.shield(ready)
+        except Exception:
+            self.consumers.discard(consumer)
+            if self._ready is ready:  # 加载失败，下一个连接重试
+                self._ready = None
+                for task in self._tasks:
+                    task.cancel()
+                self._tasks = []
+            raise
+        return self.snapshot()
+
+    async def leave(self, consumer):
+        self.consumers.discard(consumer)
+        if self.consumers or self._ready is None:
+            return
+        # 本进程没有看板连接了：退订，丢弃快照，下次有连接时重新加载
+        ready, tasks, self._ready, self._tasks = self._ready, self._tasks, None, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(ready, *tasks, return_exceptions=True)
+        if self.channel_name is not None:
+            await get_channel_layer().group_discard(BOARD_GROUP, self.channel_name)
+            self.channel_name = None
+        self.counts = None
+        self.pending.clear()
+
+    def snapshot(self):
+        return {dimension: dict(counts) for dimension, counts in self.counts.items()}
+
+    async def _start(self):
+        channel_layer = get_channel_layer()
+        self.channel_name = await channel_layer.new_channel()
+        # 先订阅并开始接收，再查快照；查询完成前收到的变化量视为已包含在快照里，剩余的偏差由定期重查修正
+        await channel_layer.group_add(BOARD_GROUP, self.channel_name)
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._receive())]
+        await self._load()
+        self._tasks.append(loop.create_task(self._run()))
+
+    async def _load(self):
+        snapshot = await database_sync_to_async(board_snapshot)()
+        self.counts = {dimension: Counter(snapshot.get(dimension, {})) for dimension in DIMENSIONS}
+        self.pending.clear()
+
+    def add(self, delta):
+        for dimension, changes in delta.items():
+            self.pending[dimension].update(changes)
+
+    async def _receive(self):
+        channel_layer = get_channel_layer()
+        while True:
+            message = await channel_layer.receive(self.channel_name)
+            if message.get('type') == 'board.delta':
+                self.add(message['delta'])
+
+    async def _run(self):
+        last_resync = time.monotonic()
+        while True:
+            await asyncio.sleep(self.broadcast_interval)
+            try:
+                if time.monotonic() - last_resync >= self.resync_interval:
+                    last_resync = time.monotonic()
+                    await get_channel_layer().group_add(BOARD_GROUP, self.channel_name)
+                    await self._load()
+                    await self._send({"type": "snapshot", "counts": self.snapshot()})
+                else:
+                    await self.flush()
+            except Exception:
+                logger.exception("看板刷新失败")
+
+    async def flush(self):
+        """把合并后的变化量应用到快照，并下发给本进程的全部看板连接"""
+        pending, self.pending = self.pending, defaultdict(Counter)
+        diff = {}
+        for dimension, changes in pending.items():
+            changes = {value: count for value, count in changes.items() if count}
+            if not changes:
+                continue
+            counts = self.counts[dimension]
+            counts.update(changes)
+            # 变化后为0的项下发0，前端据此删除
+            diff[dimension] = {value: counts[value] for value in changes}
+            for value in changes:
+                if counts[value] <= 0:
+                    del counts[value]
+        if diff:
+            await self._send({"type": "diff", "counts": diff})
+
+    async def _send(self, payload):
+        text_data = json.dumps(payload, ensure_ascii=False)
+        # 同一进程的连接直接发送，不经过通道层
+        results = await asyncio.gather(
+            *(consumer.send(text_data=text_data) for consumer in list(self.consumers)), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning("看板推送失败: %s", result)
+
+
+# 事件循环 → BoardHub，和chat/presence.py的PresenceHub一样按事件循环区分
+_boards = weakref.WeakKeyDictionary()
+
+
+def get_board():
+    loop = asyncio.get_running_loop()
+    board = _boards.get(loop)
+    if board is None:
+        board = _boards[loop] = BoardHub()
+    return board
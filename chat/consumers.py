@@ -1,79 +1,161 @@
+import asyncio
 import json
+import logging
+import time
+import uuid
+from datetime import datetime
 
 from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.utils import timezone
 
+from abnormal_device_tracking import tracing
+from abnormal_device_tracking.metrics import CHAT_FANOUT_LATENCY
+from chat.board import get_board
+from chat.history import fetch_page, serialize_message
+from chat.membership import ensure_member, get_chatroom_id, get_member_ids
 from chat.models import Message, Chatroom
+from chat.pipeline import get_writer
+from chat.presence import TYPING_TTL, get_hub
 
+logger = logging.getLogger(__name__)
+
+
+class ChatConsumer(tracing.TracedConsumerMixin, AsyncWebsocketConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending_writes = set()  # 本连接还没落库的消息的Future
 
-class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        @sync_to_async
-        def get_chatroom():
-            return Chatroom.objects.get(name=self.name)
+        @database_sync_to_async
+        def join_chatroom(name, owner):
+            # 热路径（聊天室和成员关系都已缓存）不查库，详见chat/membership.py
+            chatroom_id = get_chatroom_id(name)
+            if chatroom_id is None:
+                return None, frozenset()
+            ensure_member(chatroom_id, owner.pk)
+            return chatroom_id, get_member_ids(chatroom_id)
 
         self.name = self.scope["url_route"]["kwargs"]["name"]
         self.room_group_name = f"chat_{self.name}"
         self.owner = self.scope["user"] # 通过Channels的AuthMiddleware从WebSocket握手时的cookie/session中提取的
-        self.chatroom = await get_chatroom()
-
-        print(f"WebSocket连接请求: 路径参数room ='{self.name}', 群组名 ='{self.room_group_name}'")
+        chatroom_id, member_ids = await join_chatroom(self.name, self.owner)
+        if chatroom_id is None:
+            await self.close()
+            return
+        # 只需要id，不加载整行
+        self.chatroom = Chatroom(id=chatroom_id, name=self.name)
+
+        logger.debug("WebSocket连接: room=%s group=%s", self.name, self.room_group_name)
         # 将通道名加入 Redis 对应组的列表中，需要注意的是：Daphne 的 “通道名→连接实例” 映射 是在框架内部更早阶段（调用connect之前，daphne服务器对WebSocket 请求握手验证时）自动完成的
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)  # channel_name是这个连接在通道层中的唯一ID
 
-        @sync_to_async
-        def save_chatroom_member(owner, chatroom_id): # 把当前用户加入到聊天室
-            chatroom = Chatroom.objects.filter(id=chatroom_id).first()
-            if owner not in chatroom.members.all():
-                chatroom.members.add(owner)
-                chatroom.save()
-        await save_chatroom_member(self.owner, self.chatroom.id)
-
         await self.accept()
 
+        # 在线状态：加入本进程的PresenceHub，并把当前在线成员发给自己（详见chat/presence.py）
+        # 页面刚渲染完最新的消息，以连接时间作为已看到的位置，之后随收到的消息推进
+        self.last_seen_at = timezone.now()
+        online = await get_hub().join(self.chatroom.id, self.room_group_name, self.owner, member_ids)
+        await self.send(text_data=json.dumps({
+            "type": "presence", "online": {str(k): v for k, v in online.items()},
+            "offline": [], "typing": {}, "typing_ttl": TYPING_TTL, "read": {},
+        }))
+
     async def disconnect(self, close_code):
+        if getattr(self, "chatroom", None) is None:  # 聊天室不存在，连接时已拒绝
+            return
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await get_hub().leave(self.chatroom.id, self.owner)
+        # 持久性：断开前把本连接还没落库的消息写完
+        if self.pending_writes:
+            await get_writer().flush()
+            await asyncio.gather(*self.pending_writes, return_exceptions=True)
 
     # 接收服务器消息
     async def receive(self, text_data):
-        # 消息是否抵达Consumer
-        print(f"Consumer.receive 收到原始数据: {text_data}")
         text_data_json = json.loads(text_data)
+        # 前端滚动到顶部时请求更早的聊天记录，只回给当前连接，不广播
+        if text_data_json.get("type") == "history":
+            await self.send_history(text_data_json.get("before"))
+            return
+        # 正在输入/已读只交给PresenceHub合并，不立即广播，也不写库
+        if text_data_json.get("type") == "typing":
+            get_hub().typing(self.chatroom.id, self.owner)
+            return
+        if text_data_json.get("type") == "read":
+            get_hub().read(self.chatroom.id, self.owner, self.last_seen_at)
+            return
         message_content = text_data_json["message_content"]
-        chatroom_id = text_data_json["chatroom_id"]
 
-        # 消息解析和准备发送的群组
-        print(f"Consumer.receive 解析消息: '{message_content}', 目标群组: '{self.room_group_name}', 连接名: '{self.channel_name}'")
+        # 写后管道：在内存中构造消息（服务端生成uid和时间），交给本进程的MessageWriter批量写库，不等写库直接广播
+        # 聊天室用连接时解析出的self.chatroom，不信任客户端传来的chatroom_id；owner是握手时已加载的用户，不会触发懒加载
+        self.message = Message(
+            uid=uuid.uuid4(), chatroom_id=self.chatroom.id, owner=self.owner,
+            content=message_content, created_at=timezone.now(),
+        )
+        self.track_write(get_writer().submit(self.message), self.message)
 
-        # 定义异步函数save_chat_message 保存消息到数据库
-        @sync_to_async  # sync_to_async装饰器：异步customer调用同步代码（如 Django ORM、同步业务函数）时使用
-        def save_chat_message(message_content, owner,chatroom_id):
-            return Message.objects.create(content=message_content, owner=owner, chatroom_id=chatroom_id)
+        self.message_data = serialize_message(self.message)
 
+        # 发送消息到群组，让聊天室的每一个成员都能实时收到消息
+        fanout_start = time.perf_counter()
+        with tracing.span('ws.group_send', group=self.room_group_name):
+            await self.channel_layer.group_send( # 该方法实际做的事情是 channel-redis从Redis查询组内所有channel，对每个channel: LPUSH + PUBLISH，把消息推送到对应通道的消息队列中，并通知所有daphne实例来消息了
+                # 在Django Channels中，当 group_send 发送的事件中的 type 字段被框架接收后，它会在调用消费者实例的方法前，**自动将类型字符串中的点 . 替换为下划线 _**
+                self.room_group_name,
+                {"type": "chat.message", "message": self.message_data, "sent_at": self.message.created_at.isoformat()}
+            )
+        CHAT_FANOUT_LATENCY.observe(time.perf_counter() - fanout_start)
+        # await self.send(text_data=json.dumps({"message": message}))
 
-        # 保存消息（await 调用）
-        self.message = await save_chat_message(message_content,self.owner,chatroom_id)
+    def track_write(self, future, message):
+        """跟踪消息的写库结果：断开连接时等待全部写完，写库失败时通知发送者"""
+        self.pending_writes.add(future)
 
-        self.message_data = {
-            "content": self.message.content,
-            "owner": self.message.owner.username,
-            "created_at": self.message.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+        def done(future):
+            self.pending_writes.discard(future)
+            if future.exception() is not None:
+                asyncio.ensure_future(self.send(text_data=json.dumps({
+                    "type": "error", "uid": str(message.uid), "error": "消息保存失败，请重新发送",
+                })))
+        future.add_done_callback(done)
 
-        }
+    async def presence_update(self, event):
+        await self.send(text_data=json.dumps({"type": "presence", **event["presence"]}))
 
-        # 发送消息到群组，让聊天室的每一个成员都能实时收到消息
-        await self.channel_layer.group_send( # 该方法实际做的事情是 channel-redis从Redis查询组内所有channel，对每个channel: LPUSH + PUBLISH，把消息推送到对应通道的消息队列中，并通知所有daphne实例来消息了
-            # 在Django Channels中，当 group_send 发送的事件中的 type 字段被框架接收后，它会在调用消费者实例的方法前，**自动将类型字符串中的点 . 替换为下划线 _**
-            self.room_group_name, {"type": "chat.message", "message": self.message_data}
-        )
-        print(f"Consumer.receive group_send调用完成")
-        # await self.send(text_data=json.dumps({"message": message}))
+    async def send_history(self, before):
+        @sync_to_async
+        def load_page(chatroom_id, before):
+            messages, next_cursor = fetch_page(chatroom_id, before)
+            return [serialize_message(message) for message in messages], next_cursor
 
+        try:
+            messages, next_cursor = await load_page(self.chatroom.id, before)
+        except ValueError:
+            await self.send(text_data=json.dumps({"type": "history", "error": "游标格式错误"}))
+            return
+        await self.send(text_data=json.dumps({"type": "history", "messages": messages, "next_cursor": next_cursor}))
 
     # 当daphne实例监听到消息时，确认是否是自己处理的通道，如果是，从redis消息队列中取出消息，触发该函数将消息“发送”到用户浏览器
     async def chat_message(self, event): # 组发送时间的处理函数
-        print(f"Consumer.chat_message 收到广播事件: {event}")
         message = event["message"]
+        self.last_seen_at = max(self.last_seen_at, datetime.fromisoformat(event["sent_at"]))
         # 实质上这里的消费者的send方法只是给daphne服务器发送了格式化后的数据和send command，实际发送消息的任务是由daphne服务器完成的
         await self.send(text_data=json.dumps({"message": message}))
-        print(f"Consumer.chat_message WebSocket发送: '{message}'")
\ No newline at end of file
+
+class DeviceBoardConsumer(tracing.TracedConsumerMixin, AsyncWebsocketConsumer):
+    """实时状态看板：连接时下发一次快照，之后只下发合并后的增量（详见chat/board.py）"""
+
+    async def connect(self):
+        if not self.scope["user"].is_authenticated:
+            await self.close()
+            return
+        await self.accept()
+        self.board = get_board()
+        counts = await self.board.join(self)
+        await self.send(text_data=json.dumps({"type": "snapshot", "counts": counts}, ensure_ascii=False))
+
+    async def disconnect(self, close_code):
+        if getattr(self, "board", None) is not None:
+            await self.board.leave(self)
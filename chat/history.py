@@ -0,0 +1,74 @@
+# chat/history.py
+from datetime import datetime
+
+from django.db.models import Q
+from django.utils import timezone
+
+from chat.models import Message
+
+"""
+    聊天记录分页
+    聊天室页面只渲染最新的 PAGE_SIZE 条消息，更早的记录按游标向前翻页：
+        游标 = 当前已加载的最早一条消息的 (created_at, id)，下一页取严格早于它的消息，
+        走Message上 (chatroom, created_at, id) 的组合索引，翻到多早都不需要OFFSET
+    HTTP接口（ChatHistoryView）和WebSocket的"load older"请求（ChatConsumer）共用这里的实现
+"""
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# 与ChatConsumer广播消息时的时间格式保持一致
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def serialize_message(message):
+    return {
+        "id": message.id,
+        "uid": str(message.uid) if message.uid else None,
+        "content": message.content,
+        "owner": message.owner.username,
+        "created_at": timezone.localtime(message.created_at).strftime(TIME_FORMAT),
+    }
+
+
+def encode_cursor(message):
+    return f"{message.created_at.isoformat()},{message.id}"
+
+
+def decode_cursor(cursor):
+    """解析游标，格式不对（包括不是字符串，例如WebSocket帧里的 "before": 1）时抛出ValueError"""
+    if not isinstance(cursor, str):
+        raise ValueError(f'游标必须是字符串:{cursor!r}')
+    created_at, _, message_id = cursor.rpartition(',')
+    return datetime.fromisoformat(created_at), int(message_id)
+
+
+def page_queryset(chatroom_id, before=None, limit=PAGE_SIZE):
+    """fetch_page/afetch_page的查询：多取一条判断是否还有更早的消息，返回 (queryset, limit)"""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    queryset = Message.objects.filter(chatroom_id=chatroom_id).select_related('owner')
+    if before is not None:
+        created_at, message_id = decode_cursor(before)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id))
+    return queryset.order_by('-created_at', '-id')[:limit + 1], limit
+
+
+def split_page(rows, limit):
+    has_older = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, (encode_cursor(rows[0]) if has_older else None)
+
+
+def fetch_page(chatroom_id, before=None, limit=PAGE_SIZE):
+    """
+    取chatroom中早于游标before的最多limit条消息（before为None时取最新的），一条SQL，owner用select_related带出
+    返回 (按时间正序的消息列表, 继续向前翻页的游标 或 None)
+    """
+    queryset, limit = page_queryset(chatroom_id, before, limit)
+    return split_page(list(queryset), limit)
+
+
+async def afetch_page(chatroom_id, before=None, limit=PAGE_SIZE):
+    """fetch_page的异步版本（AsyncChatroomView使用）"""
+    queryset, limit = page_queryset(chatroom_id, before, limit)
+    return split_page([message async for message in queryset.aiterator()], limit)
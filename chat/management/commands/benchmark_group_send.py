@@ -0,0 +1,100 @@
+# 该django管理命令用于压测通道层group_send的扇出吞吐（通道层配置见abnormal_device_tracking/channel_layers.py），
+# 默认分别测10/100/1000人的聊天室，用压测数据确定通道层后端和Daphne进程数
+import asyncio
+import os
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from abnormal_device_tracking.channel_layers import BACKENDS, build_channel_layers
+
+GROUP_PREFIX = 'bench'
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Command(BaseCommand):
+    help = "benchmark channel layer group_send fan-out"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', choices=BACKENDS,
+                            help='通道层后端，默认使用settings.CHANNEL_LAYERS；memory为本地替身，不需要Redis')
+        parser.add_argument('--sizes', default='10,100,1000', help='聊天室人数，逗号分隔')
+        parser.add_argument('--messages', type=int, default=100, help='每个聊天室group_send的消息数')
+        parser.add_argument('--payload-bytes', type=int, default=200, help='每条消息的内容大小（字节）')
+        parser.add_argument('--timeout', type=float, default=30.0, help='等待全部接收完成的超时时间（秒）')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        except ValueError:
+            raise CommandError('--sizes 格式错误，例如 10,100,1000')
+        if options['backend']:
+            config = build_channel_layers(dict(os.environ, CHANNEL_LAYER_BACKEND=options['backend']))['default']
+        else:
+            config = settings.CHANNEL_LAYERS['default']
+        self.stdout.write(self.style.NOTICE(f"===== 通道层:{config['BACKEND']}, 每个聊天室{options['messages']}条消息 ====="))
+        asyncio.run(self.benchmark(config, sizes, options))
+
+    async def benchmark(self, config, sizes, options):
+        results = []
+        for size in sizes:
+            # 每种人数一个新的通道层实例，互不影响
+            layer = import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+            try:
+                result = await self.run_room(layer, size, options)
+            finally:
+                if hasattr(layer, 'flush'):
+                    await layer.flush()
+            results.append(result)
+            self.stdout.write(
+                f"人数:{size:>5}  group_send:{result['send_rate']:>9.1f}次/秒  "
+                f"送达:{result['delivery_rate']:>10.1f}条/秒 ({result['delivered']}/{result['expected']})  "
+                f"延迟p50:{result['p50'] * 1000:7.2f}ms  p99:{result['p99'] * 1000:7.2f}ms"
+            )
+        return results
+
+    async def run_room(self, layer, size, options):
+        group = f'{GROUP_PREFIX}.{size}.{time.monotonic_ns()}'
+        messages = options['messages']
+        channels = [await layer.new_channel() for _ in range(size)]
+        # 和ChatConsumer.connect一样，每个连接一个group_add
+        await asyncio.gather(*(layer.group_add(group, channel) for channel in channels))
+        latencies = []
+
+        async def receiver(channel):
+            for _ in range(messages):
+                message = await layer.receive(channel)
+                latencies.append(time.perf_counter() - message['sent'])
+
+        receivers = [asyncio.ensure_future(receiver(channel)) for channel in channels]
+        await asyncio.sleep(0)  # 让接收方先开始等待，pubsub后端需要先订阅
+        padding = 'x' * options['payload_bytes']
+        start = time.perf_counter()
+        for _ in range(messages):
+            await layer.group_send(group, {'type': 'chat.message', 'sent': time.perf_counter(), 'message': padding})
+        send_elapsed = time.perf_counter() - start
+        # 超出capacity或过期的消息会被丢弃，超时后按实际送达数统计
+        await asyncio.wait(receivers, timeout=options['timeout'])
+        elapsed = time.perf_counter() - start
+        for task in receivers:
+            task.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+        await asyncio.gather(*(layer.group_discard(group, channel) for channel in channels))
+
+        expected = size * messages
+        return {
+            'size': size,
+            'expected': expected,
+            'delivered': len(latencies),
+            'send_rate': messages / send_elapsed if send_elapsed else 0.0,
+            'delivery_rate': len(latencies) / elapsed if elapsed else 0.0,
+            'p50': statistics.median(latencies) if latencies else 0.0,
+            'p99': percentile(latencies, 0.99) if latencies else 0.0,
+        }
@@ -0,0 +1,81 @@
+# 该django管理命令用于压测聊天记录全文检索（chat/search.py），默认构造100万条消息
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+
+from accounts.models import Employee
+from chat.models import Chatroom, Message
+from chat.search import search_messages
+
+# 压测用的聊天室名和用户名，--cleanup时删除（消息随聊天室级联删除）
+BENCH_NAME = 'bench_chat_search'
+PHRASES = ['屏幕闪烁', 'WiFi吞吐量偏低', '摄像头对焦失败', '电池电压异常', 'USB枚举失败', '复测通过', '已转交ME分析']
+
+
+class Command(BaseCommand):
+    help = "benchmark chat message full-text search"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1_000_000, help='压测消息数量（默认100万）')
+        parser.add_argument('--batch-size', type=int, default=10_000, help='每批写入的消息数量')
+        parser.add_argument('--repeat', type=int, default=5, help='每个关键词重复搜索次数，取平均')
+        parser.add_argument('--skip-load', action='store_true', help='不写入数据，直接对已有数据压测')
+        parser.add_argument('--cleanup', action='store_true', help='压测结束后删除压测数据')
+
+    def handle(self, *args, **options):
+        user, chatroom = self.bench_room()
+        if not options['skip_load']:
+            self.load(chatroom, user, options['count'], options['batch_size'])
+
+        keywords = ['闪烁', '摄像头对焦', 'wifi', 'SN000123', '不存在的关键词']
+        self.stdout.write(self.style.NOTICE(
+            f"===== 数据库:{connection.vendor}, 消息数:{Message.objects.filter(chatroom=chatroom).count()} ====="
+        ))
+        for keyword in keywords:
+            elapsed = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                rows, _ = search_messages(user, keyword)  # 和ChatSearchView一样：第一页50条
+                elapsed.append(time.perf_counter() - start)
+            self.stdout.write(
+                f"关键词:{keyword:<12} 第一页:{len(rows):>3}条  平均:{sum(elapsed) / len(elapsed) * 1000:8.2f}ms  "
+                f"最慢:{max(elapsed) * 1000:8.2f}ms"
+            )
+
+        if options['cleanup']:
+            chatroom.delete()
+            user.delete()
+            self.stdout.write(self.style.SUCCESS('Successfully delete benchmark chatroom'))
+
+    def bench_room(self):
+        user, _ = Employee.objects.get_or_create(
+            username=BENCH_NAME, defaults={'email': f'{BENCH_NAME}@example.com', 'number': 'BENCHCHAT'}
+        )
+        chatroom = Chatroom.objects.filter(name=BENCH_NAME).first()
+        if chatroom is None:
+            # 压测聊天室不挂在具体的流程/Bug上，name手动指定
+            chatroom = Chatroom.objects.create(
+                name=BENCH_NAME, content_type=ContentType.objects.get_for_model(Employee), object_id=user.pk
+            )
+        chatroom.members.add(user)
+        return user, chatroom
+
+    def load(self, chatroom, user, count, batch_size):
+        existing = Message.objects.filter(chatroom=chatroom).count()
+        self.stdout.write(self.style.NOTICE(f"===== 写入压测消息，已有{existing}条，目标{count}条 ====="))
+        for start in range(existing, count, batch_size):
+            batch = []
+            for i in range(start, min(start + batch_size, count)):
+                message = Message(
+                    chatroom=chatroom, owner=user,
+                    content=f'SN{i:06d} {PHRASES[i % len(PHRASES)]}，请{PHRASES[(i // 7) % len(PHRASES)]}后再确认',
+                )
+                message.index_content()  # bulk_create不会调用save()
+                batch.append(message)
+            with transaction.atomic():
+                Message.objects.bulk_create(batch, batch_size=batch_size)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE chat_message;')
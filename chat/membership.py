@@ -0,0 +1,86 @@
+# chat/membership.py
+from django.core.cache import cache
+
+from chat.models import Chatroom
+
+"""
+    WebSocket连接时的聊天室/成员缓存
+    原来ChatConsumer.connect每次连接：按name查聊天室 + 按id再查一次 + 加载全部成员判断是否已加入 + members.add + chatroom.save()（还会刷新last_activity），
+    Daphne重启后所有客户端同时重连，这些查询会一起打到数据库上。
+    现在：
+        1、聊天室name→id 缓存在Django的cache框架中，未命中时一条SQL（只取id）
+        2、每个聊天室的成员id集合缓存在cache中，已是成员时不查库
+        3、不是成员时直接往through表插入一行（ignore_conflicts，重复插入无副作用），不调用save()
+    失效：聊天室删除、成员变更时由信号清除（信号在ChatConfig.ready()中注册）
+"""
+
+ROOM_KEY_PREFIX = 'chat:room'
+MEMBERS_KEY_PREFIX = 'chat:members'
+# 过期只是兜底，正常依赖信号失效
+CACHE_TIMEOUT = 60 * 60
+
+
+def _room_key(name):
+    return f'{ROOM_KEY_PREFIX}:{name}'
+
+
+def _members_key(chatroom_id):
+    return f'{MEMBERS_KEY_PREFIX}:{chatroom_id}'
+
+
+def get_chatroom_id(name):
+    """按name获取聊天室id，不存在时返回None"""
+    key = _room_key(name)
+    chatroom_id = cache.get(key)
+    if chatroom_id is None:
+        chatroom_id = Chatroom.objects.filter(name=name).values_list('id', flat=True).first()
+        if chatroom_id is not None:
+            cache.set(key, chatroom_id, CACHE_TIMEOUT)
+    return chatroom_id
+
+
+def get_member_ids(chatroom_id):
+    key = _members_key(chatroom_id)
+    member_ids = cache.get(key)
+    if member_ids is None:
+        member_ids = frozenset(
+            Chatroom.members.through.objects.filter(chatroom_id=chatroom_id).values_list('employee_id', flat=True)
+        )
+        cache.set(key, member_ids, CACHE_TIMEOUT)
+    return member_ids
+
+
+def ensure_member(chatroom_id, user_id):
+    """把用户加入聊天室（幂等），已是成员时返回False，否则插入through表并返回True"""
+    if user_id in get_member_ids(chatroom_id):
+        return False
+    # 并发重连时多个连接可能同时走到这里，ignore_conflicts让重复插入直接被数据库忽略
+    Chatroom.members.through.objects.bulk_create(
+        [Chatroom.members.through(chatroom_id=chatroom_id, employee_id=user_id)], ignore_conflicts=True
+    )
+    # bulk_create不会发m2m_changed信号，手动更新缓存
+    cache.set(_members_key(chatroom_id), get_member_ids(chatroom_id) | {user_id}, CACHE_TIMEOUT)
+    return True
+
+
+def invalidate_members(*chatroom_ids):
+    keys = [_members_key(pk) for pk in chatroom_ids]
+    if keys:
+        cache.delete_many(keys)
+
+
+# ===== 信号接收器（在ChatConfig.ready()中注册） =====
+def chatroom_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear', 'pre_clear'):
+        return
+    if not reverse:  # chatroom.members.add(...)，instance是聊天室
+        invalidate_members(instance.pk)
+    elif pk_set:  # employee.chatrooms.add(...)，instance是员工，pk_set是聊天室
+        invalidate_members(*pk_set)
+    else:  # employee.chatrooms.clear()，先在pre_clear时清除该员工所在的聊天室
+        invalidate_members(*instance.chatrooms.values_list('id', flat=True))
+
+
+def chatroom_deleted(sender, instance, **kwargs):
+    cache.delete(_room_key(instance.name))
+    invalidate_members(instance.pk)
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.5 on 2026-10-17 17:58
+
+import re
+
+from django.db import migrations, models
+
+BACKFILL_BATCH_SIZE = 2000
+# 与chat/search.py的切词规则相同，在迁移中固化一份（不导入应用代码，以后那边改动不影响重放迁移）
+TOKEN_RE = re.compile(r'[0-9a-z]+|[\u3400-\u4dbf\u4e00-\u9fff]+')
+# 表达式与SearchVector('search_tokens', config='simple')生成的SQL一致，查询才能用上索引
+SEARCH_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS chat_message_search_gin_idx ON chat_message "
+    "USING gin (to_tsvector('simple'::regconfig, COALESCE((search_tokens)::text, '')));"
+)
+
+
+def tokenize(text):
+    tokens = []
+    for run in TOKEN_RE.findall(text.lower()):
+        if run.isascii():
+            tokens.append(run)
+        else:
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens = list(dict.fromkeys(tokens))
+    return f' {" ".join(tokens)} ' if tokens else ''
+
+
+def backfill_search_tokens(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    last_id = 0
+    while True:
+        batch = list(Message.objects.filter(id__gt=last_id).order_by('id').only('id', 'content')[:BACKFILL_BATCH_SIZE])
+        if not batch:
+            break
+        for message in batch:
+            message.search_tokens = tokenize(message.content)
+        Message.objects.bulk_update(batch, ['search_tokens'])
+        last_id = batch[-1].id
+
+
+def create_search_index(apps, schema_editor):
+    # GIN索引只在PostgreSQL上创建，其他数据库（本地测试用的SQLite）检索时退回LIKE匹配
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(SEARCH_INDEX_SQL)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS chat_message_search_gin_idx;')
+
+
+class Migration(migrations.Migration):
+    '''
+        聊天记录全文检索（chat/search.py）：search_tokens字段、历史消息回填、PostgreSQL GIN索引
+    '''
+
+    dependencies = [
+        ('chat', '0005_readstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='search_tokens',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(backfill_search_tokens, migrations.RunPython.noop),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
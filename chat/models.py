@@ -5,6 +5,7 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
 
 from accounts.models import Employee
 
@@ -52,7 +53,6 @@ class Chatroom(models.Model):
     def _generate_name(self):
         """生成友好的显示名称"""
         obj = self.content_object
-        print("self.content_type.model:",self.content_type.model)
         if self.content_type.model == 'deviceprocess': # ContentType模型有两个字段：app_label和model
             self.name = f"process_{obj.device.sn}" # process_sn
         elif self.content_type.model == 'bug':
@@ -79,7 +79,46 @@ class Message(models.Model):
     chatroom = models.ForeignKey(Chatroom, on_delete=models.CASCADE)
     owner = models.ForeignKey(Employee, on_delete=models.CASCADE)
     content = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # 消息由ChatConsumer先广播、后批量写库（chat/pipeline.py），广播时还没有数据库id，用服务端生成的uid标识消息
+    uid = models.UUIDField(unique=True, null=True, blank=True, editable=False)
+    # 时间取服务端收到消息的时间，而不是批量写库的时间，保证广播出去的时间和库里一致
+    created_at = models.DateTimeField(default=timezone.now)
+    # 全文检索用的切词结果（中文单字+双字n-gram，英文整词），由index_content()根据content生成，见chat/search.py
+    search_tokens = models.TextField(blank=True, default='', editable=False)
+
+    class Meta:
+        indexes = [
+            # 聊天记录按 (created_at, id) 游标分页（chat/history.py）：chatroom等值过滤 + 时间倒序
+            models.Index(fields=['chatroom', '-created_at', '-id'], name='message_room_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.owner.username}:{self.content}"
+
+    def index_content(self):
+        from chat.search import tokenize  # chat.search导入了本模块，延迟导入避免循环
+        self.search_tokens = tokenize(self.content)
+
+    def save(self, *args, **kwargs):
+        # bulk_create不会调用save()，批量写入前需要自己调用index_content()（chat/pipeline.py）
+        self.index_content()
+        super().save(*args, **kwargs)
+
+
+class ReadState(models.Model):
+    """
+    成员在聊天室中的已读位置，由chat/presence.py定期批量写入（不是每次已读都写库）
+    消息先广播后写库，广播时还没有数据库id，所以已读位置记录的是最后一条已读消息的created_at
+    """
+    chatroom = models.ForeignKey(Chatroom, on_delete=models.CASCADE, related_name='read_states')
+    employee = models.ForeignKey(Employee, on_delete=models.CASCADE, related_name='chat_read_states')
+    last_read_at = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chatroom', 'employee'], name='chat_readstate_room_employee_uniq'),
+        ]
 
     def __str__(self):
-        return f"{self.owner.username}:{self.content}"
\ No newline at end of file
+        return f"{self.employee_id}@{self.chatroom_id}:{self.last_read_at}"
@@ -0,0 +1,136 @@
+# chat/pipeline.py
+import asyncio
+import atexit
+import logging
+import weakref
+from collections import deque
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from chat.models import Message
+
+"""
+    聊天消息的写后（write-behind）管道
+    原来ChatConsumer.receive每条消息都要 sync_to_async 切线程 + 一次INSERT，提交后才广播。
+    现在：
+        1、receive收到消息后在内存里构造Message（服务端生成uid和created_at），立即广播，不等数据库
+        2、消息交给本进程（本事件循环）的MessageWriter，攒够 BATCH_SIZE 条或等待 FLUSH_INTERVAL 秒后一次bulk_create写库
+        3、每条消息对应一个Future，写库成功/失败都会通知到发送者的consumer，失败时consumer把错误回给发送者
+    持久性保证：
+        - 连接断开时consumer会等本连接所有未落库的消息写完
+        - 进程退出时atexit把还没写的消息同步写入数据库
+"""
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = getattr(settings, 'CHAT_WRITE_BATCH_SIZE', 100)
+FLUSH_INTERVAL = getattr(settings, 'CHAT_WRITE_FLUSH_INTERVAL', 0.005)  # 秒
+
+
+def write_messages(messages):
+    """
+    一次bulk_create写入整批消息，返回与messages一一对应的异常列表（None表示成功）
+    整批失败时（比如其中一条的聊天室已被删除）逐条重试，只让有问题的消息失败
+    """
+    for message in messages:
+        message.index_content()
+    try:
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+        return [None] * len(messages)
+    except DatabaseError:
+        logger.exception("聊天消息批量写入失败，逐条重试 | 条数:%d", len(messages))
+    errors = []
+    for message in messages:
+        try:
+            with transaction.atomic():
+                message.save(force_insert=True)
+            errors.append(None)
+        except DatabaseError as e:
+            errors.append(e)
+    return errors
+
+
+class MessageWriter:
+    """一个事件循环一个实例，通过get_writer()获取"""
+
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = deque()  # (Message, Future)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def submit(self, message):
+        """加入待写队列，返回Future（写库成功时结果为message，失败时为异常）"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((message, future))
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+        # 刷写任务在队列清空后自动结束，有新消息时再启动，空闲时不占用事件循环
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return future
+
+    async def flush(self):
+        """立即写入当前队列中的全部消息"""
+        self._wakeup.set()
+        if self._task is not None and not self._task.done():
+            await asyncio.shield(self._task)
+
+    async def _run(self):
+        while self.pending:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self.pending:
+                await self._write_batch()
+                if len(self.pending) < self.batch_size:
+                    break
+
+    async def _write_batch(self):
+        batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+        try:
+            errors = await database_sync_to_async(write_messages)([message for message, _ in batch])
+        except Exception as e:  # 数据库不可用等，整批失败
+            errors = [e] * len(batch)
+        for (message, future), error in zip(batch, errors):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(message)
+            else:
+                future.set_exception(error)
+
+    def drain_sync(self):
+        """进程退出时调用（事件循环已停止），同步写入剩余消息"""
+        if not self.pending:
+            return
+        messages = [message for message, _ in self.pending]
+        self.pending.clear()
+        try:
+            errors = write_messages(messages)
+            logger.info("进程退出，补写聊天消息 %d 条，失败 %d 条", len(messages), sum(e is not None for e in errors))
+        except Exception:
+            logger.exception("进程退出时补写聊天消息失败 | 条数:%d", len(messages))
+
+
+# 事件循环 → MessageWriter；Daphne一个进程一个事件循环，测试中async_to_sync每次会新建事件循环
+_writers = weakref.WeakKeyDictionary()
+
+
+def get_writer():
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = _writers[loop] = MessageWriter()
+    return writer
+
+
+@atexit.register
+def _drain_all():
+    for writer in list(_writers.values()):
+        writer.drain_sync()
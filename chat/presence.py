@@ -0,0 +1,257 @@
+# chat/presence.py
+import asyncio
+import atexit
+import logging
+import time
+import weakref
+from collections import Counter, defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, Count, DateTimeField, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from chat.models import Chatroom, ReadState
+
+"""
+    聊天室在线状态、正在输入、已读位置
+    全部放在缓存（带TTL）和进程内存中，不随每个事件写库：
+        1、在线：每个(聊天室, 用户)一个缓存key，值为用户名，TTL为ONLINE_TTL，本进程的PresenceHub定期续期；
+           查询某个聊天室谁在线 = 对成员集合（chat/membership.py已缓存）做一次get_many
+        2、正在输入：不存储，只随广播下发，客户端在TYPING_TTL秒后自动清除，持续输入时客户端定期重发
+        3、已读位置：先记在PresenceHub内存里，每个用户的最新位置同步到缓存（未读数要用），每PERSIST_INTERVAL秒批量写入ReadState表
+    广播合并：一个事件循环一个PresenceHub，收集本进程所有连接的上线/下线/输入/已读事件，
+    每BROADCAST_INTERVAL秒每个有变化的聊天室只group_send一次，观察者再多，Redis流量也只和聊天室数量有关
+"""
+logger = logging.getLogger(__name__)
+
+ONLINE_TTL = getattr(settings, 'CHAT_PRESENCE_ONLINE_TTL', 60)  # 秒，进程崩溃后在线状态最多保留这么久
+TYPING_TTL = getattr(settings, 'CHAT_PRESENCE_TYPING_TTL', 5)  # 秒
+BROADCAST_INTERVAL = getattr(settings, 'CHAT_PRESENCE_BROADCAST_INTERVAL', 1.0)  # 秒
+PERSIST_INTERVAL = getattr(settings, 'CHAT_PRESENCE_PERSIST_INTERVAL', 30.0)  # 秒
+
+ONLINE_KEY_PREFIX = 'chat:online'
+READ_KEY_PREFIX = 'chat:read'
+# 缓存中的已读位置要比写库周期活得久，过期后以ReadState表为准
+READ_CACHE_TIMEOUT = 60 * 60
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def _online_key(chatroom_id, user_id):
+    return f'{ONLINE_KEY_PREFIX}:{chatroom_id}:{user_id}'
+
+
+def _read_key(user_id):
+    return f'{READ_KEY_PREFIX}:{user_id}'
+
+
+def online_users(chatroom_id, member_ids):
+    """聊天室中在线的成员 {用户id: 用户名}，一次缓存get_many"""
+    keys = {_online_key(chatroom_id, user_id): user_id for user_id in member_ids}
+    return {keys[key]: username for key, username in cache.get_many(keys).items()}
+
+
+def persist_reads(reads):
+    """
+    批量写入已读位置 reads: {(chatroom_id, user_id): last_read_at}
+    先查一次库里已有的位置，只往前推进（同一用户在多个进程中都有连接时，避免旧位置覆盖新位置），再一次upsert
+    """
+    if not reads:
+        return
+    existing = ReadState.objects.filter(
+        chatroom_id__in={room for room, _ in reads}, employee_id__in={user for _, user in reads}
+    ).values_list('chatroom_id', 'employee_id', 'last_read_at')
+    reads = dict(reads)
+    for room, user, last_read_at in existing:
+        if (room, user) in reads and reads[(room, user)] <= last_read_at:
+            del reads[(room, user)]
+    ReadState.objects.bulk_create(
+        [ReadState(chatroom_id=room, employee_id=user, last_read_at=at) for (room, user), at in reads.items()],
+        update_conflicts=True, unique_fields=['chatroom', 'employee'], update_fields=['last_read_at', 'updated_at'],
+    )
+
+
+def unread_counts(user):
+    """
+    用户所在各聊天室的未读消息数 {聊天室id: 未读数}（自己发的消息不算未读）
+    一条聚合SQL：已读位置取ReadState表和缓存中较新的一个（缓存里是还没写库的最新位置）
+    """
+    last_read = Coalesce(
+        Subquery(ReadState.objects.filter(chatroom=OuterRef('pk'), employee=user).values('last_read_at')[:1]),
+        Value(EPOCH), output_field=DateTimeField(),
+    )
+    cached = cache.get(_read_key(user.pk)) or {}
+    if cached:
+        last_read = Greatest(last_read, Case(
+            *(When(pk=room, then=Value(at)) for room, at in cached.items()),
+            default=Value(EPOCH), output_field=DateTimeField(),
+        ))
+    rows = (
+        Chatroom.objects.filter(members=user)
+        .annotate(last_read=last_read)
+        .annotate(unread=Count('message', filter=Q(message__created_at__gt=F('last_read')) & ~Q(message__owner=user)))
+        .values_list('id', 'unread')
+    )
+    return dict(rows)
+
+
+class PresenceHub:
+    """一个事件循环一个实例，通过get_hub()获取"""
+
+    def __init__(self, broadcast_interval=BROADCAST_INTERVAL, persist_interval=PERSIST_INTERVAL):
+        self.broadcast_interval = broadcast_interval
+        self.persist_interval = persist_interval
+        self.connections = Counter()  # (聊天室id, 用户id) → 本进程的连接数
+        self.usernames = {}  # 用户id → 用户名
+        self.groups = {}  # 聊天室id → 群组名
+        self.changes = defaultdict(lambda: {'online': {}, 'offline': set(), 'typing': {}, 'read': {}})
+        self.unpersisted = {}  # (聊天室id, 用户id) → 还没写库的已读位置
+        # 聊天室id → (读取时间, 读取在线成员的Task)：重连风暴时同一聊天室的连接共用一次get_many的结果，
+        # 再叠加本进程的连接，之后的上线/下线由广播补齐
+        self.snapshots = {}
+        self.local_online = defaultdict(dict)  # 聊天室id → {用户id: 用户名}，本进程的在线成员
+        self._last_refresh = self._last_persist = time.monotonic()
+        self._task = None
+
+    async def join(self, chatroom_id, group, user, member_ids):
+        """连接加入聊天室，返回当前在线成员 {用户id: 用户名}"""
+        self.groups[chatroom_id] = group
+        self.usernames[user.pk] = user.username
+        self.connections[(chatroom_id, user.pk)] += 1
+        if self.connections[(chatroom_id, user.pk)] == 1:
+            self.local_online[chatroom_id][user.pk] = user.username
+            changes = self.changes[chatroom_id]
+            changes['offline'].discard(user.pk)
+            changes['online'][user.pk] = user.username
+            self._ensure_task()
+            # Django的aget_many/aset_many是逐个key切线程，这里都用sync_to_async包装同步的批量方法
+            await sync_to_async(cache.set)(_online_key(chatroom_id, user.pk), user.username, ONLINE_TTL)
+        snapshot = self.snapshots.get(chatroom_id)
+        if snapshot is None or time.monotonic() - snapshot[0] > self.broadcast_interval:
+            task = asyncio.ensure_future(sync_to_async(online_users)(chatroom_id, member_ids))
+            snapshot = self.snapshots[chatroom_id] = (time.monotonic(), task)
+        online = dict(await asyncio.shield(snapshot[1]))
+        online.update(self.local_online[chatroom_id])
+        return online
+
+    async def leave(self, chatroom_id, user):
+        key = (chatroom_id, user.pk)
+        self.connections[key] -= 1
+        if self.connections[key] > 0:
+            return
+        del self.connections[key]
+        self.local_online[chatroom_id].pop(user.pk, None)
+        # 同一用户在其他进程还有连接时，下次续期会重新标记在线
+        await sync_to_async(cache.delete)(_online_key(chatroom_id, user.pk))
+        changes = self.changes[chatroom_id]
+        changes['online'].pop(user.pk, None)
+        changes['typing'].pop(user.pk, None)
+        changes['offline'].add(user.pk)
+        self._ensure_task()
+
+    def typing(self, chatroom_id, user):
+        self.changes[chatroom_id]['typing'][user.pk] = user.username
+        self._ensure_task()
+
+    def read(self, chatroom_id, user, last_read_at):
+        key = (chatroom_id, user.pk)
+        if key in self.unpersisted and self.unpersisted[key] >= last_read_at:
+            return
+        self.unpersisted[key] = last_read_at
+        self.changes[chatroom_id]['read'][user.pk] = last_read_at
+        self._ensure_task()
+
+    def _ensure_task(self):
+        # 后台任务在本进程没有连接、也没有待处理的变化后自动结束
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while self.connections or self.changes or self.unpersisted:
+            await asyncio.sleep(self.broadcast_interval)
+            try:
+                await self.flush(force_persist=not self.connections)
+            except Exception:
+                logger.exception("聊天在线状态刷新失败")
+
+    async def flush(self, force_persist=False):
+        """广播合并后的变化，按周期续期在线状态、写入已读位置"""
+        changes, self.changes = self.changes, defaultdict(self.changes.default_factory)
+        reads = defaultdict(dict)  # 用户id → {聊天室id: 已读位置}
+        channel_layer = get_channel_layer()
+        for chatroom_id, change in changes.items():
+            for user_id, last_read_at in change['read'].items():
+                reads[user_id][chatroom_id] = last_read_at
+            await channel_layer.group_send(self.groups[chatroom_id], {
+                "type": "presence.update",
+                "presence": {
+                    "online": {str(k): v for k, v in change['online'].items()},
+                    "offline": [str(k) for k in change['offline']],
+                    "typing": {str(k): v for k, v in change['typing'].items()},
+                    "typing_ttl": TYPING_TTL,
+                    "read": {str(k): v.isoformat() for k, v in change['read'].items()},
+                },
+            })
+        if reads:
+            await self._cache_reads(reads)
+
+        now = time.monotonic()
+        if self.connections and now - self._last_refresh >= ONLINE_TTL / 3:
+            self._last_refresh = now
+            await sync_to_async(cache.set_many)({
+                _online_key(room, user): self.usernames[user] for room, user in self.connections
+            }, ONLINE_TTL)
+        if self.unpersisted and (force_persist or now - self._last_persist >= self.persist_interval):
+            self._last_persist = now
+            unpersisted, self.unpersisted = self.unpersisted, {}
+            try:
+                await database_sync_to_async(persist_reads)(unpersisted)
+            except Exception:
+                logger.exception("已读位置写库失败，下次重试 | 条数:%d", len(unpersisted))
+                for key, at in unpersisted.items():
+                    self.unpersisted.setdefault(key, at)
+
+    @staticmethod
+    async def _cache_reads(reads):
+        keys = {_read_key(user_id): user_id for user_id in reads}
+        cached = await sync_to_async(cache.get_many)(keys)
+        updated = {}
+        for key, user_id in keys.items():
+            positions = dict(cached.get(key) or {})
+            for room, at in reads[user_id].items():
+                if room not in positions or positions[room] < at:
+                    positions[room] = at
+            updated[key] = positions
+        await sync_to_async(cache.set_many)(updated, READ_CACHE_TIMEOUT)
+
+    def drain_sync(self):
+        """进程退出时调用（事件循环已停止），同步写入还没写库的已读位置"""
+        if not self.unpersisted:
+            return
+        try:
+            persist_reads(self.unpersisted)
+            self.unpersisted = {}
+        except Exception:
+            logger.exception("进程退出时写入已读位置失败 | 条数:%d", len(self.unpersisted))
+
+
+# 事件循环 → PresenceHub，和chat/pipeline.py的MessageWriter一样按事件循环区分
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_hub():
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = PresenceHub()
+    return hub
+
+
+@atexit.register
+def _drain_all():
+    for hub in list(_hubs.values()):
+        hub.drain_sync()
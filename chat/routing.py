@@ -1,6 +1,6 @@
 from django.urls import re_path
 
-from chat.consumers import ChatConsumer
+from chat.consumers import ChatConsumer, DeviceBoardConsumer
 
 '''
     routing.py（Channels 的路由文件）和 Django 的urls.py逻辑高度相似，核心都是 “路径匹配 → 绑定处理逻辑”，核心区别是：
@@ -10,4 +10,5 @@ from chat.consumers import ChatConsumer
 
 websocket_urlpatterns = [
     re_path(r"ws/chat/(?P<name>\w+)/$", ChatConsumer.as_asgi()), # as_asgi将 Consumer 类转换为符合 ASGI 规范的应用实例
+    re_path(r"ws/board/$", DeviceBoardConsumer.as_asgi()),  # 实时状态看板
 ]
\ No newline at end of file
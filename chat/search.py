@@ -0,0 +1,115 @@
+# chat/search.py
+import re
+from datetime import datetime, time, timedelta
+
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from chat.history import MAX_PAGE_SIZE, PAGE_SIZE, decode_cursor, encode_cursor
+from chat.models import Chatroom, Message
+
+"""
+    聊天记录全文检索
+    PostgreSQL默认的分词器不会切分中文（一整句中文是一个词），这里在写入时自己切词，存到Message.search_tokens：
+        中文：单字 + 相邻两字（字符n-gram），"屏幕闪烁" → 屏 幕 闪 烁 屏幕 幕闪 闪烁
+        英文/数字：整词小写，"X2301 WiFi" → x2301 wifi
+    PostgreSQL上对 to_tsvector('simple', search_tokens) 建GIN索引（迁移0006），查询时把关键词按同样的规则切成词，
+    全部命中（AND）的消息才返回，英文词按前缀匹配；中文词再用icontains校验一遍连续出现，排除"两字都出现但不相邻"的结果。
+    其他数据库（本地测试用的SQLite）退回到对search_tokens的LIKE匹配，结果相同，只是没有索引。
+    结果按 (created_at, id) 倒序，用与chat/history.py相同的游标分页。
+"""
+
+# 中文（含扩展A区）连续片段、英文数字连续片段，其他字符（标点、空白、表情）都是分隔符
+TOKEN_RE = re.compile(r'[0-9a-z]+|[\u3400-\u4dbf\u4e00-\u9fff]+')
+# 聊天室类型 → ContentType.model
+CONTENT_TYPES = {'process': 'deviceprocess', 'bug': 'bug'}
+
+
+def _runs(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def tokenize(text):
+    """切词结果，空格分隔，首尾带空格（LIKE匹配时用 ' 词 ' 做完整词匹配）"""
+    tokens = []
+    for run in _runs(text):
+        if run.isascii():
+            tokens.append(run)
+        else:
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens = list(dict.fromkeys(tokens))  # 去重，保持顺序
+    return f' {" ".join(tokens)} ' if tokens else ''
+
+
+def query_terms(keyword):
+    """关键词 → ([(词, 是否前缀匹配)], 需要连续出现的中文片段)"""
+    terms, phrases = [], []
+    for run in _runs(keyword):
+        if run.isascii():
+            terms.append((run, True))
+        elif len(run) == 1:
+            terms.append((run, False))
+        else:
+            terms.extend((run[i:i + 2], False) for i in range(len(run) - 1))
+            if len(run) > 2:
+                phrases.append(run)
+    return list(dict.fromkeys(terms)), phrases
+
+
+def _match(queryset, terms):
+    if connection.vendor == 'postgresql':
+        # 表达式与迁移0006中的GIN索引一致：to_tsvector('simple', COALESCE(search_tokens, ''))
+        from django.contrib.postgres.search import SearchQuery, SearchVector
+        raw = ' & '.join(f'{term}:*' if prefix else term for term, prefix in terms)
+        return queryset.annotate(search=SearchVector('search_tokens', config='simple')).filter(
+            search=SearchQuery(raw, config='simple', search_type='raw')
+        )
+    for term, prefix in terms:
+        queryset = queryset.filter(search_tokens__contains=f' {term}' if prefix else f' {term} ')
+    return queryset
+
+
+def search_messages(user, keyword, chatroom_id=None, content_type=None, owner=None,
+                    start=None, end=None, before=None, limit=PAGE_SIZE):
+    """
+    在用户所在的全部聊天室中检索消息
+        chatroom_id：只查某个聊天室；content_type：'process' 或 'bug'；owner：发送者用户名；
+        start/end：日期（含两端）；before：上一页返回的游标
+    返回 (按时间倒序的消息列表, 下一页游标 或 None)；关键词格式错误时抛出ValueError
+    """
+    terms, phrases = query_terms(keyword or '')
+    if not terms:
+        raise ValueError('关键词不能为空')
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    rooms = Chatroom.members.through.objects.filter(employee_id=user.pk).values('chatroom_id')
+    queryset = _match(Message.objects.filter(chatroom_id__in=rooms), terms)
+    for phrase in phrases:
+        queryset = queryset.filter(content__icontains=phrase)
+    if chatroom_id is not None:
+        queryset = queryset.filter(chatroom_id=chatroom_id)
+    if content_type:
+        if content_type not in CONTENT_TYPES:
+            raise ValueError(f'不支持的聊天室类型:{content_type}')
+        queryset = queryset.filter(chatroom__content_type__model=CONTENT_TYPES[content_type])
+    if owner:
+        queryset = queryset.filter(owner__username=owner)
+    if start:
+        queryset = queryset.filter(created_at__gte=_start_of(start))
+    if end:
+        queryset = queryset.filter(created_at__lt=_start_of(end + timedelta(days=1)))
+    if before:
+        created_at, message_id = decode_cursor(before)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id))
+
+    rows = list(queryset.select_related('owner', 'chatroom').order_by('-created_at', '-id')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, (encode_cursor(rows[-1]) if has_more else None)
+
+
+def _start_of(day):
+    """日期按本地时区的零点换算，created_at上可以直接走范围条件"""
+    return timezone.make_aware(datetime.combine(day, time.min))
@@ -1,36 +1,41 @@
 from chat.models import Chatroom
 import logging
-from django.db import IntegrityError
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, transaction
+
+from workflows.jobs import enqueue, job
 
 
 # 配置日志（替代print，日志会写入Gunicorn日志）
 logger = logging.getLogger(__name__)
-# 定义接收器函数
-def create_chatroom(sender,instance,created,**kwargs):
-    if created:
-        try:
-            # 第一步：先检查是否已存在关联的Chatroom，避免重复创建
-            # 假设Chatroom的content_object是通用外键，用content_type和object_id过滤
-            from django.contrib.contenttypes.models import ContentType
-            ct = ContentType.objects.get_for_model(instance)
-            chatroom_exists = Chatroom.objects.filter(
-                content_type=ct,
-                object_id=instance.pk
-            ).exists()
 
-            if chatroom_exists:
-                logger.warning(f"Chatroom已存在：{ct.model} - {instance.pk}")
-                return  # 已存在则跳过，避免重复创建
 
-            # 第二步：创建Chatroom（若name自动生成，确保生成逻辑唯一）
-            result = Chatroom.objects.create(content_object=instance)
-            logger.info(f"Chatroom创建成功：{result.id}，关联实例：{instance}")
+@job('chat.ensure_chatroom')
+def ensure_chatroom(model, pk):
+    """后台任务：为实例创建聊天室，已存在则跳过（任务可能重复执行，必须幂等）"""
+    instance = apps.get_model(model).objects.filter(pk=pk).first()
+    if instance is None:  # 入队后实例已被删除
+        logger.warning(f"Chatroom创建跳过，实例不存在：{model} - {pk}")
+        return None
+    ct = ContentType.objects.get_for_model(instance)
+    chatroom = Chatroom.objects.filter(content_type=ct, object_id=instance.pk).first()
+    if chatroom is not None:
+        return chatroom
+    try:
+        # 保存点：并发创建时的唯一约束冲突只回滚这一条INSERT
+        with transaction.atomic():
+            chatroom = Chatroom.objects.create(content_object=instance)
+    except IntegrityError as e:
+        logger.warning(f"Chatroom已被并发创建：{e}，关联实例：{instance}")
+        return Chatroom.objects.get(content_type=ct, object_id=instance.pk)
+    logger.info(f"Chatroom创建成功：{chatroom.id}，关联实例：{instance}")
+    return chatroom
 
-            # 精准捕获唯一约束冲突异常
-        except IntegrityError as e:
-            logger.error(f"Chatroom创建失败（唯一约束冲突）：{e}，关联实例：{instance}")
 
-
-            # 捕获其他异常
-        except Exception as e:
-            logger.error(f"Chatroom创建失败（未知错误）：{e}，关联实例：{instance}", exc_info=True)
+# 定义接收器函数
+def create_chatroom(sender,instance,created,**kwargs):
+    if created:
+        # 不在流转的请求里建聊天室：在同一个事务里入队，提交后由后台worker执行，流转回滚时任务一起回滚
+        model = instance._meta.label_lower
+        enqueue('chat.ensure_chatroom', {'model': model, 'pk': instance.pk}, key=f'chatroom:{model}:{instance.pk}')
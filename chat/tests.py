@@ -1,3 +1,449 @@
-from django.test import TestCase
+import asyncio
+from importlib import import_module
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.urls import reverse
 
 # Create your tests here.
+from accounts.models import Employee
+from chat import board
+from chat.board import get_board
+from chat.history import fetch_page
+from chat.models import Chatroom, Message, ReadState
+from chat.pipeline import write_messages
+from chat.presence import PresenceHub, get_hub, persist_reads, unread_counts
+from chat.search import query_terms, search_messages, tokenize
+from chat.routing import websocket_urlpatterns
+from devices.models import Device
+from workflows.flows import DeviceInvestigationFlow
+from workflows.jobs import run_due_jobs
+from workflows.models import DeviceProcess
+from workflows.state import refresh_device_states
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def create_employee(username):
+    return Employee.objects.create_user(username=username, password='password',
+                                        email=f'{username}@example.com', number=username[:10])
+
+
+def create_chatroom(sn):
+    # DeviceProcess的post_save信号入队建聊天室的后台任务，这里直接执行
+    device = Device.objects.create(sn=sn)
+    process = DeviceProcess.objects.create(device=device, flow_class=DeviceInvestigationFlow)
+    run_due_jobs()
+    return Chatroom.objects.get(object_id=process.pk)
+
+
+def create_messages(chatroom, owner, count):
+    Message.objects.bulk_create(Message(chatroom=chatroom, owner=owner, content=f'msg{i}') for i in range(count))
+
+
+class ChatHistoryTest(TestCase):
+    def setUp(self):
+        self.user = create_employee('chatter')
+        self.chatroom = create_chatroom('CHAT0001')
+        create_messages(self.chatroom, self.user, 120)
+
+    def test_cursor_walks_back_without_gaps(self):
+        seen = []
+        before = None
+        while True:
+            with self.assertNumQueries(1):
+                messages, before = fetch_page(self.chatroom.id, before, limit=50)
+            seen = [m.content for m in messages] + seen
+            if before is None:
+                break
+        self.assertEqual([f'msg{i}' for i in range(120)], seen)
+
+    def test_room_renders_latest_page_only(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('chat:chatroom', args=[self.chatroom.object_id]))
+        self.assertEqual(50, len(response.context['messages']))
+        self.assertEqual('msg119', response.context['messages'][-1].content)
+        self.assertIsNotNone(response.context['older_cursor'])
+
+    def test_history_endpoint(self):
+        self.client.force_login(self.user)
+        url = reverse('chat:history', args=[self.chatroom.id])
+        first = self.client.get(url, {'limit': 100}).json()
+        self.assertEqual('msg20', first['messages'][0]['content'])
+        second = self.client.get(url, {'limit': 100, 'before': first['next_cursor']}).json()
+        self.assertEqual(20, len(second['messages']))
+        self.assertIsNone(second['next_cursor'])
+        self.assertEqual(400, self.client.get(url, {'before': 'bad'}).status_code)
+
+
+class MessagePipelineTest(TransactionTestCase):
+    def setUp(self):
+        self.user = create_employee('chatter')
+        self.chatroom = create_chatroom('CHAT0003')
+
+    def test_bad_message_does_not_fail_batch(self):
+        messages = [Message(chatroom_id=self.chatroom.id, owner=self.user, content=f'msg{i}') for i in range(3)]
+        messages[1].chatroom_id = self.chatroom.id + 1000  # 聊天室不存在，外键约束失败
+        errors = write_messages(messages)
+        self.assertIsNone(errors[0])
+        self.assertIsNotNone(errors[1])
+        self.assertIsNone(errors[2])
+        self.assertEqual(['msg0', 'msg2'], list(Message.objects.order_by('id').values_list('content', flat=True)))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatConsumerTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()  # 连接缓存（chat/membership.py）不随测试数据库清空
+        self.user = create_employee('chatter')
+        self.chatroom = create_chatroom('CHAT0002')
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.chatroom.name}/')
+        communicator.scope['user'] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        presence = await communicator.receive_json_from()  # 连接后先收到当前在线成员
+        self.assertEqual('presence', presence['type'])
+        return communicator
+
+    def test_load_older_over_websocket(self):
+        create_messages(self.chatroom, self.user, 60)
+        _, cursor = fetch_page(self.chatroom.id)
+
+        async def scenario():
+            communicator = await self.connect()
+            await communicator.send_json_to({'type': 'history', 'before': cursor})
+            response = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return response
+
+        response = async_to_sync(scenario)()
+        self.assertEqual('history', response['type'])
+        self.assertEqual(['msg0', 'msg9'], [response['messages'][0]['content'], response['messages'][-1]['content']])
+        self.assertIsNone(response['next_cursor'])
+
+    def test_malformed_history_cursor_keeps_connection(self):
+        async def scenario():
+            communicator = await self.connect()
+            responses = []
+            for before in (1, {'a': 1}, 'bad'):
+                await communicator.send_json_to({'type': 'history', 'before': before})
+                responses.append(await communicator.receive_json_from())
+            await communicator.send_json_to({'type': 'history'})  # 连接仍然可用
+            responses.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return responses
+
+        responses = async_to_sync(scenario)()
+        self.assertEqual(['游标格式错误'] * 3, [response['error'] for response in responses[:3]])
+        self.assertIn('messages', responses[3])
+
+    def test_broadcast_then_persist(self):
+        async def scenario():
+            communicator = await self.connect()
+            for i in range(5):
+                await communicator.send_json_to({'message_content': f'hello{i}'})
+            responses = [await communicator.receive_json_from() for _ in range(5)]
+            await communicator.disconnect()
+            return responses
+
+        responses = async_to_sync(scenario)()
+        self.assertEqual([f'hello{i}' for i in range(5)], [r['message']['content'] for r in responses])
+        # 断开连接时等待写库完成，5条消息以一批写入，uid与广播的一致
+        stored = list(Message.objects.filter(chatroom=self.chatroom).order_by('created_at', 'id'))
+        self.assertEqual([r['message']['uid'] for r in responses], [str(m.uid) for m in stored])
+
+
+# 1000个用户的在线状态key超过本地内存缓存默认的300条上限，会把聊天室/成员缓存挤掉
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'OPTIONS': {'MAX_ENTRIES': 10_000}},
+})
+class ChatConnectTest(TransactionTestCase):
+    CLIENTS = 1000
+
+    def setUp(self):
+        cache.clear()
+        self.chatroom = create_chatroom('CHAT0004')
+        # bulk_create跳过密码哈希，1000个用户也很快
+        Employee.objects.bulk_create(
+            Employee(username=f'u{i}', email=f'u{i}@example.com', number=f'N{i}') for i in range(self.CLIENTS)
+        )
+        self.users = list(Employee.objects.order_by('id'))
+
+    def connect_all(self, users):
+        async def scenario():
+            communicators = []
+            for user in users:
+                communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.chatroom.name}/')
+                communicator.scope['user'] = user
+                communicators.append(communicator)
+            results = await asyncio.gather(*(c.connect(timeout=60) for c in communicators))
+            await asyncio.gather(*(c.disconnect(timeout=60) for c in communicators))
+            return [connected for connected, _ in results]
+
+        return async_to_sync(scenario)()
+
+    def test_reconnect_storm_hits_cache_only(self):
+        # 第一次连接：查聊天室、加载成员、每个用户插入一条成员关系
+        self.assertTrue(all(self.connect_all(self.users)))
+        self.assertEqual(self.CLIENTS, self.chatroom.members.count())
+        # Daphne重启后全部重连：不再查库
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(all(self.connect_all(self.users)))
+        self.assertEqual(0, len(queries), [q["sql"] for q in queries])
+        self.assertEqual(self.CLIENTS, self.chatroom.members.count())
+
+    def test_join_is_idempotent_and_keeps_last_activity(self):
+        user = self.users[0]
+        last_activity = self.chatroom.last_activity
+        cache.clear()
+        self.connect_all([user, user])
+        cache.clear()  # 缓存丢失后再次加入，ignore_conflicts保证不会重复插入
+        self.connect_all([user])
+        self.chatroom.refresh_from_db()
+        self.assertEqual([user.pk], list(self.chatroom.members.values_list('pk', flat=True)))
+        self.assertEqual(last_activity, self.chatroom.last_activity)
+
+    def test_membership_change_invalidates_cache(self):
+        user = self.users[0]
+        self.connect_all([user])
+        self.chatroom.members.remove(user)
+        self.connect_all([user])
+        self.assertTrue(self.chatroom.members.filter(pk=user.pk).exists())
+
+    def test_unknown_room_is_rejected(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/process_missing/')
+            communicator.scope['user'] = self.users[0]
+            connected, _ = await communicator.connect()
+            return connected
+
+        self.assertFalse(async_to_sync(scenario)())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class PresenceTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = create_employee('alice')
+        self.bob = create_employee('bob')
+        self.chatroom = create_chatroom('CHAT0005')
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.chatroom.name}/')
+        communicator.scope['user'] = user
+        await communicator.connect()
+        return communicator, await communicator.receive_json_from()
+
+    def test_events_are_coalesced_per_room(self):
+        async def scenario():
+            alice, snapshot = await self.connect(self.alice)
+            bob, bob_snapshot = await self.connect(self.bob)
+            for _ in range(20):
+                await bob.send_json_to({'type': 'typing'})
+            await bob.send_json_to({'type': 'read'})
+            await asyncio.sleep(0.05)  # 让consumer处理完上面的事件
+            await get_hub().flush(force_persist=True)
+            update = await alice.receive_json_from()
+            nothing_else = await alice.receive_nothing()
+            await alice.disconnect()
+            await bob.disconnect()
+            return snapshot, bob_snapshot, update, nothing_else
+
+        snapshot, bob_snapshot, update, nothing_else = async_to_sync(scenario)()
+        self.assertEqual({str(self.alice.pk): 'alice'}, snapshot['online'])
+        self.assertEqual({str(self.alice.pk), str(self.bob.pk)}, set(bob_snapshot['online']))
+        # 两次上线、20次输入、1次已读合并成一条广播
+        self.assertEqual({str(self.alice.pk), str(self.bob.pk)}, set(update['online']))
+        self.assertEqual({str(self.bob.pk): 'bob'}, update['typing'])
+        self.assertIn(str(self.bob.pk), update['read'])
+        self.assertTrue(nothing_else)
+        self.assertTrue(ReadState.objects.filter(chatroom=self.chatroom, employee=self.bob).exists())
+
+    def test_read_state_only_moves_forward(self):
+        earlier, later = timezone.now() - timezone.timedelta(minutes=5), timezone.now()
+        persist_reads({(self.chatroom.id, self.bob.pk): later})
+        persist_reads({(self.chatroom.id, self.bob.pk): earlier})
+        self.assertEqual(later, ReadState.objects.get(employee=self.bob).last_read_at)
+
+    def test_unread_counts_in_one_query(self):
+        other = create_chatroom('CHAT0006')
+        for room in (self.chatroom, other):
+            room.members.add(self.alice, self.bob)
+        create_messages(self.chatroom, self.alice, 3)
+        create_messages(other, self.alice, 2)
+        create_messages(other, self.bob, 4)  # 自己发的不算未读
+        with self.assertNumQueries(1):
+            self.assertEqual({self.chatroom.id: 3, other.id: 2}, unread_counts(self.bob))
+
+        # 已读位置还在缓存里、没写库时也要生效
+        async def read_all():
+            hub = PresenceHub()
+            hub.groups[other.id] = f'chat_{other.name}'
+            hub.read(other.id, self.bob, timezone.now())
+            await hub.flush()
+            return hub.unpersisted
+
+        unpersisted = async_to_sync(read_all)()
+        self.assertIn((other.id, self.bob.pk), unpersisted)
+        self.assertEqual({self.chatroom.id: 3, other.id: 0}, unread_counts(self.bob))
+
+        self.client.force_login(self.bob)
+        self.assertEqual(3, self.client.get(reverse('chat:unread')).json()['total'])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class DeviceBoardTest(TransactionTestCase):
+    def setUp(self):
+        self.user = create_employee('watcher')
+        self.device = Device.objects.create(sn='BOARD001', project='X2301', current_position='仓库')
+        refresh_device_states(self.device.pk)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/board/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    def move(self, position):
+        self.device.current_position = position
+        self.device.save()
+        refresh_device_states(self.device.pk)
+
+    def test_snapshot_then_coalesced_diff(self):
+        def changes():
+            self.move('失效分析室')
+            self.move('ME')
+            other = Device.objects.create(sn='BOARD002', project='Y1001', current_position='ME')
+            refresh_device_states(other.pk)
+
+        async def scenario():
+            first, _ = await self.connect(self.user)
+            second, _ = await self.connect(self.user)
+            snapshots = [await first.receive_json_from(), await second.receive_json_from()]
+            await database_sync_to_async(changes)()
+            await asyncio.sleep(0.05)  # 让BoardHub收完变化量
+            await get_board().flush()
+            diffs = [await first.receive_json_from(), await second.receive_json_from()]
+            nothing_else = await first.receive_nothing()
+            await first.disconnect()
+            await second.disconnect()
+            return snapshots, diffs, nothing_else
+
+        with mock.patch('chat.board.board_snapshot', wraps=board.board_snapshot) as snapshot_query:
+            snapshots, diffs, nothing_else = async_to_sync(scenario)()
+        self.assertEqual(1, snapshot_query.call_count)  # 第二个看板直接用进程内的快照
+        self.assertEqual({'node': {}, 'position': {'仓库': 1}, 'project': {'X2301': 1}}, snapshots[0]['counts'])
+        self.assertEqual(snapshots[0], snapshots[1])
+        # 3次提交合并成一条增量，中间经过的位置（失效分析室）不出现
+        self.assertEqual({'type': 'diff', 'counts': {'position': {'仓库': 0, 'ME': 2}, 'project': {'Y1001': 1}}}, diffs[0])
+        self.assertEqual(diffs[0], diffs[1])
+        self.assertTrue(nothing_else)
+
+    def test_anonymous_is_rejected(self):
+        from django.contrib.auth.models import AnonymousUser
+
+        async def scenario():
+            communicator, connected = await self.connect(AnonymousUser())
+            await communicator.disconnect()
+            return connected
+
+        self.assertFalse(async_to_sync(scenario)())
+
+    def test_board_page(self):
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get(reverse('chat:board')), '/ws/board/')
+
+
+class BenchmarkGroupSendTest(TestCase):
+    def test_in_memory_fan_out(self):
+        out = StringIO()
+        call_command('benchmark_group_send', backend='memory', sizes='10,20', messages=5, stdout=out)
+        output = out.getvalue()
+        self.assertIn('(50/50)', output)
+        self.assertIn('(100/100)', output)
+
+
+class MessageSearchTest(TestCase):
+    def setUp(self):
+        self.alice = create_employee('alice')
+        self.bob = create_employee('bob')
+        self.room = create_chatroom('CHAT0007')
+        self.other_room = create_chatroom('CHAT0008')
+        self.room.members.add(self.alice, self.bob)
+        self.other_room.members.add(self.bob)  # alice不在这个聊天室
+        self.hit = Message.objects.create(chatroom=self.room, owner=self.bob, content='X2301屏幕闪烁，WiFi正常')
+        Message.objects.create(chatroom=self.room, owner=self.alice, content='屏幕正常，偶尔闪一下烁')
+        Message.objects.create(chatroom=self.other_room, owner=self.bob, content='另一台也屏幕闪烁')
+
+    def test_tokenize_chinese_ngrams_and_words(self):
+        self.assertEqual(' x2301 屏 幕 屏幕 wifi ', tokenize('X2301 屏幕, WiFi'))
+        self.assertEqual(([('屏幕', False), ('幕闪', False), ('闪烁', False), ('wi', True)], ['屏幕闪烁']),
+                         query_terms('屏幕闪烁 Wi'))
+
+    def test_migration_tokenizer_matches_current(self):
+        frozen = import_module('chat.migrations.0006_message_search_tokens').tokenize
+        for text in ('X2301 屏幕, WiFi', '屏幕闪烁！🙂abc123 㐀', ''):
+            self.assertEqual(tokenize(text), frozen(text))
+
+    def test_only_member_rooms_and_contiguous_phrase(self):
+        with self.assertNumQueries(1):
+            messages, cursor = search_messages(self.alice, '屏幕闪烁')
+        self.assertEqual([self.hit], messages)
+        self.assertIsNone(cursor)
+        self.assertEqual(2, len(search_messages(self.bob, '闪烁')[0]))
+        self.assertEqual([self.hit], search_messages(self.alice, 'wif x23')[0])  # 英文前缀匹配
+
+    def test_filters_and_cursor(self):
+        self.assertEqual([self.hit], search_messages(self.bob, '屏幕', owner='bob', chatroom_id=self.room.id)[0])
+        self.assertEqual(2, len(search_messages(self.bob, '屏幕', content_type='process', owner='bob')[0]))
+        self.assertEqual([], search_messages(self.bob, '屏幕', content_type='bug')[0])
+        today = timezone.localdate()
+        self.assertEqual(3, len(search_messages(self.bob, '屏幕', start=today, end=today)[0]))
+        self.assertEqual([], search_messages(self.bob, '屏幕', end=today - timezone.timedelta(days=1))[0])
+
+        first, cursor = search_messages(self.bob, '屏幕', limit=2)
+        rest, last_cursor = search_messages(self.bob, '屏幕', limit=2, before=cursor)
+        self.assertEqual(3, len({m.pk for m in first + rest}))
+        self.assertIsNone(last_cursor)
+
+    def test_search_endpoint(self):
+        self.client.force_login(self.alice)
+        url = reverse('chat:search')
+        response = self.client.get(url, {'q': '闪烁', 'type': 'process'}).json()
+        self.assertEqual([self.hit.content], [m['content'] for m in response['messages']])
+        self.assertEqual(self.room.name, response['messages'][0]['chatroom'])
+        self.assertEqual(400, self.client.get(url, {'q': '  '}).status_code)
+        self.assertEqual(400, self.client.get(url, {'q': '闪烁', 'start': '2024-13-01'}).status_code)
+
+
+class AsyncChatroomViewTest(TestCase):
+    def setUp(self):
+        self.user = create_employee('async_chatter')
+        self.chatroom = create_chatroom('CHAT0005')
+        create_messages(self.chatroom, self.user, 60)
+
+    async def test_renders_latest_page(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('chat:chatroom_async', args=[self.chatroom.object_id]))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([f'msg{i}' for i in range(10, 60)], [m.content for m in response.context['messages']])
+        self.assertIsNotNone(response.context['older_cursor'])
+        self.assertEqual(self.user, response.context['user'])
+
+    async def test_missing_chatroom_redirects_to_sync_view(self):
+        await Chatroom.objects.filter(pk=self.chatroom.pk).adelete()
+        response = await self.async_client.get(reverse('chat:chatroom_async', args=[self.chatroom.object_id]))
+        self.assertRedirects(response, reverse('chat:chatroom', args=[self.chatroom.object_id]),
+                             fetch_redirect_response=False)
@@ -1,8 +1,13 @@
 from django.urls import path
 
-from chat.views import ChatroomView
+from chat.views import ChatroomView, AsyncChatroomView, ChatHistoryView, ChatSearchView, DeviceBoardView, UnreadCountView
 
 app_name = 'chat'
 urlpatterns = [
     path('<int:process_pk>', ChatroomView.as_view(), name='chatroom'),
+    path('<int:process_pk>/async', AsyncChatroomView.as_view(), name='chatroom_async'),  # 聊天室页面的异步版本（ASGI）
+    path('rooms/<int:chatroom_id>/messages', ChatHistoryView.as_view(), name='history'),  # 聊天记录游标分页
+    path('unread', UnreadCountView.as_view(), name='unread'),  # 各聊天室未读数
+    path('search', ChatSearchView.as_view(), name='search'),  # 聊天记录全文检索
+    path('board', DeviceBoardView.as_view(), name='board'),  # 实时状态看板
 ]
\ No newline at end of file
@@ -1,7 +1,17 @@
-
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404, redirect
+from django.utils.dateparse import parse_date
+from django.views import View
 from django.views.generic import TemplateView
 
-from chat.models import Chatroom, Message
+from abnormal_device_tracking.async_views import AsyncTemplateView
+from chat.history import PAGE_SIZE, afetch_page, fetch_page, serialize_message
+from chat.models import Chatroom
+from chat.presence import unread_counts
+from chat.search import search_messages
+from chat.signals import ensure_chatroom
+from workflows.models import DeviceProcess
 
 
 # Create your views here.
@@ -12,9 +22,104 @@ class ChatroomView(TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         process_id = self.kwargs['process_pk']
-        chatroom = Chatroom.objects.get(object_id=process_id)
-        messages = Message.objects.filter(chatroom=chatroom).order_by('created_at')
+        chatroom = Chatroom.objects.filter(object_id=process_id).first()
+        if chatroom is None:
+            # 聊天室由后台任务创建，worker还没执行到时在这里补建（任务幂等，之后执行时直接跳过）
+            get_object_or_404(DeviceProcess, pk=process_id)
+            chatroom = ensure_chatroom('workflows.deviceprocess', process_id)
+        # 只渲染最新的PAGE_SIZE条，更早的记录由前端滚动到顶部时通过WebSocket/ChatHistoryView按游标加载
+        messages, older_cursor = fetch_page(chatroom.id)
         context['messages'] = messages
+        context['older_cursor'] = older_cursor
         context['chatroom'] = chatroom
         context['user'] = self.request.user
-        return context
\ No newline at end of file
+        return context
+
+
+class AsyncChatroomView(AsyncTemplateView):
+    """
+    ChatroomView的异步版本（ASGI）：聊天室和最新一页消息各一条异步查询
+    聊天室还没建好时（后台任务未执行）重定向到同步的ChatroomView补建，建聊天室要生成名称、写库，不放在事件循环里
+    """
+    template_name = 'chat/chatroom.html'
+
+    async def get(self, request, *args, **kwargs):
+        process_id = self.kwargs['process_pk']
+        self.chatroom = await Chatroom.objects.filter(object_id=process_id).afirst()
+        if self.chatroom is None:
+            return redirect('chat:chatroom', process_pk=process_id)
+        return await super().get(request, *args, **kwargs)
+
+    async def aget_context_data(self, **kwargs):
+        context = await super().aget_context_data(**kwargs)
+        messages, older_cursor = await afetch_page(self.chatroom.id)
+        context.update(messages=messages, older_cursor=older_cursor, chatroom=self.chatroom, user=self.request.user)
+        return context
+
+
+class ChatHistoryView(LoginRequiredMixin, View):
+    """聊天记录分页接口：GET ?before=<游标>&limit=<条数>，返回 {'messages': [...], 'next_cursor': 游标或null}"""
+
+    def get(self, request, chatroom_id):
+        chatroom = get_object_or_404(Chatroom, pk=chatroom_id)
+        try:
+            limit = int(request.GET.get('limit', PAGE_SIZE))
+            messages, next_cursor = fetch_page(chatroom.id, request.GET.get('before') or None, limit)
+        except ValueError:
+            return JsonResponse({'error': '参数格式错误'}, status=400)
+        return JsonResponse({
+            'messages': [serialize_message(message) for message in messages],
+            'next_cursor': next_cursor,
+        })
+
+
+class UnreadCountView(LoginRequiredMixin, View):
+    """当前用户各聊天室的未读消息数：{'rooms': {聊天室id: 未读数}, 'total': 总数}，一条聚合SQL"""
+
+    def get(self, request):
+        counts = unread_counts(request.user)
+        return JsonResponse({'rooms': counts, 'total': sum(counts.values())})
+
+
+class ChatSearchView(LoginRequiredMixin, View):
+    """
+    聊天记录全文检索，只查当前用户所在的聊天室
+    GET ?q=关键词&chatroom=<聊天室id>&type=process|bug&owner=<用户名>&start=YYYY-MM-DD&end=YYYY-MM-DD&before=<游标>&limit=<条数>
+    返回 {'messages': [...], 'next_cursor': 游标或null}，消息按时间倒序
+    """
+
+    def get(self, request):
+        params = request.GET
+        try:
+            chatroom_id = int(params['chatroom']) if params.get('chatroom') else None
+            start = self.parse_day(params.get('start'))
+            end = self.parse_day(params.get('end'))
+            messages, next_cursor = search_messages(
+                request.user, params.get('q', ''), chatroom_id=chatroom_id, content_type=params.get('type') or None,
+                owner=params.get('owner') or None, start=start, end=end, before=params.get('before') or None,
+                limit=int(params.get('limit', PAGE_SIZE)),
+            )
+        except ValueError as e:
+            return JsonResponse({'error': f'参数格式错误:{e}'}, status=400)
+        return JsonResponse({
+            'messages': [
+                dict(serialize_message(message), chatroom_id=message.chatroom_id, chatroom=message.chatroom.name)
+                for message in messages
+            ],
+            'next_cursor': next_cursor,
+        })
+
+    @staticmethod
+    def parse_day(value):
+        if not value:
+            return None
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'日期格式应为YYYY-MM-DD:{value}')
+        return day
+
+
+class DeviceBoardView(LoginRequiredMixin, TemplateView):
+    """实时状态看板页面，数据全部通过WebSocket ws/board/ 推送，页面本身不查库"""
+    template_name = 'chat/device_board.html'
+    extra_context = {'dimensions': [('node', '按节点'), ('position', '按位置'), ('project', '按专案')]}
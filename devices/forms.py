@@ -56,3 +56,9 @@ class PositionForm(ModelForm):
             raise forms.ValidationError(f'负责人工号 {owner_number} 不存在，请重新扫码/输入')
 
 
+class PositionUpdateForm(PositionForm):
+    # 编辑时设备不可修改：换设备会同时破坏两台设备的停留序列（left_at）和current_position，改错设备应新增一条记录
+    device = None
+
+    class Meta(PositionForm.Meta):
+        fields = ['owner', 'position', 'reason']
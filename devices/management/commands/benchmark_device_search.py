@@ -0,0 +1,72 @@
+# 该django管理命令用于压测设备列表搜索（devices/search.py），默认构造100万台设备
+import time
+
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+
+from devices.models import Device
+from devices.search import search_devices
+
+# 压测数据的SN前缀，--cleanup时按前缀删除
+BENCH_PREFIX = 'BENCH'
+PROJECTS = ['X2301', 'X2302', 'Y1001', 'Z0900']
+FAILURE_MODES = ['wifi_rssi', 'bt_tx_power', 'camera_af', 'battery_ocv', 'usb_enum']
+
+
+class Command(BaseCommand):
+    help = "benchmark device list search"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1_000_000, help='压测设备数量（默认100万）')
+        parser.add_argument('--batch-size', type=int, default=10_000, help='每批写入的设备数量')
+        parser.add_argument('--repeat', type=int, default=5, help='每个关键词重复搜索次数，取平均')
+        parser.add_argument('--skip-load', action='store_true', help='不写入数据，直接对已有数据压测')
+        parser.add_argument('--cleanup', action='store_true', help='压测结束后删除压测数据')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        if not options['skip_load']:
+            self.load(count, options['batch_size'])
+
+        keywords = [
+            f'{BENCH_PREFIX}{count // 2:09d}',  # SN完全匹配
+            f'{BENCH_PREFIX}{count // 3:09d}'[:-3],  # SN前缀（命中1000台）
+            'camera',  # failure_mode子串
+            'Y10',  # project子串
+        ]
+        self.stdout.write(self.style.NOTICE(f"===== 数据库:{connection.vendor}, 设备数:{Device.objects.count()} ====="))
+        for keyword in keywords:
+            elapsed = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                # 和DeviceListView一样：第一页20条
+                rows = list(search_devices(Device.objects.all(), keyword)[:20])
+                elapsed.append(time.perf_counter() - start)
+            self.stdout.write(
+                f"关键词:{keyword:<16} 第一页:{len(rows):>3}条  平均:{sum(elapsed) / len(elapsed) * 1000:8.2f}ms  "
+                f"最慢:{max(elapsed) * 1000:8.2f}ms"
+            )
+
+        if options['cleanup']:
+            deleted, _ = Device.objects.filter(sn__startswith=BENCH_PREFIX).delete()
+            self.stdout.write(self.style.SUCCESS(f'Successfully delete {deleted} benchmark rows'))
+
+    def load(self, count, batch_size):
+        existing = Device.objects.filter(sn__startswith=BENCH_PREFIX).count()
+        self.stdout.write(self.style.NOTICE(f"===== 写入压测设备，已有{existing}台，目标{count}台 ====="))
+        for start in range(existing, count, batch_size):
+            # Device有HistoricalRecords，bulk_create不会写历史表，压测数据正好不需要历史
+            batch = [
+                Device(
+                    sn=f'{BENCH_PREFIX}{i:09d}',
+                    project=PROJECTS[i % len(PROJECTS)],
+                    hardware_version=f'EVT{i % 3}',
+                    failure_mode=FAILURE_MODES[i % len(FAILURE_MODES)],
+                )
+                for i in range(start, min(start + batch_size, count))
+            ]
+            with transaction.atomic():
+                Device.objects.bulk_create(batch, batch_size=batch_size)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE devices_device;')
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-17 16:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0008_remove_analysisresults_task_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='analysisresults',
+            index=models.Index(fields=['process', 'task', '-created_at'], name='analysis_process_task_idx'),
+        ),
+    ]
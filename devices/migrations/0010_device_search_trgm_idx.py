@@ -0,0 +1,45 @@
+# Generated by Django 5.2.5 on 2026-10-17 17:10
+
+from django.db import migrations
+
+# (索引名, 表名, 列名)，表达式与Django为icontains生成的 UPPER("col"::text) 一致
+TRGM_INDEXES = [
+    ('devices_device_sn_trgm_idx', 'devices_device', 'sn'),
+    ('devices_device_project_trgm_idx', 'devices_device', 'project'),
+    ('devices_device_hw_version_trgm_idx', 'devices_device', 'hardware_version'),
+    ('devices_device_failure_mode_trgm_idx', 'devices_device', 'failure_mode'),
+    ('problem_group_bug_number_trgm_idx', 'problem_group_bug', 'bug_number'),
+]
+
+
+def create_trgm_indexes(apps, schema_editor):
+    # pg_trgm只有PostgreSQL有，其他数据库（本地测试用的SQLite）跳过，搜索语句照常执行
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+    for name, table, column in TRGM_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ((UPPER({column}::text)) gin_trgm_ops);'
+        )
+
+
+def drop_trgm_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _, _ in TRGM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name};')
+
+
+class Migration(migrations.Migration):
+    '''
+        设备列表搜索（devices/search.py）用的pg_trgm GIN索引，让 icontains 不再全表扫描
+    '''
+
+    dependencies = [
+        ('devices', '0009_analysisresults_process_task_idx'),
+        ('problem_group', '0009_alter_bug_bug_number'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trgm_indexes, drop_trgm_indexes),
+    ]
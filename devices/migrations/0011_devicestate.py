@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0010_device_search_trgm_idx'),
+        ('workflows', '0003_task_process_flow_task_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceState',
+            fields=[
+                ('device', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='state', serialize=False, to='devices.device')),
+                ('current_node', models.CharField(blank=True, default='', max_length=50)),
+                ('status', models.CharField(blank=True, default='', max_length=50)),
+                ('task_status', models.CharField(blank=True, default='', max_length=50)),
+                ('last_transition_at', models.DateTimeField(blank=True, null=True)),
+                ('current_position', models.CharField(blank=True, max_length=50, null=True)),
+                ('owner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('process', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='workflows.deviceprocess')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['current_node', 'status'], name='device_state_node_status_idx'), models.Index(fields=['owner', 'task_status'], name='device_state_owner_idx'), models.Index(fields=['-last_transition_at'], name='device_state_transition_idx')],
+            },
+        ),
+    ]
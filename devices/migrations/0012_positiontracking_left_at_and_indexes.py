@@ -0,0 +1,54 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:46
+
+from django.db import migrations, models
+
+BACKFILL_DEVICE_BATCH_SIZE = 500
+
+
+def backfill_left_at(apps, schema_editor):
+    # 已有记录：每台设备按时间排序，一行的left_at = 同一台设备下一行的created_at，最后一行保持为空（当前位置）
+    PositionTracking = apps.get_model('devices', 'PositionTracking')
+    last_device = 0
+    while True:
+        device_ids = list(
+            PositionTracking.objects.filter(device_id__gt=last_device).order_by('device_id')
+            .values_list('device_id', flat=True).distinct()[:BACKFILL_DEVICE_BATCH_SIZE]
+        )
+        if not device_ids:
+            break
+        last_device = device_ids[-1]
+        rows = list(PositionTracking.objects.filter(device_id__in=device_ids)
+                    .order_by('device_id', 'created_at', 'id').only('id', 'device_id', 'created_at'))
+        closed = []
+        for row, following in zip(rows, rows[1:]):
+            if following.device_id == row.device_id:
+                row.left_at = following.created_at
+                closed.append(row)
+        PositionTracking.objects.bulk_update(closed, ['left_at'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+    '''
+        位置记录按时序存储（devices/positions.py）：停留结束时间left_at、历史记录回填、(device, created_at)和(position, left_at)索引
+    '''
+
+    dependencies = [
+        ('devices', '0011_devicestate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='positiontracking',
+            name='left_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_left_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='positiontracking',
+            index=models.Index(fields=['device', 'created_at'], name='position_device_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='positiontracking',
+            index=models.Index(fields=['position', 'left_at'], name='position_location_left_idx'),
+        ),
+    ]
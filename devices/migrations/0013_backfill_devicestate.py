@@ -0,0 +1,83 @@
+# Generated by Django 5.2.5 on 2026-10-17 19:20
+
+from django.db import migrations, models
+from django.db.models.functions import Cast
+
+BACKFILL_BATCH_SIZE = 2000
+
+
+def _latest(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def backfill_device_states(apps, schema_editor):
+    # 与workflows/state.py的build_states()相同的计算，在迁移中固化一份（不导入应用代码，以后那边改动不影响重放迁移）：
+    # 设备的当前状态 = 最新的流程（按id） + 该流程最新的task（按id） + Device.current_position
+    Device = apps.get_model('devices', 'Device')
+    DeviceState = apps.get_model('devices', 'DeviceState')
+    DeviceProcess = apps.get_model('workflows', 'DeviceProcess')
+    DeviceTask = apps.get_model('workflows', 'DeviceTask')
+    latest_process = DeviceProcess.objects.filter(device_id=models.OuterRef('pk')).order_by('-pk').values('pk')[:1]
+    latest_task = DeviceTask.objects.filter(process_id=models.OuterRef('pk')).order_by('-pk').values('pk')[:1]
+    last_id = 0
+    while True:
+        devices = list(
+            Device.objects.filter(pk__gt=last_id).order_by('pk')
+            .annotate(latest_process_id=models.Subquery(latest_process))
+            .values('pk', 'current_position', 'latest_process_id')[:BACKFILL_BATCH_SIZE]
+        )
+        if not devices:
+            break
+        last_id = devices[-1]['pk']
+        processes = {
+            row['pk']: row for row in
+            DeviceProcess.objects.filter(pk__in=[row['latest_process_id'] for row in devices if row['latest_process_id']])
+            .annotate(latest_task_id=models.Subquery(latest_task))
+            .values('pk', 'status', 'created', 'finished', 'latest_task_id')
+        }
+        # flow_task按数据库里的原始字符串读取（'app/module.Flow.节点名'），取最后一段作为节点名
+        tasks = {
+            row['process_id']: row for row in
+            DeviceTask.objects.filter(pk__in=[p['latest_task_id'] for p in processes.values() if p['latest_task_id']])
+            .annotate(flow_task_ref=Cast('flow_task', models.CharField()))
+            .values('process_id', 'flow_task_ref', 'status', 'owner_id', 'created', 'assigned', 'started', 'finished')
+        }
+        states = []
+        for row in devices:
+            state = DeviceState(device_id=row['pk'], current_position=row['current_position'])
+            process = processes.get(row['latest_process_id'])
+            if process is not None:
+                state.process_id = process['pk']
+                state.status = process['status']
+                state.last_transition_at = _latest(process['created'], process['finished'])
+                task = tasks.get(process['pk'])
+                if task is not None:
+                    state.current_node = (task['flow_task_ref'] or '').rsplit('.', 1)[-1]
+                    state.task_status = task['status']
+                    state.owner_id = task['owner_id']
+                    state.last_transition_at = _latest(
+                        state.last_transition_at, task['created'], task['assigned'], task['started'], task['finished']
+                    )
+            states.append(state)
+        DeviceState.objects.bulk_create(
+            states, update_conflicts=True, unique_fields=['device'],
+            update_fields=['process', 'current_node', 'status', 'task_status', 'owner', 'last_transition_at',
+                           'current_position'],
+        )
+
+
+class Migration(migrations.Migration):
+    '''
+        回填DeviceState投影（0011只建了空表）：按设备id keyset分块，每块3条查询 + 1条upsert；
+        已有投影的设备按同样的计算覆盖，重复执行结果不变。之后的修正仍可用 manage.py rebuild_device_state
+    '''
+
+    dependencies = [
+        ('devices', '0012_positiontracking_left_at_and_indexes'),
+        ('workflows', '0004_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_device_states, migrations.RunPython.noop),
+    ]
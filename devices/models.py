@@ -58,7 +58,11 @@ class AnalysisResults(models.Model):
     ) # 用于分支节点的判断
     history = HistoricalRecords()
 
-
+    class Meta:
+        indexes = [
+            # 分支节点查询“流程P中节点X的最新结果”：process等值过滤 + task join + created_at倒序取第一条
+            models.Index(fields=['process', 'task', '-created_at'], name='analysis_process_task_idx'),
+        ]
 
     def __str__(self):
         return f"设备:{self.process.device.sn}, {self.number.username}针对操作{self.operation.action}的分析结果{self.analysis_notes}, 时间:{self.created_at.strftime("%Y-%m-%d %H:%M:%S")}"
@@ -66,11 +70,52 @@ class AnalysisResults(models.Model):
 
 
 class PositionTracking(models.Model):
+    """
+    设备位置的时序记录：每次移动追加一行，一行就是设备在position的一段停留 [created_at, left_at)
+    left_at为空表示设备当前仍在该位置；写入、轨迹查询、按位置反查设备见devices/positions.py
+    """
     device = models.ForeignKey('devices.Device', on_delete=models.CASCADE)
     owner = models.ForeignKey('accounts.Employee', on_delete=models.CASCADE)
     position = models.CharField(max_length=100,null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    left_at = models.DateTimeField(null=True, blank=True, editable=False)  # 下一次移动的时间
     reason = models.CharField(max_length=100,null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # 单台设备的记录列表、多台设备的轨迹：device等值过滤 + 按时间排序
+            models.Index(fields=['device', 'created_at'], name='position_device_time_idx'),
+            # "某段时间内在位置L的设备"：position等值过滤 + left_at范围（left_at > start 或 IS NULL）
+            models.Index(fields=['position', 'left_at'], name='position_location_left_idx'),
+        ]
+
+    def __str__(self):
+        return f"当前位置{self.position}"
+
+class DeviceState(models.Model):
+    """
+    设备当前状态的投影表（一台设备一行）：最新流程、当前节点、状态、处理人、最后一次流转时间、当前位置
+    原来回答"这台设备现在在流程的哪一步"要 DeviceProcess → DeviceTask 按id倒序join，设备列表每行都要查一次。
+    这里由流程流转（CustomViewActivation）、启动流程、位置变更（PositionCreateView）在同一个事务里同步更新，
+    计算逻辑见workflows/state.py；数据不一致时用 manage.py rebuild_device_state 从流程/位置历史整体重算
+    """
+    device = models.OneToOneField(Device, on_delete=models.CASCADE, primary_key=True, related_name='state')
+    process = models.ForeignKey('workflows.DeviceProcess', on_delete=models.SET_NULL, null=True, blank=True,
+                                related_name='+')
+    current_node = models.CharField(max_length=50, blank=True, default='')  # 最新task的节点名，如production_test_fail
+    status = models.CharField(max_length=50, blank=True, default='')  # 流程状态（NEW/DONE/CANCELED）
+    task_status = models.CharField(max_length=50, blank=True, default='')  # 当前节点任务状态（NEW/ASSIGNED/STARTED/DONE）
+    owner = models.ForeignKey('accounts.Employee', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_transition_at = models.DateTimeField(null=True, blank=True)
+    current_position = models.CharField(max_length=50, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # 设备列表/dashboard按节点、状态、处理人筛选，按最后流转时间排序
+            models.Index(fields=['current_node', 'status'], name='device_state_node_status_idx'),
+            models.Index(fields=['owner', 'task_status'], name='device_state_owner_idx'),
+            models.Index(fields=['-last_transition_at'], name='device_state_transition_idx'),
+        ]
+
     def __str__(self):
-        return f"当前位置{self.position}"
\ No newline at end of file
+        return f"{self.device_id}:{self.current_node or '-'}({self.status or '-'})"
@@ -0,0 +1,82 @@
+# devices/positions.py
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import Q
+
+from devices.models import Device, PositionTracking
+from workflows.state import refresh_device_states
+
+"""
+    设备位置的时序存储（PositionTracking）
+        1、写入：record_move()在一个事务里追加一行、把同一台设备上一段停留的left_at设为新记录的created_at、
+           Device.current_position只UPDATE这一列（update_fields，不写simple_history：位置的历史就是PositionTracking本身），
+           并刷新DeviceState投影；先锁设备行，同一台设备的并发移动串行执行，保证每台设备最多一段未结束的停留
+           编辑已有记录（填错位置等）走update_move()：设备不可改、created_at不变，所以各段停留的left_at不受影响；
+           改的是设备当前这段停留（left_at为空）时，同步Device.current_position和DeviceState投影
+        2、轨迹：trajectories()一条SQL读出多台设备的移动序列，走(device, created_at)索引，
+           连续相同位置（重复扫码、只改原因）合并成一段停留，返回 {device_id: [Stay, ...]}
+        3、反查：devices_at(L, start, end)返回[start, end]内任意时刻在位置L的设备，
+           停留区间[created_at, left_at)与查询区间相交：position = L AND created_at <= end AND (left_at > start OR left_at IS NULL)，
+           走(position, left_at)索引的两段范围扫描（已离开的 + 仍在L的），不扫全表
+"""
+
+Stay = namedtuple('Stay', ['position', 'start', 'end'])  # end为None表示仍在该位置
+
+
+def record_move(move):
+    """保存一条（未保存的）位置记录move，返回move"""
+    with transaction.atomic():
+        device = Device.objects.select_for_update().only('pk', 'current_position').get(pk=move.device_id)
+        move.save()
+        PositionTracking.objects.filter(device_id=device.pk, left_at__isnull=True).exclude(pk=move.pk) \
+            .update(left_at=move.created_at)
+        device.current_position = move.position
+        device.skip_history_when_saving = True
+        device.save(update_fields=['current_position'])
+        refresh_device_states(device.pk)  # 同步设备当前状态投影中的位置
+    return move
+
+
+def update_move(move):
+    """保存对已有位置记录move的修改（设备和时间不变），返回move"""
+    with transaction.atomic():
+        device = Device.objects.select_for_update().only('pk', 'current_position').get(pk=move.device_id)
+        move.save()
+        if move.left_at is None and device.current_position != move.position:
+            device.current_position = move.position
+            device.skip_history_when_saving = True
+            device.save(update_fields=['current_position'])
+            refresh_device_states(device.pk)
+    return move
+
+
+def trajectories(device_ids, start=None, end=None):
+    """
+    多台设备在[start, end]内的移动序列（不传表示不限），一条SQL
+    返回 {device_id: [Stay(position, start, end), ...]}，按时间正序；与查询区间相交的停留按原始起止时间返回，不裁剪
+    """
+    device_ids = list(device_ids)
+    queryset = PositionTracking.objects.filter(device_id__in=device_ids)
+    if start is not None:
+        queryset = queryset.filter(Q(left_at__gt=start) | Q(left_at__isnull=True))
+    if end is not None:
+        queryset = queryset.filter(created_at__lte=end)
+    rows = queryset.order_by('device_id', 'created_at').values_list('device_id', 'position', 'created_at', 'left_at')
+    result = {device_id: [] for device_id in device_ids}
+    for device_id, position, arrived_at, left_at in rows.iterator(chunk_size=2000):
+        stays = result[device_id]
+        if stays and stays[-1].position == position:
+            stays[-1] = stays[-1]._replace(end=left_at)  # 位置没变，延长上一段停留
+        else:
+            stays.append(Stay(position, arrived_at, left_at))
+    return result
+
+
+def devices_at(position, start, end):
+    """[start, end]内任意时刻在位置position的设备id列表（按id排序）"""
+    return list(
+        PositionTracking.objects.filter(position=position, created_at__lte=end)
+        .filter(Q(left_at__gt=start) | Q(left_at__isnull=True))
+        .order_by('device_id').values_list('device_id', flat=True).distinct()
+    )
@@ -0,0 +1,83 @@
+# devices/search.py
+import re
+
+from django.db.models import Case, IntegerField, Q, Value, When
+
+from problem_group.models import Bug
+
+"""
+    设备列表的搜索
+    1. SN快速通道：关键词形如SN（字母数字且含数字，无空格）且有SN与它完全相同的设备（扫码枪输入完整SN）时，
+       只按 sn LIKE 'xxx%' 查询（该设备 + SN以它开头的设备），走Django给unique CharField自动建的varchar_pattern_ops索引（PostgreSQL）；
+       只是SN前缀命中时不走快速通道，否则project/硬件版本/失效模式/bug号中含该关键词的设备会被漏掉，
+       改走全字段搜索：其中的sn icontains已经包含全部SN前缀命中的设备（前缀结果并入全字段结果），排序仍排在前面
+    2. 全字段搜索：sn/project/hardware_version/failure_mode 和bug号做icontains。
+       PostgreSQL上这些列（含bug号）都有 UPPER(col::text) 的pg_trgm GIN索引（devices迁移0010），
+       与Django生成的 UPPER("col"::text) LIKE UPPER('%xxx%') 表达式一致，可以走位图索引扫描而不是全表扫描；
+       bug号改成子查询（bug_id IN (...)），避免跨表OR导致索引失效
+       SQLite等其他数据库没有这些索引，语句完全相同，只是走全表扫描，本地测试照常运行
+    3. 排序：SN完全匹配 > SN前缀匹配 > 其他字段匹配，同级按id倒序（新设备在前）
+"""
+
+SEARCH_FIELDS = ('sn', 'project', 'hardware_version', 'failure_mode')
+# 看起来像SN的关键词：字母、数字、-、_，至少6个字符且包含数字
+SN_PATTERN = re.compile(r'^(?=.*\d)[A-Za-z0-9_-]{6,}$')
+
+RANK_EXACT_SN = 3
+RANK_SN_PREFIX = 2
+RANK_OTHER = 1
+
+
+def sn_prefix_queryset(queryset, keyword):
+    """SN快速通道，关键词不像SN时返回None"""
+    if not SN_PATTERN.match(keyword):
+        return None
+    return queryset.filter(sn__startswith=keyword)
+
+
+def exact_sn_queryset(queryset, keyword):
+    """判断是否走SN快速通道的查询（有SN完全相同的设备），关键词不像SN时返回None"""
+    if not SN_PATTERN.match(keyword):
+        return None
+    return queryset.filter(sn=keyword)
+
+
+def rank_expression(keyword):
+    return Case(
+        When(sn=keyword, then=Value(RANK_EXACT_SN)),
+        When(sn__startswith=keyword, then=Value(RANK_SN_PREFIX)),
+        default=Value(RANK_OTHER),
+        output_field=IntegerField(),
+    )
+
+
+def search_devices(queryset, keyword):
+    """按关键词搜索设备，返回带rank注解、已排序的queryset"""
+    keyword = keyword.strip()
+    if not keyword:
+        return queryset.order_by('-id')
+
+    exact = exact_sn_queryset(queryset, keyword)
+    if exact is not None and exact.exists():
+        return sn_prefix_queryset(queryset, keyword).annotate(rank=rank_expression(keyword)).order_by('-rank', '-id')
+    return full_search_queryset(queryset, keyword)
+
+
+async def asearch_devices(queryset, keyword):
+    """search_devices的异步版本（异步设备列表使用），SN快速通道的判断用aexists()"""
+    keyword = keyword.strip()
+    if not keyword:
+        return queryset.order_by('-id')
+
+    exact = exact_sn_queryset(queryset, keyword)
+    if exact is not None and await exact.aexists():
+        return sn_prefix_queryset(queryset, keyword).annotate(rank=rank_expression(keyword)).order_by('-rank', '-id')
+    return full_search_queryset(queryset, keyword)
+
+
+def full_search_queryset(queryset, keyword):
+    condition = Q()
+    for field in SEARCH_FIELDS:
+        condition |= Q(**{f'{field}__icontains': keyword})
+    condition |= Q(bug__in=Bug.objects.filter(bug_number__icontains=keyword).values('pk'))
+    return queryset.filter(condition).annotate(rank=rank_expression(keyword)).order_by('-rank', '-id')
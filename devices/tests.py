@@ -1,13 +1,201 @@
 from django.test import TestCase
 
 # Create your tests here.
+from datetime import timedelta
 from io import StringIO
+from asgiref.sync import async_to_sync
 from django.core.management import call_command
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from devices.models import Device, DeviceState, PositionTracking
+from devices.positions import devices_at, trajectories
+from devices.search import asearch_devices, search_devices
 
 
 class CleanUpCommandTest(TestCase): # 测试django管理命令clean_up
     def test_command_output(self):
         out = StringIO()
         call_command("clean_up", stdout=out)
-        self.assertIn('Successfully clear', out.getvalue())
\ No newline at end of file
+        self.assertIn('Successfully clear', out.getvalue())
+
+class DeviceSearchTest(TestCase):
+    def setUp(self):
+        from accounts.models import Employee
+        from problem_group.models import Bug
+        creator = Employee.objects.create_user(username='qa', password='password', email='qa@example.com', number='qa')
+        bug = Bug.objects.create(bug_number='BUG-4242', created_by=creator)
+        Device.objects.create(sn='ABC123456', project='X2301', failure_mode='wifi_rssi')
+        Device.objects.create(sn='ABC1234567', project='Y1001', failure_mode='camera_af')
+        Device.objects.create(sn='ZZZ000001', project='X2301', failure_mode='camera_af', bug=bug)
+
+    def sns(self, keyword):
+        return [d.sn for d in search_devices(Device.objects.all(), keyword)]
+
+    def test_exact_sn_ranked_first(self):
+        self.assertEqual(['ABC123456', 'ABC1234567'], self.sns('ABC123456'))
+
+    def test_sn_prefix_does_not_hide_other_fields(self):
+        Device.objects.create(sn='QQQ000001', project='ABC12345-EVT')
+        self.assertEqual(['ABC1234567', 'ABC123456', 'QQQ000001'], self.sns('ABC12345'))
+        self.assertEqual(['ABC1234567', 'ABC123456', 'QQQ000001'],
+                         [d.sn for d in async_to_sync(asearch_devices)(Device.objects.all(), 'ABC12345')])
+
+    def test_substring_across_fields_and_bug(self):
+        self.assertEqual({'ABC1234567', 'ZZZ000001'}, set(self.sns('camera')))
+        self.assertEqual(['ZZZ000001'], self.sns('4242'))
+
+    def test_view_paginates(self):
+        for i in range(25):
+            Device.objects.create(sn=f'PAGE{i:05d}')
+        response = self.client.get(reverse('devices:device_list'), {'q': 'page'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(20, len(response.context['devices']))
+        self.assertTrue(response.context['is_paginated'])
+
+
+class DeviceStateViewTest(TestCase):
+    def setUp(self):
+        from accounts.models import Employee
+        self.user = Employee.objects.create_user(username='pos', password='password', email='pos@example.com', number='P001')
+        self.device = Device.objects.create(sn='POS000001')
+
+    def test_position_create_updates_state(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('devices:position_create'), {
+            'device': 'POS000001', 'owner': 'P001', 'position': '失效分析室', 'reason': '送测',
+        })
+        self.assertEqual(302, response.status_code)
+        self.assertEqual('失效分析室', DeviceState.objects.get(device=self.device).current_position)
+
+    def test_device_list_filters_by_node(self):
+        Device.objects.create(sn='POS000002')
+        DeviceState.objects.create(device=self.device, current_node='production_test_fail', status='NEW')
+        response = self.client.get(reverse('devices:device_list'), {'node': 'production_test_fail'})
+        self.assertEqual(['POS000001'], [d.sn for d in response.context['devices']])
+        self.assertEqual(['production_test_fail'], list(response.context['nodes']))
+
+
+class AsyncDeviceViewTest(TestCase):
+    def setUp(self):
+        from accounts.models import Employee
+        self.user = Employee.objects.create_user(username='async', password='password', email='async@example.com',
+                                                 number='A001')
+        for i in range(25):
+            Device.objects.create(sn=f'ASYNC{i:04d}')
+        self.device = Device.objects.get(sn='ASYNC0000')
+        DeviceState.objects.create(device=self.device, current_node='production_test_fail', status='NEW')
+
+    async def test_device_list_matches_sync_view(self):
+        await self.async_client.aforce_login(self.user)
+        for params in ({'q': 'async'}, {'q': 'ASYNC0000'}, {'node': 'production_test_fail'}, {'page': 'last'}):
+            sync = await self.async_client.get(reverse('devices:device_list'), params)
+            response = await self.async_client.get(reverse('devices:device_list_async'), params)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual([d.sn for d in sync.context['devices']], [d.sn for d in response.context['devices']])
+            self.assertEqual(sync.context['is_paginated'], response.context['is_paginated'])
+        self.assertEqual(['production_test_fail'], response.context['nodes'])
+        self.assertContains(response, 'async')  # 导航栏的当前用户
+        response = await self.async_client.get(reverse('devices:device_list_async'), {'page': 9})
+        self.assertEqual(404, response.status_code)
+
+    async def test_position_list(self):
+        await PositionTracking.objects.acreate(device=self.device, owner=self.user, position='失效分析室', reason='送测')
+        response = await self.async_client.get(reverse('devices:position_tracking_async', kwargs={'pk': self.device.pk}))
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, '失效分析室')
+        self.assertContains(response, 'A001')
+        response = await self.async_client.get(reverse('devices:position_tracking_async', kwargs={'pk': 999999}))
+        self.assertEqual(404, response.status_code)
+
+
+class PositionTimeSeriesTest(TestCase):
+    def setUp(self):
+        from accounts.models import Employee
+        self.user = Employee.objects.create_user(username='mover', password='password', email='mover@example.com',
+                                                 number='M001')
+        self.devices = [Device.objects.create(sn=f'MOVE{i:04d}') for i in range(4)]
+        self.t0 = timezone.now() - timedelta(days=10)
+
+    def at(self, days):
+        return self.t0 + timedelta(days=days)
+
+    def stay(self, device, position, start, end=None):
+        row = PositionTracking.objects.create(device=device, owner=self.user, position=position)
+        PositionTracking.objects.filter(pk=row.pk).update(created_at=self.at(start),
+                                                          left_at=None if end is None else self.at(end))
+
+    def test_move_closes_previous_stay_without_history_row(self):
+        self.client.force_login(self.user)
+        history = self.devices[0].history.count()
+        for position in ('FA室', '仓库'):
+            response = self.client.post(reverse('devices:position_create'), {
+                'device': 'MOVE0000', 'owner': 'M001', 'position': position, 'reason': '送测',
+            })
+            self.assertEqual(302, response.status_code)
+        first, second = PositionTracking.objects.filter(device=self.devices[0]).order_by('created_at')
+        self.assertEqual(second.created_at, first.left_at)
+        self.assertIsNone(second.left_at)
+        self.devices[0].refresh_from_db()
+        self.assertEqual('仓库', self.devices[0].current_position)
+        self.assertEqual(history, self.devices[0].history.count())
+
+    def test_edit_keeps_device_and_resyncs_current_position(self):
+        self.client.force_login(self.user)
+        for position in ('FA室', '仓库'):
+            self.client.post(reverse('devices:position_create'), {
+                'device': 'MOVE0000', 'owner': 'M001', 'position': position, 'reason': '送测',
+            })
+        first, second = PositionTracking.objects.filter(device=self.devices[0]).order_by('created_at')
+        response = self.client.post(
+            reverse('devices:position_change', kwargs={'pk': self.devices[0].pk, 'position_pk': second.pk}),
+            {'device': 'MOVE0001', 'owner': 'M001', 'position': '产线', 'reason': '填错'},
+        )
+        self.assertEqual(302, response.status_code)
+        second.refresh_from_db()
+        self.assertEqual((self.devices[0].pk, '产线', None), (second.device_id, second.position, second.left_at))
+        self.devices[0].refresh_from_db()
+        self.assertEqual('产线', self.devices[0].current_position)
+        self.assertEqual('产线', DeviceState.objects.get(device=self.devices[0]).current_position)
+        self.assertFalse(PositionTracking.objects.filter(device=self.devices[1]).exists())
+        first.refresh_from_db()
+        self.assertEqual(second.created_at, first.left_at)
+
+    def test_trajectories_are_compressed_in_one_query(self):
+        a, b = self.devices[:2]
+        self.stay(a, 'FA室', 0, 1)
+        self.stay(a, 'FA室', 1, 2)  # 重复扫码，合并
+        self.stay(a, '仓库', 2)
+        self.stay(b, '产线', 0, 5)
+        with self.assertNumQueries(1):
+            result = trajectories([a.pk, b.pk, self.devices[2].pk])
+        self.assertEqual([('FA室', self.at(0), self.at(2)), ('仓库', self.at(2), None)], result[a.pk])
+        self.assertEqual([('产线', self.at(0), self.at(5))], result[b.pk])
+        self.assertEqual([], result[self.devices[2].pk])
+        # 只取与区间相交的停留
+        self.assertEqual(['仓库'], [stay.position for stay in trajectories([a.pk], self.at(3), self.at(4))[a.pk]])
+
+    def test_devices_at_location_in_window(self):
+        a, b, c, d = self.devices
+        self.stay(a, 'FA室', 2, 4)  # 区间内离开
+        self.stay(b, 'FA室', 0)  # 区间开始前到达，一直在
+        self.stay(c, 'FA室', 0, 1)  # 区间开始前已离开
+        self.stay(d, 'FA室', 6)  # 区间结束后才到
+        self.stay(c, '仓库', 1)
+        self.assertEqual([a.pk, b.pk], devices_at('FA室', self.at(3), self.at(5)))
+
+    def test_json_endpoints(self):
+        a, b = self.devices[:2]
+        self.stay(a, 'FA室', 0, 2)
+        self.stay(a, '仓库', 2)
+        self.stay(b, 'FA室', 1)
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('devices:trajectories'), {'sn': ['MOVE0000', 'MOVE0001']})
+        self.assertEqual(['FA室', '仓库'], [stay['position'] for stay in response.json()['devices']['MOVE0000']])
+        response = self.client.get(reverse('devices:located'), {
+            'position': 'FA室', 'start': self.at(3).isoformat(), 'end': self.at(4).isoformat(),
+        })
+        self.assertEqual(['MOVE0001'], response.json()['devices'])
+        response = self.client.get(reverse('devices:located'), {'position': 'FA室', 'start': 'yesterday'})
+        self.assertEqual(400, response.status_code)
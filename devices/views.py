@@ -1,40 +1,80 @@
 from datetime import timedelta
 
 from django.contrib import messages
-from django.db.models import Q
-from django.shortcuts import redirect
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.http import JsonResponse
+from django.shortcuts import redirect, aget_object_or_404, get_object_or_404
 from django.urls import reverse_lazy, reverse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views import View
 from django.views.generic import ListView, DetailView, UpdateView, CreateView
 
-from devices.forms import DeviceForm, PositionForm
-from devices.models import Device, PositionTracking
+from abnormal_device_tracking.async_views import AsyncListView
+from devices.forms import DeviceForm, PositionForm, PositionUpdateForm
+from devices.models import Device, DeviceState, PositionTracking
+from devices.positions import devices_at, record_move, trajectories, update_move
+from devices.search import asearch_devices, search_devices
 from problem_group.models import Bug
 
 
 # Create your views here.
 
 
-class DeviceListView(ListView):
-    model = Device
+class DeviceListMixin:
+    """设备列表的筛选条件，同步和异步的设备列表共用"""
     template_name = 'devices/device_list.html'
     context_object_name = 'devices'
+    paginate_by = 20
+
+    def get_filtered_queryset(self):
+        # 流程状态从DeviceState投影表join带出（最新流程、当前节点、处理人），不再逐行查流程和任务
+        devices = Device.objects.select_related('state', 'state__owner')
+        node = self.request.GET.get('node')
+        if node:
+            devices = devices.filter(state__current_node=node)
+        status = self.request.GET.get('status')
+        if status:
+            devices = devices.filter(state__status=status)
+        return devices
+
+    def get_filter_context(self):
+        return {
+            'q': self.request.GET.get('q', ''),
+            'node': self.request.GET.get('node', ''),
+            'status': self.request.GET.get('status', ''),
+            # 筛选下拉框：投影表上current_node有索引，DISTINCT只扫索引
+            'nodes': DeviceState.objects.exclude(current_node='').order_by('current_node')
+            .values_list('current_node', flat=True).distinct(),
+        }
+
+
+class DeviceListView(DeviceListMixin, ListView):
+    model = Device
 
     def get_queryset(self):
         # 从 URL 的?后面的查询字符串中，读取q这个参数的值
         search_query = self.request.GET.get('q', '')
-        if search_query: # 有在url中输入筛选条件
-            # 多字段搜索  只要其中一个字段包含搜索关键词，就会被筛选出来
-            devices = Device.objects.filter(
-                Q(sn__icontains=search_query) |
-                Q(project__icontains=search_query) |
-                Q(hardware_version__icontains=search_query) |
-                Q(failure_mode__icontains=search_query) |
-                Q(bug__bug_number__icontains=search_query)
-            )
-        else:  # 无筛选条件
-            devices = Device.objects.all()
-        return devices
+        # 多字段搜索（SN前缀快速通道 + 索引化的icontains + 排序），见devices/search.py
+        return search_devices(self.get_filtered_queryset(), search_query)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(self.get_filter_context())
+        return context
+
+
+class AsyncDeviceListView(DeviceListMixin, AsyncListView):
+    """DeviceListView的异步版本（ASGI），查询和模板与同步版本相同"""
+
+    async def aget_queryset(self):
+        return await asearch_devices(self.get_filtered_queryset(), self.request.GET.get('q', ''))
+
+    async def aget_context_data(self, **kwargs):
+        context = await super().aget_context_data(**kwargs)
+        context.update(self.get_filter_context())
+        context['nodes'] = [node async for node in context['nodes'].aiterator()]
+        return context
 
 
 class DeviceDetailView(DetailView):
@@ -59,28 +99,96 @@ class PositionCreateView(CreateView):
     form_class = PositionForm
 
     def form_valid(self, form):
-        # 更新device的current_position字段
-        position = form.cleaned_data['position']
-        device = form.cleaned_data['device']
-        device.current_position = position
-        device.save()
-        return super().form_valid(form) # 创建PositionTracking表的记录(由表单的save方法完成),并重定向到success_url
+        # 追加位置记录、结束上一段停留、更新设备的current_position（只写这一列）并同步状态投影，见devices/positions.py
+        self.object = record_move(form.save(commit=False))
+        return redirect(self.get_success_url())
 
 
     def get_success_url(self):  # 带参数的success_url要重写get_success_url方法，用kwargs字典携带参数
         return reverse_lazy('devices:position_tracking',kwargs={'pk':self.object.device.pk})
 
 
-class PositionListView(ListView):
+class PositionListMixin:
+    """单台设备的位置记录，同步和异步的列表共用：最新的在前，走(device, created_at)索引，分页"""
     context_object_name = 'positions'
     template_name = 'devices/position_list.html'
+    paginate_by = 50
+
+    @staticmethod
+    def get_positions(device):
+        return PositionTracking.objects.filter(device=device).select_related('device', 'owner') \
+            .order_by('-created_at')
+
+
+class PositionListView(PositionListMixin, ListView):
 
     def get_queryset(self): # 默认返回全部的位置变更记录，但这没意义，需要的是当前设备的位置变更记录
         # 路由路径参数：FBV中直接作为视图函数参数接收，CBV中通过self.kwargs获取；
         # URL查询参数（?key = value）：通过request.GET.get('key')获取（注意是request.GET)
         device_pk = self.kwargs.get('pk') # 视图中通过self.kwargs获取路径参数
-        device = Device.objects.get(pk=device_pk)
-        return PositionTracking.objects.filter(device=device).order_by('created_at')
+        device = get_object_or_404(Device.objects.only('pk'), pk=device_pk)
+        return self.get_positions(device)
+
+
+class AsyncPositionListView(PositionListMixin, AsyncListView):
+    """PositionListView的异步版本（ASGI）"""
+
+    async def aget_queryset(self):
+        device = await aget_object_or_404(Device.objects.only('pk'), pk=self.kwargs.get('pk'))
+        return self.get_positions(device)
+
+
+class TrajectoryView(LoginRequiredMixin, View):
+    """
+    多台设备的位置轨迹：GET ?sn=<SN>&sn=<SN>...&start=<ISO时间>&end=<ISO时间>
+    返回 {'devices': {SN: [{'position', 'start', 'end'}, ...]}}，连续相同位置已合并，end为null表示仍在该位置
+    """
+    max_devices = 500
+
+    def get(self, request):
+        sns = request.GET.getlist('sn')[:self.max_devices]
+        try:
+            start, end = parse_window(request.GET)
+        except ValueError as e:
+            return JsonResponse({'error': f'参数格式错误:{e}'}, status=400)
+        devices = dict(Device.objects.filter(sn__in=sns).values_list('pk', 'sn'))
+        stays = trajectories(list(devices), start, end)
+        return JsonResponse({'devices': {
+            devices[device_id]: [stay._asdict() for stay in device_stays] for device_id, device_stays in stays.items()
+        }})
+
+
+class LocatedDevicesView(LoginRequiredMixin, View):
+    """某段时间内在某个位置的设备：GET ?position=<位置>&start=<ISO时间>&end=<ISO时间>，返回 {'devices': [SN, ...]}"""
+
+    def get(self, request):
+        position = request.GET.get('position', '').strip()
+        try:
+            start, end = parse_window(request.GET)
+            if not position or start is None or end is None:
+                raise ValueError('position、start、end都不能为空')
+        except ValueError as e:
+            return JsonResponse({'error': f'参数格式错误:{e}'}, status=400)
+        device_ids = devices_at(position, start, end)
+        return JsonResponse({'devices': list(Device.objects.filter(pk__in=device_ids).order_by('pk')
+                                             .values_list('sn', flat=True))})
+
+
+def parse_window(params):
+    """解析查询参数中的start/end（ISO格式，不带时区时按当前时区），没传时为None，格式不对时抛出ValueError"""
+    window = []
+    for name in ('start', 'end'):
+        value = params.get(name)
+        if not value:
+            window.append(None)
+            continue
+        moment = parse_datetime(value)
+        if moment is None:
+            raise ValueError(f'{name}应为ISO格式的时间:{value}')
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        window.append(moment)
+    return window
 
 
 class PositionUpdateView(UpdateView):
@@ -88,8 +196,12 @@ class PositionUpdateView(UpdateView):
     context_object_name = 'position'
     pk_url_kwarg = 'position_pk'   # 用于指定querySet方法中的默认主键参数名
     model = PositionTracking
-    form_class = PositionForm
+    form_class = PositionUpdateForm  # 设备不可修改
 
+    def form_valid(self, form):
+        # 改的是当前位置时同步设备的current_position和状态投影，见devices/positions.py
+        self.object = update_move(form.save(commit=False))
+        return redirect(self.get_success_url())
 
     def get_success_url(self):
         device_pk = self.kwargs.get('pk')
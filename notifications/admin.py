@@ -1,3 +1,7 @@
 from django.contrib import admin
 
+from notifications.models import EmailInfo, Notification
+
 # Register your models here.
+admin.site.register(EmailInfo)
+admin.site.register(Notification)
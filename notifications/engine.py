@@ -0,0 +1,143 @@
+# notifications/engine.py
+import logging
+from datetime import timedelta
+from itertools import groupby
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from notifications.models import EmailInfo, Notification
+from workflows.jobs import enqueue, job
+
+"""
+    通知引擎：流程事件 → 待发送通知 → 按收件人合并的汇总邮件
+        1、产生：notify()在触发事件的请求里只做一次bulk_create（未发送的通知按(收件人, dedup_key)去重）+ 入队一个发送任务，
+           不连SMTP；写入失败只记日志，不影响流转
+        2、合并：发送任务按时间窗口入队（幂等键为窗口序号），DIGEST_WINDOW秒内同一个收件人的全部通知合并成一封邮件，
+           在窗口结束时由 manage.py run_jobs 执行
+        3、发送：send_digests()按收件人分块读取未发送的通知，整个任务共用一条SMTP连接；
+           任务不包在一个大事务里（@job(atomic=False)），每封邮件发出后立即用一个短事务标记已发送并写EmailInfo：
+           不会在SMTP I/O期间持有通知行上的锁（否则同一个(收件人, dedup_key)的notify()要等到整个任务结束），
+           中途出错也只重发出错之后的收件人，已发出的不会因为回滚而重复发送；发送失败的通知留到下一个窗口重发，
+           每失败一次attempts加1，达到MAX_ATTEMPTS后放弃（sent_at和failed_at同时设置），
+           不会因为一个永远发不出去的地址每个窗口都入队一个发送任务、连一次SMTP
+    开发时可以用本地调试SMTP（python -m aiosmtpd -n -l localhost:1025）代替真实邮件服务器，测试使用Django的locmem邮件后端
+"""
+logger = logging.getLogger(__name__)
+
+DIGEST_WINDOW = getattr(settings, 'NOTIFICATION_DIGEST_WINDOW', 60)  # 秒
+BATCH_SIZE = getattr(settings, 'NOTIFICATION_BATCH_SIZE', 500)  # 每块的收件人数
+SUBJECT_PREFIX = getattr(settings, 'NOTIFICATION_SUBJECT_PREFIX', '[异常设备追踪]')
+MAX_ATTEMPTS = getattr(settings, 'NOTIFICATION_MAX_ATTEMPTS', 5)  # 同一条通知最多发送几次
+SEND_JOB = 'notifications.send_digests'
+
+
+def _schedule(now=None):
+    """入队now所在窗口的发送任务，同一个窗口只入队一次"""
+    now = now or timezone.now()
+    window = int(now.timestamp() // DIGEST_WINDOW)
+    delay = (window + 1) * DIGEST_WINDOW - now.timestamp()
+    enqueue(SEND_JOB, key=f'notifications:digest:{window}', delay=delay)
+
+
+def notify(recipients, event, message, dedup_key, actor=None):
+    """给recipients（Employee列表）各产生一条通知，返回是否写入成功"""
+    recipients = [recipient for recipient in recipients if recipient is not None and recipient != actor]
+    if not recipients:
+        return True
+    try:
+        # 保存点：写入失败只回滚通知本身，不影响触发事件的流转
+        with transaction.atomic():
+            Notification.objects.bulk_create([
+                Notification(recipient=recipient, actor=actor, event=event, message=message, dedup_key=dedup_key)
+                for recipient in recipients
+            ], ignore_conflicts=True)
+            _schedule()
+    except Exception:
+        logger.exception("通知写入失败 | 事件:%s 去重键:%s", event, dedup_key)
+        return False
+    return True
+
+
+def _render(recipient, items):
+    subject = f'{SUBJECT_PREFIX} 你有{len(items)}条新通知'
+    lines = [f'{recipient.name or recipient.username}，你好：', '']
+    for item in items:
+        created = timezone.localtime(item.created_at).strftime('%Y-%m-%d %H:%M')
+        lines.append(f'[{created}] {item.get_event_display()}：{item.message}')
+    return subject, '\n'.join(lines)
+
+
+def _reconnect(connection):
+    try:
+        connection.close()
+        connection.open()
+    except Exception:
+        logger.exception("SMTP重连失败")
+
+
+def _mark_sent(items, record):
+    """一封邮件发出后的短事务：标记这些通知已发送，写发送记录（record为None时只标记）"""
+    with transaction.atomic():
+        Notification.objects.filter(pk__in=[item.pk for item in items]).update(sent_at=timezone.now())
+        if record is not None:
+            record.save()
+
+
+def _mark_failed(items):
+    """一封邮件发送失败后的短事务：失败次数加1，达到MAX_ATTEMPTS的放弃，返回放弃的通知数"""
+    pks = [item.pk for item in items]
+    now = timezone.now()
+    with transaction.atomic():
+        Notification.objects.filter(pk__in=pks).update(attempts=F('attempts') + 1)
+        return Notification.objects.filter(pk__in=pks, attempts__gte=MAX_ATTEMPTS).update(sent_at=now, failed_at=now)
+
+
+@job(SEND_JOB, atomic=False)
+def send_digests(batch_size=BATCH_SIZE):
+    """发送全部未发送的通知，每个收件人一封汇总邮件，返回 (发出的邮件数, 失败的通知数)"""
+    sent = failed = given_up = 0
+    last_recipient = 0
+    connection = get_connection(fail_silently=False)
+    with connection:  # 整个任务共用一条SMTP连接
+        while True:
+            recipient_ids = list(
+                Notification.objects.filter(sent_at__isnull=True, recipient_id__gt=last_recipient)
+                .order_by('recipient_id').values_list('recipient_id', flat=True).distinct()[:batch_size]
+            )
+            if not recipient_ids:
+                break
+            last_recipient = recipient_ids[-1]
+            pending = Notification.objects.filter(sent_at__isnull=True, recipient_id__in=recipient_ids) \
+                .select_related('recipient', 'actor').order_by('recipient_id', 'pk')
+            for _, group in groupby(pending, key=lambda item: item.recipient_id):
+                items = list(group)
+                recipient = items[0].recipient
+                if not recipient.is_active or not recipient.email:
+                    _mark_sent(items, None)  # 没有邮箱的收件人直接丢弃，避免每个窗口重试
+                    continue
+                subject, body = _render(recipient, items)
+                try:
+                    connection.send_messages([EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, [recipient.email])])
+                except Exception as e:
+                    failed += len(items)
+                    dropped = _mark_failed(items)
+                    given_up += dropped
+                    if dropped:
+                        logger.error("通知邮件发送失败%s次，放弃 | 收件人:%s 通知数:%s 错误:%s",
+                                     MAX_ATTEMPTS, recipient.email, dropped, e)
+                    else:
+                        logger.warning("通知邮件发送失败，下一个窗口重发 | 收件人:%s 错误:%s", recipient.email, e)
+                    _reconnect(connection)
+                    continue
+                sent += 1
+                actors = {item.actor for item in items}
+                sender = actors.pop() if len(actors) == 1 else None  # 多个操作人时记为系统发出
+                _mark_sent(items, EmailInfo(sender=sender, receiver=recipient, description=f'{subject}\n{body}'))
+    if failed > given_up:  # 还有没放弃的失败通知才入队下一个窗口
+        _schedule(timezone.now() + timedelta(seconds=DIGEST_WINDOW))
+    logger.info("通知汇总邮件发送完成 | 邮件:%s 失败通知:%s 放弃:%s", sent, failed, given_up)
+    return sent, failed
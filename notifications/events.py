@@ -0,0 +1,41 @@
+# notifications/events.py
+from accounts.models import Employee
+from notifications.engine import notify
+from notifications.models import Notification
+from workflows.actions import SUPERVISOR_ROLE
+from workflows.models import DeviceProcess
+
+"""
+    流程事件 → 通知：由分配/提交/审核视图在流转完成后调用，只写通知表，不发邮件（发送见notifications/engine.py）
+"""
+
+
+def _describe(task):
+    sn = DeviceProcess.objects.filter(pk=task.process_id).values_list('device__sn', flat=True).first()
+    return f'设备{sn or "-"}（流程{task.process_id}）的【{task.flow_task.name}】任务'
+
+
+def task_assigned(task, assignee, actor):
+    """任务分配给assignee：通知被分配人"""
+    return notify([assignee], Notification.Event.ASSIGNED, f'{actor}把{_describe(task)}分配给了你',
+                  f'assigned:{task.pk}:{assignee.pk}', actor=actor)
+
+
+def approvers(user):
+    """user提交的数据由同部门的部门主管审核；没有部门时通知全部部门主管"""
+    queryset = Employee.objects.filter(groups__name=SUPERVISOR_ROLE, is_active=True)
+    if user.department_id is not None:
+        queryset = queryset.filter(department_id=user.department_id)
+    return list(queryset.distinct())
+
+
+def task_submitted(task, actor):
+    """数据已提交，等待审核：通知审核人；同一个任务未发出的提交通知只保留一条"""
+    return notify(approvers(actor), Notification.Event.SUBMITTED, f'{actor}提交了{_describe(task)}的数据，等待审核',
+                  f'submitted:{task.pk}', actor=actor)
+
+
+def task_rejected(task, actor):
+    """审核驳回：通知任务处理人"""
+    return notify([task.owner], Notification.Event.REJECTED, f'{actor}驳回了{_describe(task)}，请重新提交',
+                  f'rejected:{task.pk}', actor=actor)
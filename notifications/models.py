@@ -5,9 +5,48 @@ from django.db import models
 # Create your models here.
 '''
 邮件信息存储类：ID、发送方、接收方、邮件描述、发送时间
+    每发出一封汇总邮件记一条，sender为空表示系统发出（汇总里有多个操作人）
+通知Notification：流程事件（分配、提交待审核、驳回）产生的待发送通知，由后台任务按收件人合并成汇总邮件发送，详见notifications/engine.py
 '''
 class EmailInfo(models.Model):
-       sender = models.ForeignKey('accounts.Employee', on_delete=models.CASCADE,to_field='email',related_name='sent_emails')
+       sender = models.ForeignKey('accounts.Employee', on_delete=models.CASCADE,to_field='email',related_name='sent_emails',null=True,blank=True)
        receiver = models.ForeignKey('accounts.Employee', on_delete=models.CASCADE,to_field='email',related_name='received_emails')
        description = models.TextField() # 邮件描述信息
-       created_at = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+       created_at = models.DateTimeField(auto_now_add=True)
+
+
+class Notification(models.Model):
+    class Event(models.TextChoices):
+        ASSIGNED = 'assigned', '任务分配'
+        SUBMITTED = 'submitted', '提交待审核'
+        REJECTED = 'rejected', '审核驳回'
+
+    recipient = models.ForeignKey('accounts.Employee', on_delete=models.CASCADE, related_name='notifications')
+    actor = models.ForeignKey('accounts.Employee', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    event = models.CharField(max_length=20, choices=Event.choices)
+    message = models.TextField()
+    # 去重键：同一个收件人未发送的通知中，相同的键只保留第一条（例如同一个任务被反复提交）
+    dedup_key = models.CharField(max_length=200)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    # 发送失败次数；达到NOTIFICATION_MAX_ATTEMPTS后放弃：sent_at和failed_at同时设置（不再参与发送和去重，但能区分没有送达）
+    attempts = models.PositiveSmallIntegerField(default=0)
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = '通知'
+        verbose_name_plural = '通知列表'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['recipient', 'dedup_key'], condition=models.Q(sent_at__isnull=True),
+                name='notification_pending_unique',
+            ),
+        ]
+        indexes = [
+            # 发送任务按收件人分块读取未发送的通知
+            models.Index(fields=['recipient', 'id'], condition=models.Q(sent_at__isnull=True),
+                         name='notification_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.recipient_id}:{self.event}:{self.dedup_key}"
@@ -1,3 +1,161 @@
-from django.test import TestCase
+from unittest import mock
+
+from django.contrib.auth.models import Group
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from viewflow.workflow import STATUS
 
 # Create your tests here.
+from accounts.models import Employee
+from departments.models import Department
+from devices.models import Device
+from notifications import engine, events
+from notifications.engine import notify, send_digests
+from notifications.models import EmailInfo, Notification
+from workflows.BaseView import DirectAssignView
+from workflows.flows import DeviceInvestigationFlow
+from workflows import jobs
+from workflows.jobs import run_due_jobs
+from workflows.models import DeviceProcess, DeviceTask, Job
+
+
+def create_employee(username, **kwargs):
+    return Employee.objects.create_user(username=username, password='password', email=f'{username}@example.com',
+                                        number=username[:10], **kwargs)
+
+
+class FlakyBackend(EmailBackend):
+    """发给bad@example.com的邮件失败，其余正常"""
+
+    def send_messages(self, messages):
+        if any('bad@example.com' in message.to for message in messages):
+            raise OSError('connection reset')
+        return super().send_messages(messages)
+
+
+class NotificationDigestTest(TestCase):
+    def setUp(self):
+        self.actor = create_employee('actor')
+        self.alice = create_employee('alice')
+        self.bob = create_employee('bob')
+
+    def test_burst_is_deduplicated_and_coalesced(self):
+        notify([self.alice, self.bob], Notification.Event.SUBMITTED, '提交1', 'submitted:1', actor=self.actor)
+        notify([self.alice], Notification.Event.SUBMITTED, '提交1（重复）', 'submitted:1', actor=self.actor)
+        notify([self.alice], Notification.Event.ASSIGNED, '分配2', 'assigned:2', actor=self.actor)
+        notify([self.actor], Notification.Event.ASSIGNED, '自己', 'assigned:3', actor=self.actor)  # 不通知操作人自己
+        self.assertEqual(3, Notification.objects.count())
+        # 同一个窗口只入队一个发送任务，且没有在请求中发信
+        self.assertEqual(1, Job.objects.filter(name='notifications.send_digests').count())
+        self.assertEqual([], mail.outbox)
+
+        with mock.patch.object(EmailBackend, 'open', autospec=True, side_effect=EmailBackend.open) as opened:
+            self.assertEqual((2, 0), send_digests())
+        self.assertEqual(1, opened.call_count)  # 全部邮件共用一条连接
+        by_recipient = {message.to[0]: message for message in mail.outbox}
+        self.assertEqual({'alice@example.com', 'bob@example.com'}, set(by_recipient))
+        self.assertIn('2条', by_recipient['alice@example.com'].subject)
+        self.assertNotIn('重复', by_recipient['alice@example.com'].body)
+        self.assertFalse(Notification.objects.filter(sent_at__isnull=True).exists())
+        self.assertEqual({('actor@example.com', 'alice@example.com'), ('actor@example.com', 'bob@example.com')},
+                         set(EmailInfo.objects.values_list('sender_id', 'receiver_id')))
+
+        # 已发送的通知不再参与去重
+        notify([self.alice], Notification.Event.SUBMITTED, '提交1', 'submitted:1', actor=self.actor)
+        self.assertEqual(1, Notification.objects.filter(sent_at__isnull=True).count())
+
+    def test_failed_recipient_is_retried_next_window(self):
+        bad = create_employee('bad')
+        notify([self.alice, bad], Notification.Event.REJECTED, '驳回', 'rejected:1', actor=self.actor)
+        with self.settings(EMAIL_BACKEND='notifications.tests.FlakyBackend'):
+            self.assertEqual((1, 1), send_digests())
+        self.assertEqual([bad.pk], list(Notification.objects.filter(sent_at__isnull=True)
+                                        .values_list('recipient_id', flat=True)))
+        self.assertEqual(2, Job.objects.filter(name='notifications.send_digests').count())
+
+    def test_bad_address_is_given_up_after_max_attempts(self):
+        bad = create_employee('bad')
+        notify([bad], Notification.Event.REJECTED, '驳回', 'rejected:1', actor=self.actor)
+        with self.settings(EMAIL_BACKEND='notifications.tests.FlakyBackend'):
+            for _ in range(engine.MAX_ATTEMPTS - 1):
+                send_digests()
+            notification = Notification.objects.get()
+            self.assertEqual((engine.MAX_ATTEMPTS - 1, None), (notification.attempts, notification.sent_at))
+            Job.objects.all().delete()
+            self.assertEqual((0, 1), send_digests())
+        notification.refresh_from_db()
+        self.assertIsNotNone(notification.failed_at)
+        self.assertEqual(notification.failed_at, notification.sent_at)
+        self.assertFalse(Job.objects.exists())  # 放弃后不再入队下一个窗口
+        self.assertEqual((0, 0), send_digests())
+
+    def test_read_queries_do_not_grow_with_recipients(self):
+        # 每封邮件发出后各自提交标记（写），读取仍按块批量，不随收件人数增长
+        def count_reads(recipients):
+            notify(recipients, Notification.Event.SUBMITTED, '提交', f'submitted:{len(recipients)}', actor=self.actor)
+            with CaptureQueriesContext(connection) as queries:
+                send_digests(batch_size=100)
+            return sum(query['sql'].lstrip().upper().startswith('SELECT') for query in queries)
+
+        few = count_reads([self.alice, self.bob])
+        many = count_reads([create_employee(f'user{i}') for i in range(20)])
+        self.assertEqual(few, many)
+
+    def test_sent_mail_stays_marked_when_task_fails_later(self):
+        notify([self.alice, self.bob], Notification.Event.SUBMITTED, '提交', 'submitted:1', actor=self.actor)
+        render = engine._render
+
+        def fail_for_bob(recipient, items):
+            if recipient == self.bob:
+                raise RuntimeError('模板错误')
+            return render(recipient, items)
+
+        with mock.patch.object(engine, '_render', side_effect=fail_for_bob), self.assertRaises(RuntimeError):
+            send_digests()
+        # alice的邮件已经发出，标记没有随任务失败回滚，重试时只发bob
+        self.assertEqual(['alice@example.com'], [message.to[0] for message in mail.outbox])
+        self.assertEqual([self.bob.pk], list(Notification.objects.filter(sent_at__isnull=True)
+                                             .values_list('recipient_id', flat=True)))
+        self.assertEqual(1, EmailInfo.objects.count())
+
+    def test_send_job_is_not_wrapped_in_one_transaction(self):
+        self.assertFalse(jobs.registry['notifications.send_digests'].job_atomic)
+
+
+class WorkflowNotificationTest(TestCase):
+    def setUp(self):
+        self.supervisor = create_employee('supervisor')
+        self.department = Department.objects.create(name='FAE', manager_number=self.supervisor, telephone='1')
+        self.supervisor.department = self.department
+        self.supervisor.save()
+        self.supervisor.groups.add(Group.objects.create(name='部门主管'))
+        self.staff = create_employee('staff', department=self.department)
+        device = Device.objects.create(sn='NOTIFY001')
+        process = DeviceProcess.objects.create(device=device, flow_class=DeviceInvestigationFlow)
+        self.task = DeviceTask.objects.create(process=process, flow_task=DeviceInvestigationFlow.FAE_initial_retest,
+                                              status=STATUS.NEW)
+
+    def test_assign_view_notifies_assignee_without_sending(self):
+        request = RequestFactory().post('/', {'user_id': self.staff.pk})
+        request.user = self.supervisor
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        response = DirectAssignView.as_view()(request, process_pk=self.task.process_id, task_pk=self.task.pk)
+        self.assertEqual(302, response.status_code)
+        notification = Notification.objects.get()
+        self.assertEqual((self.staff, Notification.Event.ASSIGNED), (notification.recipient, notification.event))
+        self.assertIn('NOTIFY001', notification.message)
+        self.assertEqual([], mail.outbox)
+
+        Job.objects.update(run_at=notification.created_at)  # 窗口结束，worker发送
+        run_due_jobs()
+        self.assertEqual(['staff@example.com'], mail.outbox[0].to)
+
+    def test_submission_notifies_department_supervisors(self):
+        create_employee('other_supervisor').groups.add(Group.objects.get(name='部门主管'))
+        events.task_submitted(self.task, self.staff)
+        self.assertEqual([self.supervisor.pk], list(Notification.objects.values_list('recipient_id', flat=True)))
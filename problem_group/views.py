@@ -2,6 +2,7 @@ from django.urls import reverse_lazy
 from django.utils import timezone
 from django.views.generic import DetailView, UpdateView, CreateView, ListView
 
+from abnormal_device_tracking.async_views import AsyncListView
 from problem_group.forms import BugForm
 from problem_group.models import Bug
 
@@ -13,6 +14,15 @@ class BugListView(ListView):
     context_object_name = 'bugs'
 
 
+class AsyncBugListView(AsyncListView):
+    """BugListView的异步版本（ASGI），模板只用到Bug自身的字段"""
+    template_name = 'bug/bug_list.html'
+    context_object_name = 'bugs'
+
+    def get_queryset(self):
+        return Bug.objects.all()
+
+
 class BugDetailView(DetailView):
     template_name = 'bug/bug_detail.html'
     context_object_name = 'bug'
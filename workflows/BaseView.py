@@ -1,23 +1,36 @@
 import logging
 
 from django.contrib import messages
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
 from django.utils.timezone import now
 from viewflow.workflow.flow import View as NodeView
 from django.views.generic import View, ListView, DetailView
 from viewflow.workflow import Activation, STATUS
-from viewflow.workflow.flow.views import UpdateProcessView, DashboardProcessListView
+from viewflow.workflow.activation import has_manage_permission
+from viewflow.workflow.flow.views import UpdateProcessView, DashboardProcessListView, DashboardView
 from viewflow.workflow.models import Process, Task
 from viewflow.workflow.nodes import ViewActivation
 from viewflow.workflow.signals import task_started
 
+from abnormal_device_tracking import tracing
+from abnormal_device_tracking.async_views import AsyncListView
+from abnormal_device_tracking.metrics import time_transition
+from abnormal_device_tracking.utils import TraceViewMixin
 from accounts.models import Employee
+from notifications import events as notification_events
 from devices.models import OperationRecord, AnalysisResults
+from workflows.actions import DashboardActionResolver
+from workflows.exports import export
+from workflows.intake import DeviceIntake, FORMATS as INTAKE_FORMATS, parse_rows, text_stream
 from workflows.models import DeviceTask, DeviceProcess
+from workflows.state import refresh_device_states
 
 
-class CustomProcessView(UpdateProcessView):
+class CustomProcessView(TraceViewMixin, UpdateProcessView):
     """用于提前获取process和task对象，以及兼容ModelForm和普通表单"""
 
     '''
@@ -35,13 +48,11 @@ class CustomProcessView(UpdateProcessView):
             # 初始化 process
             process_pk = self.kwargs.get('process_pk')
             self.process = DeviceProcess.objects.get(pk=process_pk)
-            print(f"成功获取process: {self.process.pk}")
             # 初始化 task（从 request.activation 中获取）
             self.task = self.request.activation.task
-            print(f"成功获取task: {self.task.pk}")
-            print(f"[{timezone.now()}] setup阶段: self.process = {self.process.pk if self.process else 'None'}")
+            logger.debug("setup阶段: process=%s task=%s", self.process.pk, self.task.pk)
         except Exception as e:
-            print(f"获取process或task失败: {str(e)}")
+            logger.warning("获取process或task失败: %s", e)
             self.process = None
             self.task = None  # 避免后续属性不存在错误
 
@@ -52,6 +63,14 @@ class CustomProcessView(UpdateProcessView):
             如果注释get_form_kwargs方法，在请求普通表单（继承自forms.Form）时会报错。
     '''
 
+    def dispatch(self, request, *args, **kwargs):
+        submitted = getattr(self.task, 'data_submitted', None)
+        response = super().dispatch(request, *args, **kwargs)
+        # 各节点视图提交数据时把data_submitted改为True，此时任务等待审核，通知审核人
+        if submitted is False and getattr(self.task, 'data_submitted', False):
+            notification_events.task_submitted(self.task, request.user)
+        return response
+
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
         # 如果表单不是 ModelForm，移除 instance 参数
@@ -61,7 +80,7 @@ class CustomProcessView(UpdateProcessView):
 
 logger = logging.getLogger(__name__)
 
-class DirectAssignView(View): # 简单CRUD操作 + 特定业务逻辑的场景，继承View是最直接、最清晰的选择
+class DirectAssignView(TraceViewMixin, View): # 简单CRUD操作 + 特定业务逻辑的场景，继承View是最直接、最清晰的选择
     """任务分配视图"""
 
     def get(self, request, process_pk, node_name, task_pk):   # 参数来自get请求中的URL
@@ -107,6 +126,7 @@ class DirectAssignView(View): # 简单CRUD操作 + 特定业务逻辑的场景
                 '''
                 activation.assign(assigned_user)
             logging.info(f"🔹 任务 {task.pk} 绑定的节点: {task.flow_task},任务已分配给 {task.owner}")
+            notification_events.task_assigned(task, assigned_user, request.user)
             messages.success(request, f"任务已分配给 {task.owner}")
         except Employee.DoesNotExist:
             messages.error(request, "选择的员工不存在")
@@ -114,7 +134,7 @@ class DirectAssignView(View): # 简单CRUD操作 + 特定业务逻辑的场景
 
 
 
-class BaseApprovalView(View):
+class BaseApprovalView(TraceViewMixin, View):
     """审核视图"""
     template_name = "workflows/supervisor_approval.html"  # 所有节点共用一个模板
 
@@ -138,9 +158,7 @@ class BaseApprovalView(View):
                 ).order_by('-created_at').first()
 
             except Exception as e:
-                print(f"❌ 获取数据失败: {e}")
-        else:
-            print('task:',task)
+                logger.warning("获取数据失败 | task:%s | 异常:%s", task.pk, e)
 
         return render(request, self.template_name, {
             "task": task,
@@ -163,15 +181,22 @@ class BaseApprovalView(View):
             messages.success(request, f"【{node_name}】审核通过")
         elif action == "reject":
             # 驳回：回滚到待提交状态
-            task.status = "ASSIGNED"   # 这里改为ASSIGNED了，但是本身就是一次post请求，会调用start方法马上变成STARTED
-            deviceTask.data_submitted = False
-            task.save()
-            deviceTask.save()
+            with transaction.atomic():
+                task.status = "ASSIGNED"   # 这里改为ASSIGNED了，但是本身就是一次post请求，会调用start方法马上变成STARTED
+                deviceTask.data_submitted = False
+                task.save()
+                deviceTask.save(update_fields=['data_submitted'])  # 只写子表字段，否则会用旧的status覆盖上面的驳回
+                device_id = DeviceProcess.objects.values_list('device_id', flat=True).get(pk=process_pk)
+                refresh_device_states(device_id)  # 同一事务内更新设备当前状态投影
+            notification_events.task_rejected(task, request.user)
             messages.success(request, f"【{node_name}】已驳回")
 
         return redirect("deviceinvestigation:index")  # 审核后返回任务列表
 
 def is_data_submitted(task):
+    # activation.task本身就是DeviceTask时（task.activation()已经refresh_from_db，或dashboard批量预加载），直接读字段，不再重复查询
+    if isinstance(task, DeviceTask):
+        return task.data_submitted
     deviceTask = get_object_or_404(DeviceTask, pk=task.pk)
     return deviceTask.data_submitted
 
@@ -188,9 +213,44 @@ class CustomViewActivation(ViewActivation):
     )
     def assign(self, user):
         """Assign user to the task."""
-        self.task.owner = user
-        self.task.assigned = now()
-        self.task.save()
+        with time_transition(self.flow_task.name, 'assign'), \
+                tracing.span('transition.assign', node=self.flow_task.name, task=self.task.pk), transaction.atomic():
+            self.task.owner = user
+            self.task.assigned = now()
+            self.task.save()
+            refresh_device_states(self.process.device_id)  # 同一事务内更新设备当前状态投影
+
+
+    @Activation.status.transition(
+        source=STATUS.ASSIGNED,
+        target=STATUS.NEW,
+        permission=lambda activation, user: activation.flow_task.can_unassign(
+            user, activation.task
+        ),
+    )
+    def unassign(self):
+        """Remove user from the task assignment."""
+        with time_transition(self.flow_task.name, 'unassign'), \
+                tracing.span('transition.unassign', node=self.flow_task.name, task=self.task.pk), transaction.atomic():
+            self.task.owner = None
+            self.task.save()
+            refresh_device_states(self.process.device_id)
+
+
+    @Activation.status.transition(
+        source=STATUS.ASSIGNED,
+        permission=lambda activation, user: activation.flow_task.can_unassign(
+            user, activation.task
+        ),
+    )
+    def reassign(self, user=None):
+        """Reassign to another user."""
+        with time_transition(self.flow_task.name, 'reassign'), \
+                tracing.span('transition.reassign', node=self.flow_task.name, task=self.task.pk), transaction.atomic():
+            if user:
+                self.task.owner = user
+            self.task.save()
+            refresh_device_states(self.process.device_id)
 
 
     @Activation.status.transition(
@@ -203,11 +263,13 @@ class CustomViewActivation(ViewActivation):
         ),
     )
     def start(self, request):
-        print('start被调用了')
         # TODO request.GET['started']
-        task_started.send(sender=self.flow_class, process=self.process, task=self.task)
-        self.task.started = now()
-        self.task.save()
+        with time_transition(self.flow_task.name, 'start'), \
+                tracing.span('transition.start', node=self.flow_task.name, task=self.task.pk), transaction.atomic():
+            task_started.send(sender=self.flow_class, process=self.process, task=self.task)
+            self.task.started = now()
+            self.task.save()
+            refresh_device_states(self.process.device_id)
 
 
     @Activation.status.transition(
@@ -219,8 +281,43 @@ class CustomViewActivation(ViewActivation):
     )
     def complete(self):
         """Complete task and create next."""
-        super().complete.original()
-        self.activate_next()
+        with time_transition(self.flow_task.name, 'complete'), \
+                tracing.span('transition.complete', node=self.flow_task.name, task=self.task.pk), transaction.atomic():
+            super().complete.original()
+            self.activate_next()
+            # 下一个节点（或结束节点）已经激活，投影指向新的当前节点
+            refresh_device_states(self.process.device_id)
+
+
+    @Activation.status.transition(
+        source=[STATUS.NEW, STATUS.ASSIGNED],
+        target=STATUS.CANCELED,
+        permission=has_manage_permission,
+    )
+    def cancel(self):
+        with time_transition(self.flow_task.name, 'cancel'), \
+                tracing.span('transition.cancel', node=self.flow_task.name, task=self.task.pk), transaction.atomic():
+            self.task.finished = now()
+            self.task.save()
+            refresh_device_states(self.process.device_id)
+
+
+    @Activation.status.super()
+    def undo(self):
+        with time_transition(self.flow_task.name, 'undo'), \
+                tracing.span('transition.undo', node=self.flow_task.name, task=self.task.pk), transaction.atomic():
+            super().undo.original()
+            refresh_device_states(self.process.device_id)
+
+
+    @Activation.status.super()
+    def revive(self):
+        # 重新创建并激活已取消的task，投影指向新的task
+        with time_transition(self.flow_task.name, 'revive'), \
+                tracing.span('transition.revive', node=self.flow_task.name, task=self.task.pk), transaction.atomic():
+            task = super().revive.original()
+            refresh_device_states(self.process.device_id)
+        return task
 
 
     @Activation.status.transition(
@@ -237,29 +334,176 @@ class CustomView(NodeView):
     activation_class = CustomViewActivation
 
 
-# ProcessListView是针对DeviceProcess写的CRUD的列表查询操作
-class ProcessListView(ListView):
+class DeviceDashboardView(DashboardView):
+    """流程dashboard：所有任务卡片的操作按钮由DashboardActionResolver一次性批量计算"""
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        resolver = DashboardActionResolver(self.request.user)
+        # 每一列的tasks是切片后的queryset，先取出所有列的任务一起解析，再按原来的数量放回各列
+        columns = context['columns']
+        column_tasks = [list(column['tasks']) for column in columns]
+        preloaded = iter(resolver.annotate(task for tasks in column_tasks for task in tasks))
+        for column, tasks in zip(columns, column_tasks):
+            column['tasks'] = [next(preloaded) for _ in tasks]
+        return context
+
+
+class ProcessListMixin:
+    """process列表的查询和keyset游标，同步和异步的process列表共用"""
     template_name = "workflows/process_list.html"
     context_object_name = 'processes'
-    model = DeviceProcess
     paginate_by = 10
+    keyset_param = 'after'
+
+    def get_queryset(self):
+        queryset = DeviceProcess.objects.select_related('device').order_by('-id')
+        return DeviceProcess.with_current_node(queryset)
+
+    def get_keyset_cursor(self):
+        try:
+            return int(self.request.GET[self.keyset_param])
+        except (KeyError, ValueError):
+            return None
+
+    def get_keyset_context(self, context):
+        processes = list(context['object_list'])
+        if context['page_obj'] is not None:
+            has_next = context['page_obj'].has_next()
+        else:
+            has_next = self.has_next_keyset
+        # 下一页统一用keyset游标（当前页最后一行的id）
+        return {'next_cursor': processes[-1].pk if has_next and processes else None, 'keyset_param': self.keyset_param}
+
+
+# ProcessListView是针对DeviceProcess写的CRUD的列表查询操作
+class ProcessListView(ProcessListMixin, ListView):
+    """
+    process列表：设备和当前节点在同一条SQL中带出，每页的查询次数与每页条数无关
+    分页：?page=N 普通分页（COUNT + OFFSET）；?after=<id> 基于id的keyset分页，翻到很深的页也不用扫描OFFSET之前的行
+    """
+    model = DeviceProcess
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.get_keyset_cursor()
+        if cursor is None:
+            return super().paginate_queryset(queryset, page_size)
+        # 多取一条，用来判断是否还有下一页，不需要COUNT
+        rows = list(queryset.filter(pk__lt=cursor)[:page_size + 1])
+        self.has_next_keyset = len(rows) > page_size
+        return None, None, rows[:page_size], True
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(self.get_keyset_context(context))
+        return context
+
+
+class AsyncProcessListView(ProcessListMixin, AsyncListView):
+    """ProcessListView的异步版本（ASGI），分页方式和查询次数与同步版本相同"""
+
+    async def apaginate_queryset(self, queryset, page_size):
+        cursor = self.get_keyset_cursor()
+        if cursor is None:
+            return await super().apaginate_queryset(queryset, page_size)
+        rows = [row async for row in queryset.filter(pk__lt=cursor)[:page_size + 1].aiterator()]
+        self.has_next_keyset = len(rows) > page_size
+        return None, None, rows[:page_size], True
+
+    async def aget_context_data(self, **kwargs):
+        context = await super().aget_context_data(**kwargs)
+        context.update(self.get_keyset_context(context))
+        return context
 
 
 # ProcessDetailView是针对DeviceProcess写的CRUD的单个查询操作
 class ProcessDetailView(DetailView):
+    """
+    process详情：process(含设备) 1条 + 全部task(含owner) 1条 + 操作记录 1条 + 分析结果 1条，
+    操作记录/分析结果在内存中按task_id分组挂到task上，查询次数与节点数、循环次数无关
+    """
     template_name = "workflows/process_detail.html"
     model = DeviceProcess
     context_object_name = 'process'
 
+    def get_queryset(self):
+        return DeviceProcess.objects.select_related('device')
+
     # 需要的上下文数据 tasks
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        process = self.get_object()
-        tasks = DeviceTask.objects.filter(process=process).order_by('created')
-        data_tasks = DeviceTask.objects.filter(process=process,flow_task_type='HUMAN').order_by('created')
+        process = self.object  # get()中已经查过，不再重复get_object()
+        tasks = list(DeviceTask.objects.filter(process=process).select_related('owner').order_by('created'))
+        data_tasks = [task for task in tasks if task.flow_task_type == 'HUMAN']
+        DeviceTask.attach_records(data_tasks, process)
         context['tasks'] = tasks # 全部节点
         context['data_tasks'] = data_tasks # 数据节点
         return context
 
 
-
+class DeviceIntakeView(View):
+    """
+    产线异常设备批量入库接口（POST），逻辑见workflows/intake.py
+    请求体二选一：
+        1、multipart表单上传文件，字段名file
+        2、直接把CSV/JSON放在请求体里
+    格式：?format=csv|json|ndjson，不传时按Content-Type或文件扩展名判断，默认csv
+    返回：{'total', 'created', 'updated', 'started', 'skipped', 'errors': [{'row', 'sn', 'error'}]}
+    """
+    http_method_names = ['post']
+    content_type_formats = {
+        'text/csv': 'csv',
+        'application/json': 'json',
+        'application/x-ndjson': 'ndjson',
+    }
+
+    def get_format(self, request, filename=None):
+        fmt = request.GET.get('format')
+        if fmt:
+            return fmt
+        if filename and '.' in filename:
+            return filename.rsplit('.', 1)[1].lower()
+        return self.content_type_formats.get(request.content_type, 'csv')
+
+    def post(self, request):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': '请先登录'}, status=401)
+        upload = request.FILES.get('file')
+        if upload is not None:
+            fmt = self.get_format(request, upload.name)
+            binary = upload.file
+        else:
+            fmt = self.get_format(request)
+            binary = request  # HttpRequest本身就是可读的二进制流，边读边解析
+        if fmt not in INTAKE_FORMATS:
+            return JsonResponse({'error': f'不支持的格式:{fmt}'}, status=400)
+        try:
+            summary = DeviceIntake(request.user).run(parse_rows(text_stream(binary), fmt))
+        except PermissionDenied as e:
+            return JsonResponse({'error': str(e)}, status=403)
+        return JsonResponse(summary)
+
+
+class ExportView(View):
+    """
+    导出接口（GET），逻辑见workflows/exports.py
+        /deviceinvestigation/export/<devices|processes|operations|analysis>/?format=csv|xlsx&after=<id>&limit=<行数>
+    响应是流式的：边查边写，内存占用与行数无关；第一列为id，中断后用after=<最后一个完整行的id>续传
+    """
+    http_method_names = ['get']
+
+    def get(self, request, dataset):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': '请先登录'}, status=401)
+        fmt = request.GET.get('format', 'csv')
+        try:
+            after = int(request.GET['after']) if request.GET.get('after') else None
+            limit = int(request.GET['limit']) if request.GET.get('limit') else None
+            chunks, content_type = export(dataset, fmt, after, limit)
+        except ValueError as e:
+            return JsonResponse({'error': f'参数格式错误:{e}'}, status=400)
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        suffix = f'_after{after}' if after is not None else ''
+        filename = f'{dataset}_{timezone.localtime():%Y%m%d%H%M%S}{suffix}.{fmt}'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
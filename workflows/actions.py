@@ -0,0 +1,114 @@
+# workflows/actions.py
+import logging
+
+from django.urls import reverse
+
+from workflows.models import DeviceTask
+
+"""
+    dashboard的批量操作解析器
+    原来的DeviceTask.custom_actions是逐行计算的：每张任务卡片都要查一次user.groups、用task.activation()加锁并refresh_from_db、
+    懒加载process/owner，is_data_submitted条件里还要再get_object_or_404一次，几百个任务的dashboard一次就要几千条SQL。
+    DashboardActionResolver把这些工作合并到一次请求内：
+        1、用户角色每个请求只查一次
+        2、所有可见任务用一条SQL预加载（data_submitted、flow_task、status，并select_related process/owner）
+        3、一次性返回所有卡片的操作列表
+"""
+logger = logging.getLogger(__name__)
+
+# 当前用户不是部门主管时，这些操作只展示为“待主管处理”的提示
+SUPERVISOR_ROLE = '部门主管'
+
+
+class DashboardActionResolver:
+    """批量计算dashboard任务卡片的操作按钮"""
+
+    def __init__(self, user):
+        self.user = user
+        self._user_roles = None
+
+    @property
+    def user_roles(self):
+        # 每个解析器（即每个请求）只查询一次用户角色
+        if self._user_roles is None:
+            if self.user is None or not self.user.is_authenticated:
+                self._user_roles = frozenset()
+            else:
+                self._user_roles = frozenset(self.user.groups.values_list('name', flat=True))
+        return self._user_roles
+
+    def preload(self, task_pks):
+        """一条SQL加载全部可见任务，返回 {task_pk: DeviceTask}"""
+        task_pks = set(task_pks)
+        if not task_pks:
+            return {}
+        tasks = DeviceTask.objects.filter(pk__in=task_pks).select_related(
+            'process', 'process__deviceprocess', 'owner'
+        )
+        return {task.pk: task for task in tasks}
+
+    def annotate(self, tasks):
+        """
+        批量解析任务的操作列表，返回预加载后的任务实例列表（保持传入顺序）
+        每个实例的_custom_actions已经计算好，模板中访问custom_actions、owner、process不再触发查询
+        """
+        tasks = list(tasks)
+        preloaded = self.preload(task.pk for task in tasks)
+        for task in preloaded.values():
+            task._custom_actions = self.task_actions(task)
+        return [preloaded.get(task.pk, task) for task in tasks]
+
+    def resolve(self, tasks):
+        """批量解析任务的操作列表，返回 {task_pk: [(label, url), ...]}"""
+        return {
+            task.pk: task._custom_actions
+            for task in self.annotate(tasks)
+            if hasattr(task, '_custom_actions')
+        }
+
+    def task_actions(self, task):
+        """计算单个（已预加载的）任务的操作列表"""
+        user = self.user
+        if user is None or not user.is_authenticated:  # 用户未登录，不能进行任何操作
+            return []
+
+        actions = []
+        try:
+            # 只读地构造activation来计算可用转换，不需要task.activation()的加锁和refresh_from_db（任务已经是刚查出来的）
+            activation = task.flow_task.activation_class(task)
+            transitions = activation.get_available_transitions(user)
+        except Exception as e:
+            # 出错时返回空列表，让模板回退到默认逻辑
+            logger.warning("custom_actions error | task:%s | 异常:%s", task.pk, e)
+            return actions
+
+        is_supervisor = SUPERVISOR_ROLE in self.user_roles
+        for transition in transitions:
+            label = transition.label
+            if label == 'Assign':
+                url = reverse("assign", kwargs={
+                    'process_pk': task.process_id,
+                    'node_name': task.flow_task.name,
+                    'task_pk': task.pk
+                })
+                if not is_supervisor:
+                    label = '待主管分配'
+            elif label == 'Cancel':
+                url = task.flow_task.reverse('cancel', args=[task.process_id, task.pk])
+            elif label == 'Upload Data':
+                url = task.flow_task.reverse('execute', args=[task.process_id, task.pk])
+            elif label == 'Unassign':
+                url = task.flow_task.reverse('unassign', args=[task.process_id, task.pk])
+            elif label == 'Approve':
+                url = reverse("approve", kwargs={
+                    'process_pk': task.process_id,
+                    'node_name': task.flow_task.name,
+                    'task_pk': task.pk
+                })
+                if not is_supervisor:  # 普通员工
+                    label = '待主管审核'
+            else:
+                # Reassign: viewflow中虽然提供了名为reassign的状态转换函数，但并没有处理reassign的路由
+                continue
+            actions.append((label, url))
+        return actions
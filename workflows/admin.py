@@ -1,10 +1,11 @@
 from django.contrib import admin
 
-from workflows.models import DeviceProcess, DeviceTask
+from workflows.models import DeviceProcess, DeviceTask, Job
 
 # Register your models here.
 admin.site.register(DeviceProcess)
 admin.site.register(DeviceTask)
+admin.site.register(Job)
 
 '''
 tips: 在django-viewflow中，viewflow/workflow/admin.py中实现了Process model和Task model的admin注册，
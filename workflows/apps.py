@@ -4,3 +4,24 @@ from django.apps import AppConfig
 class WorkflowsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'workflows'
+
+    def ready(self):
+        # 延迟导入
+        from django.conf import settings
+        from django.contrib.auth.models import Group
+        from django.db.models.signals import post_save, post_delete, m2m_changed
+        from accounts.models import Employee
+        from departments.models import Department
+        from .middleware import VIEWFLOW_MIDDLEWARE
+        from .permission_cache import employee_changed, employee_groups_changed, group_or_department_changed
+        # viewflow导入时追加的同步版中间件：MIDDLEWARE中已经配置了本地的同步/异步版本时去掉，否则ASGI下整个中间件栈会降级成同步
+        replaced = {path for path, local in VIEWFLOW_MIDDLEWARE.items() if local in settings.MIDDLEWARE}
+        if replaced & set(settings.MIDDLEWARE):
+            settings.MIDDLEWARE = [path for path in settings.MIDDLEWARE if path not in replaced]
+        # 权限快照失效：员工信息、员工角色、角色组、部门变更时清除NodePermissionMiddleware的用户快照缓存
+        post_save.connect(employee_changed, sender=Employee, dispatch_uid='workflows_perm_employee_saved')
+        post_delete.connect(employee_changed, sender=Employee, dispatch_uid='workflows_perm_employee_deleted')
+        m2m_changed.connect(employee_groups_changed, sender=Employee.groups.through, dispatch_uid='workflows_perm_groups_changed')
+        for model in (Group, Department):
+            post_save.connect(group_or_department_changed, sender=model, dispatch_uid=f'workflows_perm_{model.__name__}_saved')
+            post_delete.connect(group_or_department_changed, sender=model, dispatch_uid=f'workflows_perm_{model.__name__}_deleted')
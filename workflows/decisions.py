@@ -0,0 +1,73 @@
+# workflows/decisions.py
+from devices.models import AnalysisResults
+
+"""
+    分支节点(flow.If)的判断结果查询
+    原来的get_latest_result会把process下所有DeviceTask查出来，在Python里逐个比较task.flow_task.name，再查一次AnalysisResults，
+    analysis_result节点一次判断要调用两次，每个网关4条以上SQL并实例化全部任务。
+    这里改为：
+        1、按flow_task直接在SQL里过滤（AnalysisResults join viewflow_task），一条查询拿到“流程P中节点X的最新结果”，
+           走AnalysisResults上(process, task, -created_at)的组合索引
+        2、结果缓存在activation实例上，同一次流转中重复判断同一节点不再查库
+"""
+
+# 缓存在activation实例上的属性名 {node_name: result}
+MEMO_ATTR = '_latest_results'
+
+
+def _node(flow_class, node_name):
+    # 按节点名获取flow中的节点对象，查询时TaskReferenceField会把它转换成数据库中存储的引用字符串
+    return flow_class.instance.node(node_name, no_obsolete=True)
+
+
+def query_latest_result(process, node_name):
+    """查询流程process中节点node_name的最新分析结果（一条SQL），无记录时返回None（符合业务中"未明确"的定义）"""
+    node = _node(process.flow_class, node_name)
+    if node is None:
+        return None
+    return AnalysisResults.objects.filter(
+        process_id=process.pk,
+        task__flow_task=node,
+    ).order_by('-created_at', '-id').values_list('result', flat=True).first()
+
+
+def query_latest_results(process, node_names):
+    """一条SQL查询多个节点各自的最新分析结果，返回 {node_name: result}"""
+    nodes = {}
+    for node_name in node_names:
+        node = _node(process.flow_class, node_name)
+        if node is not None:
+            nodes[node] = node_name
+    results = dict.fromkeys(node_names)
+    if not nodes:
+        return results
+    rows = AnalysisResults.objects.filter(
+        process_id=process.pk,
+        task__flow_task__in=list(nodes),
+    ).order_by('-created_at', '-id').values_list('task__flow_task', 'result')
+    found = set()
+    for flow_task, result in rows:
+        node_name = nodes.get(flow_task)
+        if node_name is not None and node_name not in found:  # 按时间倒序，每个节点只取第一条
+            results[node_name] = result
+            found.add(node_name)
+            if len(found) == len(nodes):
+                break
+    return results
+
+
+def latest_result(activation, node_name):
+    """分支节点中使用：同一个activation内对同一节点的重复判断只查一次库"""
+    memo = activation.__dict__.setdefault(MEMO_ATTR, {})
+    if node_name not in memo:
+        memo[node_name] = query_latest_result(activation.process, node_name)
+    return memo[node_name]
+
+
+def latest_results(activation, *node_names):
+    """分支节点中使用：一次取多个节点的最新结果，未缓存的节点合并成一条SQL查询"""
+    memo = activation.__dict__.setdefault(MEMO_ATTR, {})
+    missing = [node_name for node_name in node_names if node_name not in memo]
+    if missing:
+        memo.update(query_latest_results(activation.process, missing))
+    return [memo[node_name] for node_name in node_names]
@@ -0,0 +1,299 @@
+# workflows/exports.py
+import csv
+import io
+import re
+import zipfile
+from datetime import date, datetime
+from itertools import islice
+from xml.sax.saxutils import escape
+
+from django.utils import timezone
+
+from devices.models import AnalysisResults, Device, OperationRecord
+from workflows.models import DeviceProcess, DeviceTask
+
+"""
+    设备/流程/操作记录/分析结果导出（CSV、XLSX），给客户和评审用
+    几十万行的导出不能先在内存里拼好再返回（Gunicorn worker会超时、内存随行数增长），这里全部是生成器：
+        1、数据：按主键升序的values_list + .iterator(chunk_size)（PostgreSQL上是服务端游标），关联字段在同一条SQL里JOIN带出，
+           流程的节点耗时按块（CHUNK_SIZE个流程）一次查出这一块的任务
+        2、输出：StreamingHttpResponse逐块写出；XLSX用自己实现的只写（write-only）writer，边生成边压缩输出，
+           不依赖openpyxl（它的write-only模式也要等save()时才生成zip，整份文件生成完之前客户端收不到任何字节）
+        3、续传：第一列固定为id，中断后用 ?after=<收到的最后一个完整行的id> 从断点继续
+"""
+
+CHUNK_SIZE = 2000
+FORMATS = ('csv', 'xlsx')
+# XLSX单个sheet的行数上限（含表头）
+XLSX_MAX_ROWS = 1_048_576
+# XML 1.0不允许的控制字符，写入XLSX前去掉
+ILLEGAL_XML_CHARS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+# 以这些字符开头的文本会被Excel/WPS当成公式（CSV注入，例如分析备注里写了 =HYPERLINK(...)），导出时前面加单引号
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _node_name(flow_task):
+    return getattr(flow_task, 'name', flow_task) or ''
+
+
+def _local(value):
+    if isinstance(value, datetime):
+        return timezone.localtime(value).strftime('%Y-%m-%d %H:%M:%S') if timezone.is_aware(value) else \
+            value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def _text(value):
+    """字符串值防公式注入：开头是公式字符时加单引号，其他类型原样返回"""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _chunks(iterable, size=CHUNK_SIZE):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class Dataset:
+    """一种可导出的数据：表头 + 从after之后按id升序的行"""
+    name = None
+    header = ()
+
+    def queryset(self):
+        raise NotImplementedError
+
+    def fields(self):
+        raise NotImplementedError
+
+    def rows(self, after=None, limit=None):
+        queryset = self.queryset().order_by('pk')
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        if limit is not None:
+            queryset = queryset[:limit]
+        for row in queryset.values_list(*self.fields()).iterator(chunk_size=CHUNK_SIZE):
+            yield self.format_row(row)
+
+    def format_row(self, row):
+        return [_local(value) for value in row]
+
+
+class DeviceDataset(Dataset):
+    name = 'devices'
+    header = ('id', 'SN', '专案', '硬件版本', '软件版本', 'config', 'fail站位', 'fail测项', 'bug号',
+              '当前位置', '当前节点', '流程状态', '处理人', '创建时间')
+
+    def queryset(self):
+        return Device.objects.all()
+
+    def fields(self):
+        return ('pk', 'sn', 'project', 'hardware_version', 'software_version', 'config', 'fail_station',
+                'failure_mode', 'bug__bug_number', 'current_position', 'state__current_node', 'state__status',
+                'state__owner__username', 'created_at')
+
+
+class ProcessDataset(Dataset):
+    """每个流程一行，每个业务节点一列：在该节点上停留的小时数（复测循环多次经过的节点累加）"""
+    name = 'processes'
+    base_header = ('id', 'SN', '专案', 'fail站位', 'fail测项', '流程状态', '开始时间', '结束时间')
+
+    def __init__(self):
+        from workflows.flows import DeviceInvestigationFlow  # 避免导入时加载流程定义
+        self.nodes = [node.name for node in DeviceInvestigationFlow.instance.nodes() if node.task_type == 'HUMAN']
+        self.header = self.base_header + tuple(f'{node}(小时)' for node in self.nodes)
+
+    def queryset(self):
+        return DeviceProcess.objects.all()
+
+    def fields(self):
+        return ('pk', 'device__sn', 'device__project', 'device__fail_station', 'device__failure_mode',
+                'status', 'created', 'finished')
+
+    def rows(self, after=None, limit=None):
+        # 流程行走服务端游标，节点耗时按块一次查出：每CHUNK_SIZE个流程一条任务查询
+        for chunk in _chunks(super().rows(after, limit)):
+            timings = self.node_hours([row[0] for row in chunk])
+            for row in chunk:
+                hours = timings.get(row[0], {})
+                yield row + [hours.get(node) for node in self.nodes]
+
+    def node_hours(self, process_ids):
+        tasks = DeviceTask.objects.filter(process_id__in=process_ids, flow_task_type='HUMAN') \
+            .values_list('process_id', 'flow_task', 'created', 'finished')
+        now = timezone.now()
+        hours = {}
+        for process_id, flow_task, created, finished in tasks:
+            node = _node_name(flow_task)
+            seconds = ((finished or now) - created).total_seconds()  # 进行中的任务算到当前时间
+            by_node = hours.setdefault(process_id, {})
+            by_node[node] = by_node.get(node, 0) + seconds
+        return {pk: {node: round(seconds / 3600, 2) for node, seconds in by_node.items()}
+                for pk, by_node in hours.items()}
+
+
+class OperationDataset(Dataset):
+    name = 'operations'
+    header = ('id', 'SN', '流程id', '节点', '操作', '操作人', '操作时间', '附件')
+
+    def queryset(self):
+        return OperationRecord.objects.all()
+
+    def fields(self):
+        return ('pk', 'process__device__sn', 'process_id', 'task__flow_task', 'action', 'number__username',
+                'created_at', 'attachment')
+
+    def format_row(self, row):
+        row = super().format_row(row)
+        row[3] = _node_name(row[3])
+        return row
+
+
+class AnalysisDataset(Dataset):
+    name = 'analysis'
+    header = ('id', 'SN', '流程id', '节点', '对应操作', '分析人', '分析时间', '分析结果', '分析说明')
+
+    def queryset(self):
+        return AnalysisResults.objects.all()
+
+    def fields(self):
+        return ('pk', 'process__device__sn', 'process_id', 'task__flow_task', 'operation__action',
+                'number__username', 'created_at', 'result', 'analysis_notes')
+
+    def format_row(self, row):
+        row = super().format_row(row)
+        row[3] = _node_name(row[3])
+        return row
+
+
+DATASETS = {dataset.name: dataset for dataset in (DeviceDataset, ProcessDataset, OperationDataset, AnalysisDataset)}
+
+
+def write_csv(header, rows):
+    """逐块生成CSV字节，带BOM，Excel直接打开不乱码"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for chunk in _chunks(rows):
+        writer.writerows([_text(value) for value in row] for row in chunk)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _Sink(io.RawIOBase):
+    """不可seek的输出：zipfile写入的字节先攒在这里，每块取走一次；不可seek时zipfile会用数据描述符，不需要回写文件头"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="{sheet}" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+
+def _xlsx_cell(value):
+    if value is None or value == '':
+        return '<c/>'
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c><v>{value}</v></c>'
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    # 内联字符串：不需要sharedStrings表（那样要把所有字符串留在内存里）
+    text = escape(ILLEGAL_XML_CHARS.sub('', _text(str(value))))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _xlsx_row(values):
+    return '<row>' + ''.join(_xlsx_cell(value) for value in values) + '</row>'
+
+
+def write_xlsx(header, rows, sheet='Sheet1'):
+    """只写的XLSX：单个sheet，行数超过XLSX_MAX_ROWS时截断（用after续传导出剩余部分）"""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in XLSX_PARTS.items():
+            workbook.writestr(name, content.format(sheet=escape(sheet)))
+        with workbook.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as worksheet:
+            worksheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            worksheet.write(_xlsx_row(header).encode('utf-8'))
+            for chunk in _chunks(islice(rows, XLSX_MAX_ROWS - 1)):
+                worksheet.write(''.join(_xlsx_row(row) for row in chunk).encode('utf-8'))
+                yield sink.drain()
+            worksheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+
+WRITERS = {
+    'csv': (write_csv, 'text/csv; charset=utf-8'),
+    'xlsx': (write_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+
+def export(name, fmt='csv', after=None, limit=None):
+    """返回 (字节块生成器, Content-Type)；数据集或格式不支持时抛出ValueError"""
+    if name not in DATASETS:
+        raise ValueError(f'不支持的导出数据:{name}，可选:{", ".join(DATASETS)}')
+    if fmt not in WRITERS:
+        raise ValueError(f'不支持的格式:{fmt}，可选:{", ".join(FORMATS)}')
+    # 参数在这里校验：rows()是生成器，到那里才出错时响应已经以200开始流式输出了
+    if limit is not None and limit < 0:
+        raise ValueError(f'limit不能为负数:{limit}')
+    dataset = DATASETS[name]()
+    writer, content_type = WRITERS[fmt]
+    return writer(dataset.header, dataset.rows(after, limit)), content_type
@@ -8,6 +8,7 @@ from abnormal_device_tracking import settings
 from abnormal_device_tracking.utils import TraceViewMixin
 from devices.models import OperationRecord, AnalysisResults
 from .BaseView import CustomView
+from .decisions import query_latest_result, latest_result, latest_results
 
 from .forms import ProductionTestFailForm, FAERetestForm, XRayTestForm, EngineeringAnalysisForm, MeAnalysisForm, \
     ScrappedForm, ReturnNormalFlowForm, DeviceStartForm, FinalRetestForm
@@ -19,25 +20,9 @@ from .views import ProductionTestFailView, FAERetestView, XRayTestView, Engineer
     ScrappedView, ReturnNormalFlowView, FinalRetestView, StartProcessView
 
 
-# 获取对应节点最新result
+# 获取对应节点最新result（一条SQL，按flow_task过滤，见workflows/decisions.py）
 def get_latest_result(process, target_task_name):
-    # 查询条件：当前流程 + 目标task_name，按创建时间倒序取最新一条
-    tasks = DeviceTask.objects.filter(process=process)
-    target_task = None
-    for task in tasks:
-        if task.flow_task.name == target_task_name:
-            target_task = task
-            break
-    # 查询最新的AnalysisResults
-    latest_record = AnalysisResults.objects.filter(
-        process=process,
-        task=target_task
-    ).order_by('-created_at').first()
-    if latest_record:
-        return latest_record.result
-    # 无记录时返回None（符合业务中"未明确"的定义）
-    else:
-        return None
+    return query_latest_result(process, target_task_name)
 
 
 
@@ -152,10 +137,7 @@ class DeviceInvestigationFlow(Flow): # 当Python解释器遇到这个类定义
 
 
     judge_retest_result = flow.If(
-        lambda activation: get_latest_result(
-            process=activation.process,  # activation 是实例，有 process 属性
-            target_task_name="FAE_initial_retest"
-        ),
+        lambda activation: latest_result(activation, "FAE_initial_retest"),  # activation 是实例，有 process 属性
     ).Then(this.return_normal_flow).Else(this.X_ray_test)
 
 
@@ -169,10 +151,7 @@ class DeviceInvestigationFlow(Flow): # 当Python解释器遇到这个类定义
 
     # 在流程中使用这个函数
     judge_X_ray_result = flow.If(
-        lambda activation: get_latest_result(
-            process=activation.process,  # activation 是实例，有 process 属性
-            target_task_name="X_ray_test"
-        )
+        lambda activation: latest_result(activation, "X_ray_test")
     ).Then(this.engineering_analysis).Else(this.me_analysis)
 
     # 分支A：测试通过 → 工程团队分析
@@ -191,10 +170,8 @@ class DeviceInvestigationFlow(Flow): # 当Python解释器遇到这个类定义
 
     # me_analysis / engineering_analysis的分析结果
     analysis_result = flow.If(
-        # 条件：工程分析节点的最新result是否为'pass'，能解决问题
-        lambda activation:
-        get_latest_result(activation.process, 'engineering_analysis') == 1 or
-        get_latest_result(activation.process, 'me_analysis') == 1,
+        # 条件：工程分析节点的最新result是否为'pass'，能解决问题（两个节点的结果合并成一条SQL查询）
+        lambda activation: 1 in latest_results(activation, 'engineering_analysis', 'me_analysis'),
     ).Then(this.FAE_final_retest).Else(this.scrapped)
 
 
@@ -210,7 +187,7 @@ class DeviceInvestigationFlow(Flow): # 当Python解释器遇到这个类定义
     final_retest_result = flow.If(
         # 条件：FAE最终复测是否为'pass'
         lambda activation:
-        get_latest_result(activation.process, 'FAE_final_retest') == 1
+        latest_result(activation, 'FAE_final_retest') == 1
     ).Then(this.return_normal_flow).Else(this.scrapped)
 
 
@@ -0,0 +1,197 @@
+# workflows/intake.py
+import codecs
+import csv
+import json
+import logging
+from types import SimpleNamespace
+
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import transaction
+from viewflow.workflow import PROCESS
+
+from devices.models import Device
+from workflows.models import DeviceProcess
+from workflows.state import refresh_device_states
+
+"""
+    产线异常设备批量入库
+    原来设备只能通过DeviceStartForm逐台录入：每台一次get_or_create + 一次完整的启动流程请求，产线下班后一次导出几百个fail的SN就要几百次往返。
+    这里提供批量入口（HTTP接口 DeviceIntakeView 和 manage.py intake_devices 共用）：
+        1、流式解析CSV / JSON数组 / JSON Lines，每行一个设备
+        2、按块（默认500行）处理：先一条SQL查出块内已存在的设备，再用 bulk_create(update_conflicts=True) 一次upsert整块设备，
+           行内没填的字段保留数据库中的原值
+        3、没有进行中流程的设备启动DeviceInvestigationFlow，每块一个事务，每台设备一个savepoint
+        4、单行出错（JSON Lines坏行、字段校验失败、块内SN重复、流程启动失败）只记录到errors，不影响同批其他行
+    注意：bulk_create不会触发Device的HistoricalRecords，批量入库不产生设备历史记录
+"""
+logger = logging.getLogger(__name__)
+
+# 可以批量导入的设备字段，sn必填
+INTAKE_FIELDS = ('sn', 'project', 'hardware_version', 'software_version', 'fail_station', 'failure_mode', 'test_link')
+UPDATE_FIELDS = [field for field in INTAKE_FIELDS if field != 'sn']
+DEFAULT_CHUNK_SIZE = 500
+FORMATS = ('csv', 'json', 'ndjson')
+
+
+def parse_rows(stream, fmt):
+    """把文本流解析成 dict 行的迭代器；stream是文本流（str），CSV需要表头"""
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    elif fmt == 'ndjson':
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:  # 单行坏数据交给clean_row记录为该行的错误，不中断整批
+                    yield e
+    elif fmt == 'json':
+        rows = json.load(stream)
+        if not isinstance(rows, list):
+            raise ValueError('JSON内容必须是设备数组')
+        yield from rows
+    else:
+        raise ValueError(f'不支持的格式:{fmt}，可选:{", ".join(FORMATS)}')
+
+
+def text_stream(binary, encoding='utf-8-sig'):
+    """上传文件/请求体是二进制流，包一层按需解码的文本流（utf-8-sig兼容Excel导出的BOM）"""
+    # HttpRequest只有read/readline，不是完整的IOBase，不能用io.TextIOWrapper，用codecs的StreamReader
+    return codecs.getreader(encoding)(binary)
+
+
+def _chunks(rows, size):
+    chunk = []
+    for number, row in enumerate(rows, start=1):
+        chunk.append((number, row))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class DeviceIntake:
+    """
+    批量入库
+    用法：
+        summary = DeviceIntake(user).run(parse_rows(stream, 'csv'))
+        summary -> {'total', 'created', 'updated', 'started', 'skipped', 'errors': [{'row', 'sn', 'error'}]}
+    """
+
+    def __init__(self, user, chunk_size=DEFAULT_CHUNK_SIZE, start_flows=True):
+        self.user = user
+        self.chunk_size = chunk_size
+        self.start_flows = start_flows
+        self.summary = {'total': 0, 'created': 0, 'updated': 0, 'started': 0, 'skipped': 0, 'errors': []}
+
+    def error(self, number, sn, message):
+        self.summary['errors'].append({'row': number, 'sn': sn, 'error': message})
+
+    @staticmethod
+    def start_node():
+        from workflows.flows import DeviceInvestigationFlow  # flows导入了视图，延迟导入避免循环
+        return DeviceInvestigationFlow.start
+
+    def can_start(self):
+        """和启动流程页面（wrap_start_view）一样的权限校验"""
+        return self.start_node().can_execute(self.user)
+
+    def run(self, rows):
+        if self.start_flows and not self.can_start():
+            raise PermissionDenied('无权限启动流程')
+        try:
+            for chunk in _chunks(rows, self.chunk_size):
+                self.summary['total'] += len(chunk)
+                devices = self.upsert_devices(chunk)
+                if self.start_flows and devices:
+                    self.start_processes(devices)
+        except (ValueError, csv.Error) as e:  # 流本身格式错误（坏的JSON/CSV），已处理的块保留
+            self.error(self.summary['total'] + 1, None, f'解析失败:{e}')
+        return self.summary
+
+    def clean_row(self, number, row):
+        """校验一行，返回 {字段: 值}（只包含填写了的字段），校验失败返回None"""
+        if isinstance(row, ValueError):
+            self.error(number, None, f'解析失败:{row}')
+            return None
+        if not isinstance(row, dict):
+            self.error(number, None, '行格式错误，应为对象')
+            return None
+        values = {}
+        for field in INTAKE_FIELDS:
+            value = row.get(field)
+            if value is None:
+                continue
+            value = str(value).strip()
+            if value:
+                values[field] = value
+        sn = values.get('sn')
+        if not sn:
+            self.error(number, None, 'sn不能为空')
+            return None
+        try:
+            # 只做字段级校验（长度等），不做validate_unique，避免每行一次查询
+            Device(**values).clean_fields(exclude=[f.name for f in Device._meta.fields if f.name not in values])
+        except ValidationError as e:
+            self.error(number, sn, '; '.join(f'{k}:{"".join(v)}' for k, v in e.message_dict.items()))
+            return None
+        return values
+
+    def upsert_devices(self, chunk):
+        """一块行：1条SQL查已有设备 + 1条upsert + 1条回查主键，返回 {sn: (行号, device)}"""
+        cleaned = {}
+        for number, row in chunk:
+            values = self.clean_row(number, row)
+            if values is None:
+                continue
+            if values['sn'] in cleaned:
+                self.error(number, values['sn'], f'与第{cleaned[values["sn"]][0]}行SN重复')
+                continue
+            cleaned[values['sn']] = (number, values)
+        if not cleaned:
+            return {}
+
+        existing = {
+            row['sn']: row for row in Device.objects.filter(sn__in=cleaned).values(*INTAKE_FIELDS)
+        }
+        objs = []
+        for sn, (_, values) in cleaned.items():
+            merged = dict(existing.get(sn, {}), **values)  # 没填的字段保留原值
+            objs.append(Device(**merged))
+        with transaction.atomic():
+            Device.objects.bulk_create(objs, update_conflicts=True, unique_fields=['sn'], update_fields=UPDATE_FIELDS)
+        self.summary['created'] += len(cleaned) - len(existing)
+        self.summary['updated'] += len(existing)
+        # 不同数据库对upsert后回填主键的支持不一致，统一按SN回查一次
+        devices = Device.objects.filter(sn__in=cleaned).only('pk', 'sn')
+        return {device.sn: (cleaned[device.sn][0], device) for device in devices}
+
+    def start_processes(self, devices):
+        """给没有进行中流程的设备启动流程：整块一个事务，每台设备一个savepoint，单台失败只回滚自己"""
+        active = set(
+            DeviceProcess.objects.filter(device__in=[device for _, device in devices.values()])
+            .exclude(status__in=[PROCESS.DONE, PROCESS.CANCELED])
+            .values_list('device_id', flat=True)
+        )
+        start_node = self.start_node()
+        # StartViewActivation.start()只读取request.user
+        starter = SimpleNamespace(user=self.user)
+        started = []
+        with transaction.atomic():
+            for sn, (number, device) in devices.items():
+                if device.pk in active:
+                    self.summary['skipped'] += 1
+                    continue
+                try:
+                    with transaction.atomic():
+                        activation = start_node.activation_class.create(start_node, None, None)
+                        activation.process.device = device
+                        activation.start(starter)
+                        activation.execute()
+                    self.summary['started'] += 1
+                    started.append(device.pk)
+                except Exception as e:
+                    logger.exception("批量入库启动流程失败 | SN:%s", sn)
+                    self.error(number, sn, f'启动流程失败:{e}')
+            # 整块启动成功的设备一次更新当前状态投影
+            refresh_device_states(*started)
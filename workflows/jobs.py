@@ -0,0 +1,151 @@
+# workflows/jobs.py
+import logging
+import random
+import traceback
+from contextlib import nullcontext
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from abnormal_device_tracking import tracing
+from workflows.models import Job
+
+"""
+    后台任务队列：流转中的慢操作（建聊天室、发通知……）不在请求里做，写一条Job，由 manage.py run_jobs 执行
+        1、入队：enqueue()在调用方的事务里INSERT一条Job，流转回滚时任务一起回滚，提交后才对worker可见，
+           不会出现“任务执行了但流转没提交”或“流转提交了但任务丢了”；传key时同一个键只入队一次
+        2、执行：worker用 SELECT ... FOR UPDATE SKIP LOCKED 领取到期的任务（多个worker互不阻塞），
+           每个任务默认在自己的事务里执行（@job(..., atomic=False)的任务自己管理事务）；失败按指数退避+随机抖动重试，超过max_attempts标记为failed
+        3、worker崩溃：执行中（running）超过LOCK_TIMEOUT秒的任务视为无人处理，重新领取
+    任务函数必须是幂等的（至少执行一次，可能重复执行），参数只放可JSON序列化的值（主键而不是对象）
+    选数据库而不是Redis做队列：入队和业务写入在同一个事务里，不需要额外的一致性处理
+"""
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = getattr(settings, 'JOBS_LOCK_TIMEOUT', 600)  # 秒
+BACKOFF_BASE = getattr(settings, 'JOBS_BACKOFF_BASE', 10)  # 秒，第n次失败后等待 BASE * 2^(n-1)
+BACKOFF_MAX = getattr(settings, 'JOBS_BACKOFF_MAX', 3600)  # 秒
+DEFAULT_MAX_ATTEMPTS = 5
+
+# 任务名 → 函数，由@job注册
+registry = {}
+
+
+def job(name, atomic=True):
+    """
+    注册任务函数：@job('chat.ensure_chatroom')，函数以payload为关键字参数调用
+    atomic=False：不包在一个事务里执行，由任务自己管理短事务（例如逐封发邮件、每封发完立即提交的通知汇总）
+    """
+    def decorator(func):
+        func.job_atomic = atomic
+        registry[name] = func
+        return func
+    return decorator
+
+
+def _eager():
+    # 调用时读取，方便测试中override_settings；开发环境默认不需要单独启动worker
+    return getattr(settings, 'JOBS_EAGER', settings.DEBUG)
+
+
+def enqueue(name, payload=None, key=None, delay=0, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """在当前事务中入队，返回Job；key已存在时不重复入队，返回已有的Job"""
+    if name not in registry:
+        raise ValueError(f'未注册的任务:{name}')
+    values = {
+        'name': name, 'payload': payload or {}, 'max_attempts': max_attempts,
+        'run_at': timezone.now() + timedelta(seconds=delay),
+    }
+    if key is None:
+        job = Job.objects.create(**values)
+    else:
+        try:
+            # 保存点：唯一约束冲突时只回滚这一条INSERT，不影响调用方的事务
+            with transaction.atomic():
+                job = Job.objects.create(idempotency_key=key, **values)
+        except IntegrityError:
+            return Job.objects.get(idempotency_key=key)
+    if _eager() and not delay:
+        transaction.on_commit(lambda: run_job(job.pk))
+    return job
+
+
+def backoff(attempts):
+    """第attempts次失败后的等待秒数，带±20%抖动，避免一批失败的任务同时重试"""
+    seconds = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return seconds * random.uniform(0.8, 1.2)
+
+
+def claim(worker, limit=10):
+    """领取最多limit个到期的任务并标记为running，返回Job列表"""
+    now = timezone.now()
+    stale = now - timedelta(seconds=LOCK_TIMEOUT)
+    with transaction.atomic():
+        jobs = list(
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(Q(status=Job.Status.PENDING, run_at__lte=now) | Q(status=Job.Status.RUNNING, locked_at__lt=stale))
+            .order_by('run_at')[:limit]
+        )
+        for job in jobs:
+            job.status = Job.Status.RUNNING
+            job.locked_by = worker
+            job.locked_at = now
+            job.attempts += 1
+        Job.objects.bulk_update(jobs, ['status', 'locked_by', 'locked_at', 'attempts'])
+    return jobs
+
+
+def execute(job):
+    """执行一个已领取的任务，记录结果；返回是否成功"""
+    func = registry.get(job.name)
+    try:
+        if func is None:
+            raise LookupError(f'未注册的任务:{job.name}')
+        with tracing.start_trace(f'job.{job.name}', job=job.pk, attempt=job.attempts), \
+                (transaction.atomic() if func.job_atomic else nullcontext()):
+            func(**job.payload)
+    except Exception as e:
+        job.last_error = ''.join(traceback.format_exception(e))[-4000:]
+        if func is not None and job.attempts < job.max_attempts:
+            job.status = Job.Status.PENDING
+            job.run_at = timezone.now() + timedelta(seconds=backoff(job.attempts))
+            logger.warning("后台任务失败，等待重试 | %s 第%s次: %s", job, job.attempts, e)
+        else:
+            job.status = Job.Status.FAILED
+            job.finished_at = timezone.now()
+            logger.error("后台任务失败，不再重试 | %s 第%s次: %s", job, job.attempts, e)
+        job.save(update_fields=['status', 'run_at', 'finished_at', 'last_error'])
+        return False
+    job.status = Job.Status.DONE
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'finished_at'])
+    return True
+
+
+def run_job(pk, worker='eager'):
+    """立即执行一个待执行的任务（JOBS_EAGER时在提交后调用），已被其他worker领取时跳过"""
+    updated = Job.objects.filter(pk=pk, status=Job.Status.PENDING).update(
+        status=Job.Status.RUNNING, locked_by=worker, locked_at=timezone.now(), attempts=F('attempts') + 1,
+    )
+    if updated:
+        execute(Job.objects.get(pk=pk))
+
+
+def run_due_jobs(worker='worker', limit=100):
+    """领取并执行一批到期的任务，返回 (成功数, 失败数)"""
+    done = failed = 0
+    for job in claim(worker, limit):
+        if execute(job):
+            done += 1
+        else:
+            failed += 1
+    return done, failed
+
+
+def purge(days):
+    """删除days天前结束的done任务（failed的保留，便于排查），返回删除条数"""
+    cutoff = timezone.now() - timedelta(days=days)
+    return Job.objects.filter(status=Job.Status.DONE, finished_at__lt=cutoff).delete()[0]
@@ -0,0 +1,120 @@
+# 该django管理命令用于对比只读页面同步视图和异步视图（abnormal_device_tracking/async_views.py）在ASGI下的并发表现：
+# 同一进程内经过Django的ASGIHandler和完整中间件栈，按不同并发数请求同一个页面的同步/异步两个URL，输出吞吐和延迟
+# 用真实部署的数据库（PostgreSQL）跑才有意义：SQLite没有网络往返，异步视图等待数据库的时间几乎为0
+import asyncio
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.test import AsyncClient, override_settings
+from django.urls import reverse
+
+from accounts.models import Employee
+from chat.models import Chatroom
+from devices.models import Device, PositionTracking
+
+# (名称, 同步URL名, 异步URL名, URL参数名) ，URL参数在运行时按已有数据填充
+PAGES = [
+    ('devices', 'devices:device_list', 'devices:device_list_async', None),
+    ('positions', 'devices:position_tracking', 'devices:position_tracking_async', 'device'),
+    ('processes', 'process_list', 'process_list_async', None),
+    ('bugs', 'problem_group:bug_list', 'problem_group:bug_list_async', None),
+    ('chatroom', 'chat:chatroom', 'chat:chatroom_async', 'process'),
+]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Command(BaseCommand):
+    help = "benchmark sync vs async read-only views under ASGI"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', default=','.join(page[0] for page in PAGES), help='要压测的页面，逗号分隔')
+        parser.add_argument('--concurrency', default='1,10,50', help='并发数，逗号分隔')
+        parser.add_argument('--requests', type=int, default=200, help='每个页面、每种视图、每个并发数的请求总数')
+        parser.add_argument('--username', help='登录用户，默认第一个启用的超级用户')
+
+    def handle(self, *args, **options):
+        names = {name.strip() for name in options['pages'].split(',') if name.strip()}
+        unknown = names - {page[0] for page in PAGES}
+        if unknown:
+            raise CommandError(f'未知页面:{",".join(sorted(unknown))}')
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',') if level.strip()]
+        except ValueError:
+            raise CommandError('--concurrency 格式错误，例如 1,10,50')
+        # 测试客户端的Host固定为testserver
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            asyncio.run(self.benchmark([page for page in PAGES if page[0] in names], levels, options))
+
+    async def benchmark(self, pages, levels, options):
+        users = Employee.objects.filter(is_active=True)
+        if options['username']:
+            users = users.filter(username=options['username'])
+        else:
+            users = users.order_by('-is_superuser', 'id')
+        user = await users.afirst()
+        if user is None:
+            raise CommandError('没有可登录的用户')
+        client = AsyncClient()
+        await client.aforce_login(user)
+        kwargs = await self.url_kwargs()
+
+        self.stdout.write(self.style.NOTICE(f"===== 用户:{user.username}, 每组{options['requests']}个请求 ====="))
+        for name, sync_name, async_name, kwarg in pages:
+            if kwarg is not None and kwarg not in kwargs:
+                self.stdout.write(self.style.WARNING(f'{name}: 没有可用的数据，跳过'))
+                continue
+            url_kwargs = {} if kwarg is None else kwargs[kwarg]
+            urls = {'sync': reverse(sync_name, kwargs=url_kwargs), 'async': reverse(async_name, kwargs=url_kwargs)}
+            for level in levels:
+                results = {mode: await self.run(client, url, level, options['requests']) for mode, url in urls.items()}
+                self.stdout.write(f"{name:<10} 并发:{level:>4}  " + '  |  '.join(
+                    f"{mode}:{result['rate']:>8.1f}次/秒 p50:{result['p50'] * 1000:7.1f}ms "
+                    f"p99:{result['p99'] * 1000:7.1f}ms 失败:{result['errors']}"
+                    for mode, result in results.items()
+                ))
+
+    @staticmethod
+    async def url_kwargs():
+        kwargs = {}
+        device_id = await PositionTracking.objects.order_by('-id').values_list('device_id', flat=True).afirst()
+        if device_id is None:
+            device_id = await Device.objects.order_by('-id').values_list('pk', flat=True).afirst()
+        if device_id is not None:
+            kwargs['device'] = {'pk': device_id}
+        # 异步聊天室页面在聊天室不存在时会重定向，压测取已经建好聊天室的process
+        process_id = await Chatroom.objects.filter(content_type__model='deviceprocess').order_by('-id') \
+            .values_list('object_id', flat=True).afirst()
+        if process_id is not None:
+            kwargs['process'] = {'process_pk': process_id}
+        return kwargs
+
+    @staticmethod
+    async def run(client, url, concurrency, total):
+        latencies = []
+        errors = 0
+        remaining = iter(range(total))
+
+        async def worker():
+            nonlocal errors
+            for _ in remaining:  # 多个worker共用一个迭代器，总请求数固定
+                start = time.perf_counter()
+                response = await client.get(url)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        return {
+            'rate': total / elapsed if elapsed else 0.0,
+            'p50': statistics.median(latencies) if latencies else 0.0,
+            'p99': percentile(latencies, 0.99) if latencies else 0.0,
+            'errors': errors,
+        }
@@ -0,0 +1,48 @@
+# 该django管理命令用于产线异常设备批量入库（逻辑见workflows/intake.py），和HTTP接口 deviceinvestigation/intake/ 共用同一套实现
+import json
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import PermissionDenied
+from django.core.management import BaseCommand, CommandError
+
+from workflows.intake import DEFAULT_CHUNK_SIZE, FORMATS, DeviceIntake, parse_rows
+
+
+class Command(BaseCommand):
+    help = "bulk intake failing devices from CSV/JSON and start investigation flows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV/JSON文件路径，"-"表示从标准输入读取')
+        parser.add_argument('--user', required=True, help='以该员工（用户名）的身份启动流程')
+        parser.add_argument('--format', choices=FORMATS, help='文件格式，不传时按扩展名判断，默认csv')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help=f'每块处理的行数（默认{DEFAULT_CHUNK_SIZE}）')
+        parser.add_argument('--no-start', action='store_true', help='只入库/更新设备，不启动流程')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or (path.rsplit('.', 1)[1].lower() if '.' in path else 'csv')
+        if fmt not in FORMATS:
+            raise CommandError(f'不支持的格式:{fmt}，可选:{", ".join(FORMATS)}')
+        try:
+            user = get_user_model().objects.get(username=options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f'用户不存在:{options["user"]}')
+
+        intake = DeviceIntake(user, chunk_size=options['chunk_size'], start_flows=not options['no_start'])
+        self.stdout.write(self.style.NOTICE(f"===== 开始批量入库:{path}（{fmt}） ====="))
+        try:
+            if path == '-':
+                summary = intake.run(parse_rows(sys.stdin, fmt))
+            else:
+                with open(path, encoding='utf-8-sig', newline='') as stream:
+                    summary = intake.run(parse_rows(stream, fmt))
+        except PermissionDenied as e:
+            raise CommandError(str(e))
+
+        for error in summary['errors']:
+            self.stdout.write(self.style.WARNING(f"第{error['row']}行 sn:{error['sn'] or '-'} {error['error']}"))
+        counts = {key: value for key, value in summary.items() if key != 'errors'}
+        self.stdout.write(self.style.SUCCESS(
+            f"Successfully intake {json.dumps(counts, ensure_ascii=False)}, errors: {len(summary['errors'])}"
+        ))
@@ -0,0 +1,32 @@
+# 该django管理命令用于按流程/任务/设备表全量重算DeviceState投影（计算逻辑见workflows/state.py），
+# 用于直接改库后修正投影（首次上线的回填由迁移devices/0013_backfill_devicestate完成）
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+
+from devices.models import Device
+from workflows.state import build_states, save_states
+
+DEFAULT_BATCH_SIZE = 2000
+
+
+class Command(BaseCommand):
+    help = "rebuild the DeviceState projection from processes, tasks and positions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help=f'每批重算的设备数量（默认{DEFAULT_BATCH_SIZE}）')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size <= 0:
+            raise CommandError('--batch-size 必须大于0')
+        total, last_id = 0, 0
+        while True:
+            # 按主键keyset分块，每块3条查询 + 1条upsert
+            ids = list(Device.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            with transaction.atomic():
+                save_states(build_states(ids))
+            total += len(ids)
+            last_id = ids[-1]
+        self.stdout.write(self.style.SUCCESS(f'Successfully rebuild {total} device states'))
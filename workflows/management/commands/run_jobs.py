@@ -0,0 +1,55 @@
+# 该django管理命令是后台任务队列的worker（队列见workflows/jobs.py）：循环领取到期的任务并执行，
+# 可以同时启动多个（SKIP LOCKED，互不阻塞）；收到SIGTERM/SIGINT时执行完当前这批再退出
+# 每轮领取前调用close_old_connections()（Django在每个请求前后也是这样做的）：数据库重启或服务端空闲超时断开的连接会被丢弃重连，
+# 否则之后每次领取都抛OperationalError，直到worker被重启
+import os
+import signal
+import socket
+import time
+
+from django.core.management import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from workflows.jobs import purge, run_due_jobs
+
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_POLL = 1.0  # 秒
+
+
+class Command(BaseCommand):
+    help = "run background jobs enqueued by workflow transitions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help=f'每次领取的任务数（默认{DEFAULT_BATCH_SIZE}）')
+        parser.add_argument('--poll', type=float, default=DEFAULT_POLL, help=f'没有到期任务时的轮询间隔秒数（默认{DEFAULT_POLL}）')
+        parser.add_argument('--once', action='store_true', help='执行完当前到期的任务后退出（用于cron或测试）')
+        parser.add_argument('--purge-days', type=int, default=None, help='启动时删除N天前已完成的任务')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size <= 0:
+            raise CommandError('--batch-size 必须大于0')
+        if options['purge_days'] is not None:
+            deleted = purge(options['purge_days'])
+            self.stdout.write(f'purged {deleted} finished jobs')
+
+        self.stopping = False
+        if not options['once']:
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        total_done = total_failed = 0
+        while not self.stopping:
+            close_old_connections()
+            done, failed = run_due_jobs(worker, batch_size)
+            total_done += done
+            total_failed += failed
+            if done + failed:
+                continue  # 可能还有到期任务，立即领取下一批
+            if options['once']:
+                break
+            time.sleep(options['poll'])
+        self.stdout.write(self.style.SUCCESS(f'Successfully run {total_done} jobs, {total_failed} failed'))
+
+    def stop(self, signum, frame):
+        self.stopping = True
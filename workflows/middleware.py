@@ -1,5 +1,5 @@
 # middleware.py
-from threading import local
+from contextvars import ContextVar
 import re
 import logging
 from django.conf import settings
@@ -7,15 +7,21 @@ from django.http import JsonResponse, HttpResponseForbidden
 from django.core.exceptions import ObjectDoesNotExist
 from django.apps import apps
 from django.shortcuts import render
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.utils.decorators import sync_and_async_middleware
+from viewflow import middleware as viewflow_middleware
+
+from workflows.permission_cache import build_node_department_table, get_task_node_name, get_user_snapshot, \
+    normalize
 """
     workflows 应用的中间件配置
     核心功能：
     1. NodePermissionMiddleware：工作流节点权限核心中间件，实现「URL操作+节点部门+用户角色」的三重权限校验，适配Viewflow工作流
-    2. ThreadLocalMiddleware：线程本地存储中间件，解决非视图层（模型、信号、Viewflow节点）获取当前request/user的问题
-    3. 配套工具函数：AJAX判断、当前请求/用户获取、标准化权限拦截响应
+    2. ThreadLocalMiddleware：请求上下文中间件（contextvars），解决非视图层（模型、信号、Viewflow节点）获取当前request/user的问题
+    3. SiteMiddleware / HotwireTurboMiddleware：viewflow同名中间件的同步/异步版本（见下面的说明）
+    4. 配套工具函数：AJAX判断、当前请求/用户获取、标准化权限拦截响应
     适用框架：Viewflow+AdminLTE（非纯前后端分离）
-    核心依赖：Django 4.0+（兼容异步视图）、threading.local（线程隔离）
+    核心依赖：Django 4.0+（兼容异步视图）、contextvars（按请求隔离，WSGI线程和ASGI协程/线程池都适用）
 """
 # 日志器（统一记录权限相关日志）
 logger = logging.getLogger('workflows.permission')
@@ -32,6 +38,12 @@ class NodePermissionMiddleware:
 
     def __init__(self, get_response):
         self.get_response = get_response
+        # 异步中间件栈中get_response是协程函数，__call__直接返回它的协程，标记后Django不再做sync/async适配
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+            # Django按process_view是否是协程函数决定要不要用sync_to_async适配（每个请求都切一次同步线程），
+            # 换成异步的钩子：不需要校验的请求在事件循环里直接放行
+            self.process_view = self.aprocess_view
 
         # 1. 从settings读取配置（解耦硬编码）
         self.url_patterns = getattr( # getattr(x, 'y', default) = x.y，如果x.y不存在，返回default
@@ -61,12 +73,15 @@ class NodePermissionMiddleware:
 
         # 2. 预编译所有URL正则（只编译一次，提升效率）
         self._compile_url_patterns()
+        # 3. 预处理节点→部门表（部门名只格式化一次，不再每个请求strip().lower()）
+        self.node_department_table = build_node_department_table(self.node_departments)
 
     def _compile_url_patterns(self):
-        """预编译URL正则表达式"""
+        """预编译URL正则表达式，同时预先格式化每条规则的角色列表"""
         self.compiled_url_patterns = []
         for pattern, rule in self.url_patterns.items():
             compiled_re = re.compile(pattern) # 对正则字符串做 “语法检查 + 解析转换”，把「正则表达式字符串」编译成 Python 内部的「正则表达式对象（Pattern 对象）」
+            rule = dict(rule, roles_normalized=frozenset(normalize(r) for r in rule['roles']))
             self.compiled_url_patterns.append((compiled_re, rule))
 
     def __call__(self, request):
@@ -97,8 +112,7 @@ class NodePermissionMiddleware:
 
         # Step 3: 核心权限校验（加完整异常捕获）
         try:
-            # 3.1 Django 的模型懒加载——不是项目启动就导入模型，而是用到该模型时再动态获取，解决循环导入问题。中间件中使用模型 → 必须用懒加载
-            DeviceTask = apps.get_model('workflows', 'DeviceTask') # apps是 Django 的应用注册表，项目启动时，Django 会自动扫描所有已注册的INSTALLED_APPS（比如你的workflows），把每个应用的模型类（比如DeviceTask）注册到这个注册表中，形成「应用名→模型名→模型类」的映射关系
+            # 3.1 模型懒加载（解决循环导入）在workflows/permission_cache.py中完成
 
             # 获取task_pk，无则拦截
             '''
@@ -121,10 +135,9 @@ class NodePermissionMiddleware:
                 )
                 return self._forbidden_response(request,"缺少任务ID参数")
 
-            # 3.3 查询任务（可加简单缓存，比如django-cacheops/本地缓存/redis缓存）
-            task = DeviceTask.objects.get(pk=task_pk)
-            node_name = task.flow_task.name.strip()  # 获取节点名，去空格
-            required_departments = self.node_departments.get(node_name) # 获取可通行的部门列表
+            # 3.3 查询任务绑定的节点名（LRU缓存，同一个task只查一次库）
+            node_name = get_task_node_name(int(task_pk))  # task不存在时抛出DeviceTask.DoesNotExist，由下面的ObjectDoesNotExist捕获
+            required_departments = self.node_department_table.get(node_name) # 获取可通行的部门列表(原始列表, 格式化后的集合)
 
             # 3.4 无部门要求则放行，无部门要求就更没有职级要求
             if not required_departments:
@@ -157,10 +170,19 @@ class NodePermissionMiddleware:
             )
             return self._forbidden_response(request,"权限校验失败，请联系管理员")
 
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        """异步中间件栈的process_view：只有匹配到权限规则（需要查库）时才到同步线程里执行校验"""
+        if not request.path.startswith('/workflows/') or not self.get_permission_rule(request.path):
+            return None
+        return await sync_to_async(NodePermissionMiddleware.process_view)(
+            self, request, view_func, view_args, view_kwargs
+        )
+
     def _check_permission(self, request, required_departments, permission_rule, node_name):
         """拆分权限检查逻辑，提升可读性"""
         user = request.user
         request_id = getattr(request, 'request_id', 'unknown')
+        required_departments, required_departments_normalized = required_departments
 
         # 1. 检查用户是否登录
         if not user.is_authenticated:
@@ -170,42 +192,40 @@ class NodePermissionMiddleware:
             )
             return self._forbidden_response(request,"请先登录系统")
 
+        # 用户的部门和角色快照（已格式化），重复访问时从request/cache中读取，不再查库
+        snapshot = get_user_snapshot(request)
+
         # 2. 检查用户部门信息
-        if not hasattr(user, 'department') or not user.department:
+        if not snapshot['department']:
             logger.warning(
                 "权限拦截 | 请求ID:%s | 路径:%s | 节点:%s | 用户:%s | 原因：用户无部门信息",
                 request_id, request.path, node_name, user.username
             )
             return self._forbidden_response(request,"用户部门信息不完整，请联系管理员配置")
 
-        # 3. 检查部门权限（统一转小写，去空格，避免大小写/空格误判）
-        # 格式化用户部门和有权限的部门列表
-        user_department = user.department.name.strip().lower()
-        required_departments_normalized = [d.strip().lower() for d in required_departments]
-        if user_department not in required_departments_normalized:
+        # 3. 检查部门权限（部门名在启动和构建快照时已统一转小写，去空格）
+        if snapshot['department'] not in required_departments_normalized:
             logger.warning(
                 "权限拦截 | 请求ID:%s | 路径:%s | 节点:%s | 用户:%s | 部门:%s | 要求部门:%s",
-                request_id, request.path, node_name, user.username, user.department.name, required_departments
+                request_id, request.path, node_name, user.username, snapshot['department_name'], required_departments
             )
             return self._forbidden_response(request,f"需要{required_departments}部门权限")
 
         # 4. 检查角色权限
-        # 格式化所需权限列表和用户权限列表
         required_roles = permission_rule['roles'] # 获取该url(操作)对应的职级权限列表
-        user_roles = [group.name.strip().lower() for group in user.groups.all()]
-        required_roles_normalized = [r.strip().lower() for r in required_roles]
+        user_roles = snapshot['roles']
 
-        if not any(role in user_roles for role in required_roles_normalized): # 没有匹配的职级权限
+        if user_roles.isdisjoint(permission_rule['roles_normalized']): # 没有匹配的职级权限
             logger.warning(
                 "权限拦截 | 请求ID:%s | 路径:%s | 节点:%s | 用户:%s | 角色:%s | 要求角色:%s",
-                request_id, request.path, node_name, user.username, user_roles, required_roles
+                request_id, request.path, node_name, user.username, snapshot['role_names'], required_roles
             )
             return self._forbidden_response(request,f"需要{required_roles}角色权限")
 
         # 所有权限校验通过
         logger.info(
             "权限放行 | 请求ID:%s | 路径:%s | 节点:%s | 用户:%s | 部门:%s | 角色:%s",
-            request_id, request.path, node_name, user.username, user.department.name, user_roles
+            request_id, request.path, node_name, user.username, snapshot['department_name'], snapshot['role_names']
         )
         return None
 
@@ -235,28 +255,123 @@ def request_is_ajax(request):
 前提：
     Django 的默认规则是：只有「视图、中间件、装饰器」能直接拿到 request 对象（因为这些是请求处理的直接环节，request 会作为参数传入），
     但在工具函数、模型方法、Django 信号、Viewflow 工作流节点逻辑等「非视图层代码」中，若想获取当前请求的 request/user，默认只能通过层层传参的方式实现
-    Django 是多线程运行的 Web 框架，每个 HTTP 请求都会被分配一个独立的线程处理，请求处理完成后线程销毁（或复用，但数据会清空）。
 原理：
-    threading.local()会创建一个线程本地存储对象，这个对象的特点是：每个线程对它的操作都是独立的，线程 A 存的属性，线程 B 看不到，
-    不会出现多个请求的数据串扰，是多线程环境下 “安全存全局数据” 的核心工具
+    原来用threading.local()按线程存request，有两个问题：
+        1、请求结束后没有清除，线程被下一个请求复用时，没有经过中间件的代码（例如后台线程、信号）会读到上一个请求的用户
+        2、ASGI（Daphne/uvicorn）下中间件在事件循环线程里执行，同步视图由sync_to_async放到线程池执行，
+           线程池里的线程看不到事件循环线程存的值，多个请求共用一个线程时还会互相覆盖
+    现在用contextvars.ContextVar：每个请求有自己的上下文，asyncio的Task和asgiref的sync_to_async/async_to_sync都会把上下文带过去，
+    所以不管是WSGI线程、ASGI协程还是线程池中的同步视图，读到的都是当前请求；请求结束时在finally中还原
 '''
-# 通过线程局部变量的方式解决model层无法获取当前登录用户的问题, 在DeviceTask model的custom_actions方法中被使用
-_thread_locals = local() # 创建一个全局的线程本地存储容器，用于存放每个请求的 request 对象
+# 通过请求上下文变量解决model层无法获取当前登录用户的问题, 在DeviceTask model的custom_actions方法中被使用
+_current_request = ContextVar('current_request', default=None)
 
-def get_current_request(): # 从线程本地存储中，获取当前线程（当前请求）存的 request 对象
-    return getattr(_thread_locals, 'request', None)
+def get_current_request(): # 获取当前请求的 request 对象，不在请求中时为None
+    return _current_request.get()
 
 def get_current_user(): # 直接获取当前登录用户
-    request = get_current_request()
-    if request and hasattr(request, 'user'):
+    request = _current_request.get()
+    if request is not None and hasattr(request, 'user'):
         return request.user
     return None
 
+@sync_and_async_middleware  # 同步/异步中间件栈都直接使用，不需要Django做sync/async适配（适配会多一次线程切换）
 class ThreadLocalMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        _thread_locals.request = request # 把request对象存入当前请求对应的线程中
-        response = self.get_response(request)
-        return response
\ No newline at end of file
+        if self.async_mode:
+            return self.__acall__(request)
+        token = _current_request.set(request) # 把request对象存入当前请求的上下文
+        try:
+            return self.get_response(request)
+        finally:
+            _current_request.reset(token) # 异常时也要还原，避免泄漏到同一线程的下一个请求
+
+    async def __acall__(self, request):
+        token = _current_request.set(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            _current_request.reset(token)
+
+
+'''
+    viewflow在导入时（viewflow/__init__.py）会把 viewflow.middleware.SiteMiddleware 和 HotwireTurboMiddleware 追加到MIDDLEWARE末尾，
+    这两个都只支持同步：ASGI下Django为了它们把整个中间件栈降级成同步，用一个SyncToAsync包起来，
+    所有请求都在Django唯一的同步线程里执行，异步视图也被async_to_sync调用，没有任何并发。
+    这里是两者的同步/异步版本，在settings.MIDDLEWARE中显式配置（VIEWFLOW_MIDDLEWARE），
+    WorkflowsConfig.ready()再把viewflow自动追加的原版去掉
+'''
+# viewflow自动追加的中间件 → 本地的同步/异步版本
+VIEWFLOW_MIDDLEWARE = {
+    'viewflow.middleware.SiteMiddleware': 'workflows.middleware.SiteMiddleware',
+    'viewflow.middleware.HotwireTurboMiddleware': 'workflows.middleware.HotwireTurboMiddleware',
+}
+
+
+@sync_and_async_middleware
+class SiteMiddleware(viewflow_middleware.SiteMiddleware):
+    """
+    viewflow的SiteMiddleware：按URL上挂的site/app做查看权限校验，把site/app等属性设置到request.resolver_match上
+    异步中间件栈中，只有viewflow的URL（url_name上有extra）才到同步线程里校验权限（has_perm可能查库），其他请求直接放行
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            self.process_view = self.aprocess_view
+            self.process_template_response = self.aprocess_template_response
+
+    def __call__(self, request):
+        # 异步模式下get_response返回协程，直接交给上层await
+        return self.get_response(request)
+
+    async def aprocess_view(self, request, callback, callback_args, callback_kwargs):
+        match = request.resolver_match
+        if hasattr(request, 'user') and not (match and getattr(match.url_name, 'extra', None)):
+            return None
+        return await sync_to_async(viewflow_middleware.SiteMiddleware.process_view)(
+            self, request, callback, callback_args, callback_kwargs
+        )
+
+    async def aprocess_template_response(self, request, response):
+        if getattr(request.resolver_match, 'app', None) is None:
+            return response
+        return await sync_to_async(viewflow_middleware.SiteMiddleware.process_template_response)(
+            self, request, response
+        )
+
+
+@sync_and_async_middleware
+class HotwireTurboMiddleware:
+    """viewflow的HotwireTurboMiddleware：Turbo提交的表单，200（表单有错）改为422、301改为303"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process_response(request, await self.get_response(request))
+
+    @staticmethod
+    def process_response(request, response):
+        if request.method == 'POST' and request.META.get('HTTP_X_REQUEST_FRAMEWORK') == 'Turbo':
+            if response.status_code == 200:
+                response.status_code = 422
+            elif response.status_code == 301:
+                response.status_code = 303
+        return response
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.5 on 2026-10-17 16:25
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    '''
+        viewflow_task表属于viewflow应用，不能在DeviceTask的Meta中声明索引，这里用RunSQL补一个(process_id, flow_task)组合索引，
+        分支节点按“流程+节点”查找任务（workflows/decisions.py）时走索引，而不是扫描流程下的全部任务
+    '''
+
+    dependencies = [
+        ('workflows', '0002_remove_devicetask_analysis_result_and_more'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX IF NOT EXISTS workflows_task_process_flow_idx ON viewflow_task (process_id, flow_task);',
+            reverse_sql='DROP INDEX IF EXISTS workflows_task_process_flow_idx;',
+        ),
+    ]
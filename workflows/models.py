@@ -1,5 +1,6 @@
 from django.contrib.contenttypes.fields import GenericRelation
 from django.db import models
+from django.utils import timezone
 from django.http import HttpResponseForbidden
 from django.urls import reverse
 
@@ -13,6 +14,7 @@ from workflows.middleware import get_current_user
 '''
 DeviceProcess:device、department
 DeviceTask:process、analysis_result、operation_record
+Job:后台任务队列（workflows/jobs.py）
 '''
 
 # Create your models here.
@@ -42,9 +44,17 @@ class DeviceProcess(BaseProcess):
 
     def getCurrentNode(self):
         # 用于在process列表页展示当前process的当前处理节点
-         return DeviceTask.objects.filter(
-            process_id = self.pk
-        ).order_by("-id").first().flow_task
+        # 列表页(ProcessListView)已经用with_current_node()注解好了，直接返回，不再逐行查询
+        if hasattr(self, 'current_node'):
+            return self.current_node
+        task = DeviceTask.objects.filter(process_id=self.pk).order_by("-id").only('flow_task').first()
+        return task.flow_task if task else None
+
+    @staticmethod
+    def with_current_node(queryset):
+        """给process queryset注解current_node（最新一个task的节点），一条SQL带出所有行的当前节点"""
+        latest_task = DeviceTask.objects.filter(process_id=models.OuterRef('pk')).order_by('-id')
+        return queryset.annotate(current_node=models.Subquery(latest_task.values('flow_task')[:1]))
 
 
 
@@ -59,80 +69,49 @@ class DeviceTask(BaseTask):  # 流程节点的任务实例（一次任务对应
     # 用于区分数据是否已提交，可审核
     data_submitted = models.BooleanField(default=False, verbose_name="是否已提交数据")
 
-    # process详情页需要展示
+    # process详情页需要展示，详情页(ProcessDetailView)已经用attach_records批量查好了，直接返回
     def get_operation_record(self):
+        if hasattr(self, '_operation_records'):
+            return self._operation_records
         return OperationRecord.objects.filter(task__pk = self.pk).order_by("id")
 
 
     def get_analysis_result(self):
+        if hasattr(self, '_analysis_results'):
+            return self._analysis_results
         return AnalysisResults.objects.filter(task__pk = self.pk).order_by("id")
 
+    @staticmethod
+    def attach_records(tasks, process):
+        """
+        一次查出tasks的全部操作记录和分析结果（各1条SQL），按task_id分组挂到每个task上
+        记录的__str__会访问process.device.sn和number.username：员工用select_related带出，process直接复用已加载的对象
+        """
+        by_task = {task.pk: task for task in tasks}
+        for task in tasks:
+            task._operation_records = []
+            task._analysis_results = []
+        if not by_task:
+            return
+        records = OperationRecord.objects.filter(task_id__in=by_task).select_related('number').order_by('id')
+        results = AnalysisResults.objects.filter(task_id__in=by_task).select_related('number', 'operation').order_by('id')
+        for items, attr in ((records, '_operation_records'), (results, '_analysis_results')):
+            for item in items:
+                if item.process_id == process.pk:
+                    item.process = process
+                getattr(by_task[item.task_id], attr).append(item)
+
 
     @property  # 方法的 “属性化封装”，使得在process_dashboard.html中调用时无需加括号
     def custom_actions(self):    # viewflow提供的钩子方法(templates\viewflow\workflow\process_dashboard.html页面提供的)，通过自定义实现去定义index页的标签展示以及对应的处理路由
-        user = get_current_user() # 通过线程局部变量获取用户，（定义的中间件ThreadLocalMiddleware把request对象传到threading.local对象中）
-        user_roles = [g.name for g in user.groups.all()]  # 获取当前登录的用户的用户角色  普通员工/部门主管
-        actions = []
-
-        if not user or not user.is_authenticated:    # 用户未登录
-            return actions # 不能进行任何操作
-
-        try:
-            with self.activation() as activation:
-                # 调用 activation 的方法, 获取当前可获得的转换（经过了状态校验和权限校验），其中权限校验主要是校验节点的permission参数
-                transitions = activation.get_available_transitions(user)
-                print(transitions,self.pk,'transitions')
-                for transition in transitions:
-                    label = transition.label
-                    if label == 'Assign':
-                        # 生成对应的 URL ，Django 普通方式（需要手动指定命名空间）
-                        url = reverse("assign", kwargs={
-                            'process_pk': self.process_id,
-                            'node_name': self.flow_task.name,
-                            'task_pk': self.id
-                        })
-                        if '部门主管' not in user_roles:
-                            label = '待主管分配'
-                    elif label == 'Cancel':
-                        # 生成对应的 URL   ViewFlow 的方式（自动生成带命名空间的URL）
-                        url = self.flow_task.reverse(
-                            'cancel',
-                            args=[self.process_id, self.id]
-                        )
-                    elif label == 'Upload Data':
-                            url = self.flow_task.reverse(
-                                'execute',
-                                args=[self.process_id, self.id]
-                            )
-                    elif label == 'Unassign':
-                        url = self.flow_task.reverse(
-                            'unassign',
-                            args=[self.process_id, self.id]
-                        )
-                    elif label == 'Reassign':
-                        # 这里要改,viewflow中虽然提供了名为reassign的状态转换函数，但并没有处理reassign的路由
-                        continue
-                        # url = self.flow_task.reverse(
-                        #     'detail',
-                        #     args=[self.process_id, self.id]
-                        # )
-                    elif label == 'Approve':
-                        # 生成对应的 URL ，Django 普通方式（需要手动指定命名空间）
-                        url = reverse("approve", kwargs={
-                            'process_pk': self.process_id,
-                            'node_name': self.flow_task.name,
-                            'task_pk': self.id
-                        })
-                        if '部门主管' not in user_roles: # 普通员工
-                            label = '待主管审核'
-                    else:
-                        continue
-                    actions.append((label, url))
-                print('actions',actions,self.data_submitted)
-        except Exception as e:
-            print(f"custom_actions error: {e}")
-            # 出错时返回空列表，让模板回退到默认逻辑
-        return actions
+        # dashboard视图(DeviceDashboardView)已经用DashboardActionResolver批量算好了，直接返回
+        if hasattr(self, '_custom_actions'):
+            return self._custom_actions
+        # 单独访问时（非dashboard），退化为只包含当前任务的批量解析
+        from workflows.actions import DashboardActionResolver
+        user = get_current_user() # 通过请求上下文获取用户（中间件ThreadLocalMiddleware把request对象存入ContextVar）
+        self._custom_actions = DashboardActionResolver(user).resolve([self]).get(self.pk, [])
+        return self._custom_actions
 
 
 
@@ -140,4 +119,39 @@ class DeviceTask(BaseTask):  # 流程节点的任务实例（一次任务对应
 
 class Meta:
         verbose_name = "设备处理任务"
-        verbose_name_plural = "设备处理任务列表"
\ No newline at end of file
+        verbose_name_plural = "设备处理任务列表"
+
+
+class Job(models.Model):
+    """后台任务：流转后的慢操作（建聊天室、发通知等）写入该表，由 manage.py run_jobs 执行，详见workflows/jobs.py"""
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', '待执行'
+        RUNNING = 'running', '执行中'
+        DONE = 'done', '已完成'
+        FAILED = 'failed', '失败'
+
+    name = models.CharField(max_length=100, verbose_name="任务名")
+    payload = models.JSONField(default=dict, blank=True, verbose_name="参数")
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    # 幂等键：同一个键只会入队一次（NULL不参与唯一约束）
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name="已执行次数")
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now, verbose_name="最早执行时间")
+    locked_by = models.CharField(max_length=100, blank=True, default='')
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "后台任务"
+        verbose_name_plural = "后台任务列表"
+        indexes = [
+            # worker取任务：status等值 + run_at范围，按run_at顺序
+            models.Index(fields=['status', 'run_at'], name='job_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name}#{self.pk}({self.status})"
\ No newline at end of file
@@ -0,0 +1,112 @@
+# workflows/permission_cache.py
+from functools import lru_cache
+
+from django.apps import apps
+from django.core.cache import cache
+
+"""
+    NodePermissionMiddleware使用的权限缓存
+    1. 节点→部门表：启动时（中间件__init__）从WORKFLOW_NODE_DEPARTMENTS构建一次，部门名预先strip().lower()
+    2. 用户快照：用户的部门名和角色名（同样预先格式化），按请求缓存在request上，跨请求缓存在Django的cache框架中，
+       Employee、Group成员关系、Group、Department变更时由信号失效（信号在WorkflowsConfig.ready()中注册）
+    3. task→节点名：一个task绑定的节点创建后不会再变，用有上限的LRU缓存
+    目标：同一用户重复访问时，权限校验不产生额外的SQL
+"""
+
+# 用户快照在缓存中的key前缀和过期时间（秒），过期只是兜底，正常依赖信号失效
+SNAPSHOT_KEY_PREFIX = 'workflows:perm:user'
+SNAPSHOT_VERSION_KEY = 'workflows:perm:version'
+SNAPSHOT_TIMEOUT = 60 * 60
+# 请求对象上缓存快照的属性名
+REQUEST_ATTR = '_workflow_permission_snapshot'
+# task→节点名 LRU缓存的容量
+TASK_NODE_CACHE_SIZE = 4096
+
+
+def normalize(name):
+    """统一转小写，去空格，避免大小写/空格误判"""
+    return name.strip().lower()
+
+
+def build_node_department_table(node_departments):
+    """把 {节点名: [部门名]} 预处理成 {节点名: (原始部门列表, 格式化后的部门集合)}"""
+    return {
+        node_name.strip(): (list(departments), frozenset(normalize(d) for d in departments))
+        for node_name, departments in node_departments.items()
+    }
+
+
+@lru_cache(maxsize=TASK_NODE_CACHE_SIZE)
+def get_task_node_name(task_pk):
+    """查询task绑定的节点名，task不存在时抛出DoesNotExist（异常不会被lru_cache缓存）"""
+    DeviceTask = apps.get_model('workflows', 'DeviceTask')
+    flow_task = DeviceTask.objects.filter(pk=task_pk).values_list('flow_task', flat=True).get()
+    return flow_task.name.strip()
+
+
+def _snapshot_key(user_pk):
+    # key中带上全局版本号，Group/Department变更时只需要递增版本号，就能让所有用户快照失效
+    version = cache.get_or_set(SNAPSHOT_VERSION_KEY, 1, None)
+    return f'{SNAPSHOT_KEY_PREFIX}:{version}:{user_pk}'
+
+
+def _build_snapshot(user):
+    Employee = apps.get_model('accounts', 'Employee')
+    row = Employee.objects.filter(pk=user.pk).values_list('department__name', flat=True).first()
+    role_names = list(user.groups.values_list('name', flat=True))
+    return {
+        'department_name': row,
+        'department': normalize(row) if row else None,
+        'role_names': role_names,
+        'roles': frozenset(normalize(r) for r in role_names),
+    }
+
+
+def get_user_snapshot(request):
+    """获取当前用户的部门/角色快照：先查request，再查cache，都没有时才查库"""
+    snapshot = getattr(request, REQUEST_ATTR, None)
+    if snapshot is not None:
+        return snapshot
+    user = request.user
+    key = _snapshot_key(user.pk)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = _build_snapshot(user)
+        cache.set(key, snapshot, SNAPSHOT_TIMEOUT)
+    setattr(request, REQUEST_ATTR, snapshot)
+    return snapshot
+
+
+def invalidate_user(*user_pks):
+    """清除指定用户的快照"""
+    keys = [_snapshot_key(pk) for pk in user_pks]
+    if keys:
+        cache.delete_many(keys)
+
+
+def invalidate_all():
+    """递增版本号，让全部用户快照失效（部门改名、角色组改名/删除等影响多个用户的变更）"""
+    try:
+        cache.incr(SNAPSHOT_VERSION_KEY)
+    except ValueError:  # key不存在（已过期或被清空），旧快照的key本来也对不上了
+        cache.set(SNAPSHOT_VERSION_KEY, 2, None)
+
+
+# ===== 信号接收器（在WorkflowsConfig.ready()中注册） =====
+def employee_changed(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+def employee_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear', 'pre_clear'):
+        return
+    if not reverse:  # employee.groups.add(...)，instance是员工
+        invalidate_user(instance.pk)
+    elif pk_set:  # group.user_set.add(...)，instance是角色组，pk_set是员工
+        invalidate_user(*pk_set)
+    else:  # group.user_set.clear()，不知道影响了哪些员工
+        invalidate_all()
+
+
+def group_or_department_changed(sender, **kwargs):
+    invalidate_all()
@@ -0,0 +1,124 @@
+# workflows/state.py
+from collections import Counter, defaultdict
+
+from django.db import models, transaction
+from django.dispatch import Signal
+
+from devices.models import Device, DeviceState
+from workflows.models import DeviceProcess, DeviceTask
+
+"""
+    DeviceState投影表的计算与同步
+    一台设备的当前状态 = 最新的流程（按id） + 该流程最新的task（按id） + Device.current_position
+    build_states()按设备批量计算（3条SQL，与设备数量无关），以下场景在各自的事务中调用refresh_device_states()：
+        1、CustomViewActivation的assign/unassign/reassign/start/complete/cancel/undo/revive（complete会激活下一个节点，流程结束时流程状态变为DONE），
+           以及审核驳回（BaseApprovalView，task回到ASSIGNED）
+        2、启动流程（StartProcessView、批量入库DeviceIntake）
+        3、位置变更（PositionCreateView）
+    迁移devices/0013在上线时回填已有设备（计算逻辑在迁移中固化一份）；manage.py rebuild_device_state 用同一套计算按块重算全部设备
+    refresh_device_states()在事务提交后发出device_states_changed信号，携带按节点/位置/专案统计的设备数变化量，
+    实时状态看板（chat/board.py）据此推送增量，不轮询数据库
+"""
+
+STATE_FIELDS = ['process', 'current_node', 'status', 'task_status', 'owner', 'last_transition_at', 'current_position']
+# 看板统计的维度 → 变化量中的key
+BOARD_DIMENSIONS = ('node', 'position', 'project')
+
+# 参数delta: {'node': {节点名: 变化量}, 'position': {...}, 'project': {...}}，只包含非0项
+device_states_changed = Signal()
+
+
+def _latest(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def build_states(device_ids):
+    """根据流程/任务/设备表计算设备的当前状态，返回未保存的DeviceState列表"""
+    latest_process = DeviceProcess.objects.filter(device_id=models.OuterRef('pk')).order_by('-id').values('pk')[:1]
+    devices = list(
+        Device.objects.filter(pk__in=device_ids)
+        .annotate(latest_process_id=models.Subquery(latest_process))
+        .values('pk', 'current_position', 'latest_process_id')
+    )
+    process_ids = [row['latest_process_id'] for row in devices if row['latest_process_id']]
+    latest_task = DeviceTask.objects.filter(process_id=models.OuterRef('pk')).order_by('-id').values('pk')[:1]
+    processes = {
+        row['pk']: row for row in
+        DeviceProcess.objects.filter(pk__in=process_ids)
+        .annotate(latest_task_id=models.Subquery(latest_task))
+        .values('pk', 'status', 'created', 'finished', 'latest_task_id')
+    }
+    tasks = {
+        task.process_id: task for task in
+        DeviceTask.objects.filter(pk__in=[p['latest_task_id'] for p in processes.values() if p['latest_task_id']])
+        .only('process_id', 'flow_task', 'status', 'owner_id', 'created', 'assigned', 'started', 'finished')
+    }
+
+    states = []
+    for row in devices:
+        state = DeviceState(device_id=row['pk'], current_position=row['current_position'])
+        process = processes.get(row['latest_process_id'])
+        if process is not None:
+            state.process_id = process['pk']
+            state.status = process['status']
+            state.last_transition_at = _latest(process['created'], process['finished'])
+            task = tasks.get(process['pk'])
+            if task is not None:
+                state.current_node = task.flow_task.name if task.flow_task else ''
+                state.task_status = task.status
+                state.owner_id = task.owner_id
+                state.last_transition_at = _latest(
+                    state.last_transition_at, task.created, task.assigned, task.started, task.finished
+                )
+        states.append(state)
+    return states
+
+
+def save_states(states):
+    """一条upsert写入"""
+    DeviceState.objects.bulk_create(
+        states, update_conflicts=True, unique_fields=['device'], update_fields=STATE_FIELDS,
+    )
+
+
+def state_delta(before, states, projects):
+    """
+    投影更新前后按维度统计的设备数变化量
+        before: {设备id: (节点, 位置)}，没有投影的设备不在其中；states: 新的DeviceState列表；projects: {设备id: 专案}
+    """
+    delta = defaultdict(Counter)
+    for device_id, (node, position) in before.items():
+        for dimension, value in zip(BOARD_DIMENSIONS, (node, position, projects.get(device_id))):
+            if value:
+                delta[dimension][value] -= 1
+    for state in states:
+        for dimension, value in zip(BOARD_DIMENSIONS,
+                                    (state.current_node, state.current_position, projects.get(state.device_id))):
+            if value:
+                delta[dimension][value] += 1
+    return {dimension: {k: v for k, v in counts.items() if v} for dimension, counts in delta.items()
+            if any(counts.values())}
+
+
+def refresh_device_states(*device_ids):
+    """重算并保存指定设备的状态；在调用方的事务中执行，事务回滚时投影一起回滚"""
+    device_ids = [pk for pk in device_ids if pk is not None]
+    if not device_ids:
+        return
+    with transaction.atomic():
+        listening = device_states_changed.has_listeners()
+        if listening:
+            # 一次LEFT JOIN取更新前的投影和专案，用于计算看板变化量
+            before, projects = {}, {}
+            for pk, project, has_state, node, position in Device.objects.filter(pk__in=device_ids).values_list(
+                    'pk', 'project', 'state__device_id', 'state__current_node', 'state__current_position'):
+                projects[pk] = project
+                if has_state is not None:
+                    before[pk] = (node, position)
+        states = build_states(device_ids)
+        save_states(states)
+        if listening:
+            delta = state_delta(before, states, projects)
+            if delta:
+                transaction.on_commit(lambda: device_states_changed.send(sender=DeviceState, delta=delta))
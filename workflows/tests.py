@@ -1,3 +1,648 @@
-from django.test import TestCase
+import asyncio
+import csv
+from importlib import import_module
+import io
+import tempfile
+from unittest import mock
+import zipfile
+from xml.etree import ElementTree
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import Group
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory, override_settings
 
 # Create your tests here.
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from viewflow.workflow import STATUS
+
+from accounts.models import Employee
+from departments.models import Department
+from devices.models import Device, DeviceState, OperationRecord, AnalysisResults
+from workflows.actions import DashboardActionResolver
+from workflows.BaseView import BaseApprovalView
+from workflows.decisions import latest_result, latest_results
+from workflows.exports import write_xlsx
+from workflows.flows import DeviceInvestigationFlow
+from workflows.intake import DeviceIntake, parse_rows
+from workflows.jobs import enqueue, job, run_due_jobs
+from workflows.middleware import NodePermissionMiddleware, ThreadLocalMiddleware, get_current_request, get_current_user
+from workflows.models import DeviceProcess, DeviceTask, Job
+from workflows.permission_cache import get_task_node_name
+from workflows.state import build_states
+
+
+def create_employee(username, **kwargs):
+    return Employee.objects.create_user(
+        username=username,
+        password='password',
+        email=f'{username}@example.com',
+        number=username[:10],
+        **kwargs
+    )
+
+
+def create_task(sn, flow_task=None, status=STATUS.NEW, owner=None, data_submitted=False):
+    # 直接创建process和task，绕过视图，用于构造dashboard数据
+    device = Device.objects.create(sn=sn)
+    process = DeviceProcess.objects.create(device=device, flow_class=DeviceInvestigationFlow)
+    return DeviceTask.objects.create(
+        process=process,
+        flow_task=flow_task or DeviceInvestigationFlow.production_test_fail,
+        status=status,
+        owner=owner,
+        data_submitted=data_submitted,
+    )
+
+
+class DashboardActionResolverTest(TestCase):
+    def setUp(self):
+        self.supervisor = create_employee('supervisor', is_superuser=True)
+        self.supervisor.groups.add(Group.objects.create(name='部门主管'))
+        self.staff = create_employee('staff')
+
+    def test_assign_label_depends_on_role(self):
+        task = create_task('SN0001')
+        supervisor_actions = DashboardActionResolver(self.supervisor).resolve([task])[task.pk]
+        staff_actions = DashboardActionResolver(self.staff).resolve([task])[task.pk]
+        self.assertIn('Assign', [label for label, _ in supervisor_actions])
+        self.assertIn('待主管分配', [label for label, _ in staff_actions])
+
+    def test_data_submitted_switches_upload_and_approve(self):
+        pending = create_task('SN0002', status=STATUS.STARTED, owner=self.staff)
+        submitted = create_task('SN0003', status=STATUS.STARTED, owner=self.staff, data_submitted=True)
+        actions = DashboardActionResolver(self.staff).resolve([pending, submitted])
+        self.assertEqual(['Upload Data'], [label for label, _ in actions[pending.pk]])
+        self.assertEqual(['待主管审核'], [label for label, _ in actions[submitted.pk]])
+
+    def test_anonymous_user_has_no_actions(self):
+        task = create_task('SN0004')
+        self.assertEqual({task.pk: []}, DashboardActionResolver(None).resolve([task]))
+
+    def test_resolve_query_count_is_constant(self):
+        # 任务预加载1条 + 用户权限2条（Django按用户实例缓存） + 用户角色1条，与任务数量无关
+        small = [create_task(f'SMALL{i}', status=STATUS.ASSIGNED, owner=self.staff) for i in range(3)]
+        large = [create_task(f'LARGE{i}', status=STATUS.ASSIGNED, owner=self.staff) for i in range(30)]
+        for tasks in (small, large):
+            user = Employee.objects.get(pk=self.staff.pk)  # 每轮用新的用户实例，模拟新的请求
+            with self.assertNumQueries(4):
+                DashboardActionResolver(user).resolve(tasks)
+
+
+class DeviceDashboardViewTest(TestCase):
+    def setUp(self):
+        self.user = create_employee('supervisor', is_superuser=True, is_staff=True)
+        self.user.groups.add(Group.objects.create(name='部门主管'))
+        self.client.force_login(self.user)
+        self.url = reverse('deviceinvestigation:index')
+
+    def count_dashboard_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code)
+        return len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_dashboard_size(self):
+        create_task('SN0000')
+        baseline = self.count_dashboard_queries()
+        for i in range(1, 20):
+            create_task(f'SN{i:04d}', status=STATUS.ASSIGNED, owner=self.user)
+        for i in range(20, 25):
+            create_task(f'SN{i:04d}', flow_task=DeviceInvestigationFlow.X_ray_test,
+                        status=STATUS.STARTED, owner=self.user, data_submitted=True)
+        self.assertEqual(baseline, self.count_dashboard_queries())
+
+    def test_actions_are_rendered(self):
+        task = create_task('SN0100')
+        response = self.client.get(self.url)
+        self.assertContains(response, reverse('assign', kwargs={
+            'process_pk': task.process_id,
+            'node_name': 'production_test_fail',
+            'task_pk': task.pk,
+        }))
+
+
+class FakeActivation:
+    # 分支节点的lambda只用到activation.process
+    def __init__(self, process):
+        self.process = process
+
+
+class DecisionResultTest(TestCase):
+    def setUp(self):
+        self.user = create_employee('analyst')
+        self.task = create_task('SN0200', flow_task=DeviceInvestigationFlow.FAE_initial_retest)
+        self.process = self.task.process.coerced
+
+    def add_result(self, task, result):
+        operation = OperationRecord.objects.create(process=self.process, task=task, action='复测', number=self.user)
+        return AnalysisResults.objects.create(process=self.process, task=task, operation=operation,
+                                              number=self.user, result=result, analysis_notes='')
+
+    def test_latest_result_single_query_and_memo(self):
+        self.add_result(self.task, False)
+        self.add_result(self.task, True)
+        activation = FakeActivation(self.process)
+        with self.assertNumQueries(1):
+            self.assertIs(True, latest_result(activation, 'FAE_initial_retest'))
+        with self.assertNumQueries(0):  # 同一个activation内重复判断不再查库
+            self.assertIs(True, latest_result(activation, 'FAE_initial_retest'))
+
+    def test_latest_result_without_record_is_none(self):
+        self.assertIsNone(latest_result(FakeActivation(self.process), 'X_ray_test'))
+
+    def test_latest_results_for_several_nodes_in_one_query(self):
+        ee_task = DeviceTask.objects.create(process=self.process, flow_task=DeviceInvestigationFlow.engineering_analysis)
+        self.add_result(ee_task, False)
+        self.add_result(self.task, True)
+        with self.assertNumQueries(1):
+            results = latest_results(FakeActivation(self.process), 'engineering_analysis', 'me_analysis', 'FAE_initial_retest')
+        self.assertEqual([False, None, True], results)
+
+
+class NodePermissionCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_task_node_name.cache_clear()
+        self.user = create_employee('manager')
+        self.department = Department.objects.create(name=' 产线 ', manager_number=self.user, telephone='1')
+        self.user.department = self.department
+        self.user.save()
+        self.supervisor_group = Group.objects.create(name='部门主管')
+        self.user.groups.add(self.supervisor_group)
+        self.task = create_task('SN0300')
+        self.middleware = NodePermissionMiddleware(lambda request: None)
+        self.path = f'/workflows/deviceinvestigation/{self.task.process_id}/production_test_fail/{self.task.pk}/assign/'
+
+    def check(self):
+        request = RequestFactory().get(self.path)
+        request.user = Employee.objects.get(pk=self.user.pk)  # 每次都是新的请求和用户实例
+        return self.middleware.process_view(request, None, (), {'task_pk': self.task.pk})
+
+    def test_repeat_check_makes_no_queries(self):
+        self.assertIsNone(self.check())
+        request = RequestFactory().get(self.path)
+        request.user = Employee.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.middleware.process_view(request, None, (), {'task_pk': self.task.pk}))
+
+    def test_group_membership_change_invalidates_snapshot(self):
+        self.assertIsNone(self.check())
+        self.user.groups.remove(self.supervisor_group)
+        self.assertEqual(403, self.check().status_code)
+        self.supervisor_group.user_set.add(self.user)
+        self.assertIsNone(self.check())
+
+    def test_department_change_invalidates_snapshot(self):
+        self.assertIsNone(self.check())
+        self.department.name = 'FAE'
+        self.department.save()
+        self.assertEqual(403, self.check().status_code)
+
+    def test_missing_task_is_forbidden(self):
+        request = RequestFactory().get(self.path)
+        request.user = self.user
+        self.assertEqual(403, self.middleware.process_view(request, None, (), {'task_pk': 999999}).status_code)
+
+
+class ProcessListViewTest(TestCase):
+    def setUp(self):
+        self.user = create_employee('viewer')
+        self.client.force_login(self.user)
+        self.url = reverse('process_list')
+
+    def count_list_queries(self, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url, params)
+        self.assertEqual(200, response.status_code)
+        return len(ctx.captured_queries), response
+
+    def test_query_count_does_not_grow_with_rows(self):
+        for i in range(2):
+            create_task(f'LIST{i:04d}')
+        baseline, _ = self.count_list_queries()
+        for i in range(2, 10):
+            create_task(f'LIST{i:04d}')
+        count, response = self.count_list_queries()
+        self.assertEqual(baseline, count)
+        self.assertContains(response, 'Production Test Fail')
+
+    def test_keyset_pagination(self):
+        tasks = [create_task(f'PAGE{i:04d}') for i in range(25)]
+        _, first = self.count_list_queries()
+        cursor = first.context['next_cursor']
+        self.assertEqual(tasks[15].process_id, cursor)
+        _, second = self.count_list_queries(after=cursor)
+        self.assertEqual([t.process_id for t in reversed(tasks[5:15])], [p.pk for p in second.context['processes']])
+        _, last = self.count_list_queries(after=tasks[5].process_id)
+        self.assertEqual(5, len(last.context['processes']))
+        self.assertIsNone(last.context['next_cursor'])
+
+
+# 复测循环中经过的数据节点：FAE复测 → X-ray → FAE终测，每个节点一条操作记录+一条分析结果
+RETEST_LOOP_NODES = (
+    DeviceInvestigationFlow.FAE_initial_retest,
+    DeviceInvestigationFlow.X_ray_test,
+    DeviceInvestigationFlow.FAE_final_retest,
+)
+
+
+def create_retest_loops(process, user, loops):
+    """基准数据：构造一个在复测节点之间循环了loops次的process"""
+    for _ in range(loops):
+        for node in RETEST_LOOP_NODES:
+            task = DeviceTask.objects.create(process=process, flow_task=node, flow_task_type='HUMAN',
+                                             status=STATUS.DONE, owner=user)
+            operation = OperationRecord.objects.create(process=process, task=task, action='复测', number=user)
+            AnalysisResults.objects.create(process=process, task=task, operation=operation, number=user,
+                                           result=False, analysis_notes='fail')
+
+
+class ProcessDetailViewTest(TestCase):
+    def setUp(self):
+        self.user = create_employee('fae')
+        self.client.force_login(self.user)
+
+    def count_detail_queries(self, process):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('process_detail', args=[process.pk]))
+        self.assertEqual(200, response.status_code)
+        return len(ctx.captured_queries), response
+
+    def test_query_count_does_not_grow_with_loops(self):
+        small = create_task('DETAIL1').process
+        create_retest_loops(small, self.user, 1)
+        large = create_task('DETAIL50').process
+        create_retest_loops(large, self.user, 50)
+        small_count, _ = self.count_detail_queries(small)
+        large_count, response = self.count_detail_queries(large)
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(151, len(response.context['data_tasks']))  # 产线测试节点 + 50轮 × 3个复测节点
+        self.assertContains(response, 'fae的操作:复测', count=150)
+
+    def test_records_grouped_by_task(self):
+        process = create_task('DETAIL2').process
+        create_retest_loops(process, self.user, 2)
+        _, response = self.count_detail_queries(process)
+        for task in response.context['data_tasks'][1:]:  # 跳过没有记录的产线测试节点
+            self.assertEqual([task.pk], [r.task_id for r in task.get_operation_record()])
+            self.assertEqual([task.pk], [r.task_id for r in task.get_analysis_result()])
+
+
+INTAKE_CSV = (
+    'sn,project,hardware_version,fail_station,failure_mode\n'
+    'INTAKE001,X2301,EVT1,FCT,wifi_rssi\n'
+    'INTAKE002,X2301,EVT1,FCT,bt_tx_power\n'
+    ',X2301,EVT1,FCT,no_sn\n'
+    'INTAKE001,X2301,EVT1,FCT,duplicate\n'
+    'INTAKE003,X2301,EVT1,FCT,' + 'x' * 40 + '\n'
+)
+
+
+class DeviceIntakeTest(TestCase):
+    def setUp(self):
+        self.user = create_employee('line')
+
+    def test_upsert_and_start_flows(self):
+        existing = Device.objects.create(sn='INTAKE002', project='OLD', software_version='ROM1')
+        summary = DeviceIntake(self.user, chunk_size=10).run(parse_rows(io.StringIO(INTAKE_CSV), 'csv'))
+        self.assertEqual((5, 1, 1, 2), (summary['total'], summary['created'], summary['updated'], summary['started']))
+        self.assertEqual([3, 4, 5], [e['row'] for e in summary['errors']])
+        existing.refresh_from_db()
+        self.assertEqual(('X2301', 'ROM1'), (existing.project, existing.software_version))  # 没填的字段保留原值
+        process = DeviceProcess.objects.get(device__sn='INTAKE001')
+        self.assertEqual(['production_test_fail'], [
+            t.flow_task.name for t in DeviceTask.objects.filter(process=process, flow_task_type='HUMAN')
+        ])
+
+    def test_running_process_is_not_started_twice(self):
+        rows = [{'sn': 'INTAKE010', 'project': 'X2301'}]
+        DeviceIntake(self.user).run(rows)
+        summary = DeviceIntake(self.user).run(rows)
+        self.assertEqual((0, 1), (summary['started'], summary['skipped']))
+        self.assertEqual(1, DeviceProcess.objects.filter(device__sn='INTAKE010').count())
+
+    def test_http_endpoint_streams_ndjson(self):
+        self.client.force_login(self.user)
+        body = '{"sn": "INTAKE020"}\n{"sn": "INTAKE021"}\nnot json\n'
+        response = self.client.post(reverse('device_intake'), body, content_type='application/x-ndjson')
+        self.assertEqual(200, response.status_code)
+        data = response.json()
+        self.assertEqual(2, data['started'])
+        self.assertEqual(3, data['errors'][0]['row'])
+
+    def test_command(self):
+        out = io.StringIO()
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, encoding='utf-8') as f:
+            f.write(INTAKE_CSV)
+        call_command('intake_devices', f.name, user='line', stdout=out)
+        self.assertIn('Successfully intake', out.getvalue())
+        self.assertEqual(2, Device.objects.filter(sn__startswith='INTAKE').count())  # 第5行字段超长
+
+
+class DeviceStateTest(TestCase):
+    def setUp(self):
+        self.user = create_employee('state_user')
+        self.task = create_task('STATE001')
+        self.device = self.task.process.device
+
+    def state(self):
+        return DeviceState.objects.select_related('owner').get(device=self.device)
+
+    def test_assign_and_start_update_projection(self):
+        activation = self.task.flow_task.activation_class(self.task)
+        activation.assign(self.user)
+        state = self.state()
+        self.assertEqual(('production_test_fail', STATUS.ASSIGNED, self.user), (state.current_node, state.task_status, state.owner))
+        self.assertEqual(self.task.process_id, state.process_id)
+        self.assertEqual(self.task.assigned, state.last_transition_at)
+
+        activation = self.task.flow_task.activation_class(self.task)
+        activation.start(RequestFactory().get('/'))
+        self.assertEqual(STATUS.STARTED, self.state().task_status)
+
+    def test_complete_moves_to_next_node(self):
+        activation = self.task.flow_task.activation_class(self.task)
+        activation.assign(self.user)
+        activation.start(RequestFactory().get('/'))
+        self.task.data_submitted = True
+        self.task.save()
+        activation.complete()
+        latest = DeviceTask.objects.filter(process=self.task.process).latest('id')
+        self.assertNotEqual(self.task.pk, latest.pk)
+        self.assertEqual(latest.flow_task.name, self.state().current_node)
+
+    def test_unassign_and_cancel_update_projection(self):
+        activation = self.task.flow_task.activation_class(self.task)
+        activation.assign(self.user)
+        activation.unassign()
+        state = self.state()
+        self.assertEqual((STATUS.NEW, None), (state.task_status, state.owner))
+        activation.cancel()
+        self.assertEqual(STATUS.CANCELED, self.state().task_status)
+
+    def test_reject_updates_projection(self):
+        activation = self.task.flow_task.activation_class(self.task)
+        activation.assign(self.user)
+        activation.start(RequestFactory().get('/'))
+        self.task.data_submitted = True
+        self.task.save()
+        request = RequestFactory().post('/', {'action': 'reject'})
+        request.user = self.user
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        response = BaseApprovalView.as_view()(request, process_pk=self.task.process_id,
+                                              node_name='production_test_fail', task_pk=self.task.pk)
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(STATUS.ASSIGNED, self.state().task_status)
+
+    def test_rebuild_command(self):
+        other = Device.objects.create(sn='STATE002', current_position='仓库A')  # 没有流程的设备也有投影
+        DeviceState.objects.all().delete()
+        out = io.StringIO()
+        call_command('rebuild_device_state', batch_size=1, stdout=out)
+        self.assertIn('Successfully rebuild 2', out.getvalue())
+        self.assertEqual('production_test_fail', self.state().current_node)
+        state = DeviceState.objects.get(device=other)
+        self.assertEqual(('仓库A', None, ''), (state.current_position, state.process_id, state.current_node))
+
+    def test_migration_backfill_matches_build_states(self):
+        # 0013迁移里固化的计算与build_states()一致
+        from django.apps import apps
+        backfill = import_module('devices.migrations.0013_backfill_devicestate').backfill_device_states
+        activation = self.task.flow_task.activation_class(self.task)
+        activation.assign(self.user)
+        Device.objects.create(sn='STATE003', current_position='仓库B')
+        fields = ['device_id', 'process_id', 'current_node', 'status', 'task_status', 'owner_id',
+                  'last_transition_at', 'current_position']
+        expected = [[getattr(state, field) for field in fields] for state in
+                    build_states(Device.objects.order_by('pk').values_list('pk', flat=True))]
+        DeviceState.objects.all().delete()
+        backfill(apps, None)
+        self.assertEqual(expected, [list(row) for row in DeviceState.objects.order_by('device_id').values_list(*fields)])
+
+    def test_build_states_query_count_is_constant(self):
+        for i in range(5):
+            create_task(f'STATEQ{i:03d}')
+        with self.assertNumQueries(3):
+            build_states(Device.objects.values_list('pk', flat=True))
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.user = create_employee('exporter')
+        self.client.force_login(self.user)
+        self.processes = []
+        for i in range(3):
+            task = create_task(f'EXPORT{i:03d}', status=STATUS.DONE, owner=self.user)
+            self.processes.append(task.process)
+            operation = OperationRecord.objects.create(process=task.process, task=task, action='复测', number=self.user)
+            AnalysisResults.objects.create(process=task.process, task=task, operation=operation, number=self.user,
+                                           result=True, analysis_notes='pass, "ok"\n换行')
+
+    def download(self, dataset, **params):
+        response = self.client.get(reverse('export', args=[dataset]), params)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def csv_rows(self, dataset, **params):
+        _, content = self.download(dataset, **params)
+        return list(csv.reader(io.StringIO(content.decode('utf-8-sig'))))
+
+    def test_csv_and_resume(self):
+        rows = self.csv_rows('analysis')
+        self.assertEqual(['id', 'SN', '流程id', '节点'], rows[0][:4])
+        self.assertEqual(4, len(rows))
+        self.assertEqual(['EXPORT000', 'production_test_fail', 'True', 'pass, "ok"\n换行'],
+                         [rows[1][1], rows[1][3], rows[1][7], rows[1][8]])
+        resumed = self.csv_rows('analysis', after=rows[1][0], limit=1)
+        self.assertEqual([rows[2]], resumed[1:])
+
+    def test_process_node_hours(self):
+        rows = self.csv_rows('processes')
+        column = rows[0].index('production_test_fail(小时)')
+        self.assertEqual(['0.0'] * 3, [row[column] for row in rows[1:]])
+
+    def test_query_count_does_not_grow_with_rows(self):
+        def count(dataset):
+            with CaptureQueriesContext(connection) as queries:
+                self.download(dataset)
+            return len(queries)
+
+        before = {dataset: count(dataset) for dataset in ('devices', 'processes', 'operations')}
+        for i in range(5):
+            create_task(f'EXPORTX{i:02d}')
+        self.assertEqual(before, {dataset: count(dataset) for dataset in before})
+
+    def test_xlsx_is_a_valid_workbook(self):
+        response, content = self.download('devices', format='xlsx')
+        self.assertIn('spreadsheetml', response['Content-Type'])
+        with zipfile.ZipFile(io.BytesIO(content)) as workbook:
+            self.assertIsNone(workbook.testzip())
+            sheet = ElementTree.fromstring(workbook.read('xl/worksheets/sheet1.xml'))
+        namespace = {'x': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+        rows = sheet.findall('.//x:row', namespace)
+        self.assertEqual(4, len(rows))
+        self.assertEqual('EXPORT000', rows[1].findall('x:c', namespace)[1].find('.//x:t', namespace).text)
+
+    def test_formula_cells_are_escaped(self):
+        AnalysisResults.objects.update(analysis_notes='=HYPERLINK("http://evil","x")')
+        self.assertEqual('\'=HYPERLINK("http://evil","x")', self.csv_rows('analysis')[1][8])
+        content = b''.join(write_xlsx(['a', 'b', 'c'], [['@SUM(A1)', -1, 'ok']]))
+        with zipfile.ZipFile(io.BytesIO(content)) as workbook:
+            sheet = workbook.read('xl/worksheets/sheet1.xml').decode('utf-8')
+        self.assertIn("'@SUM(A1)", sheet)
+        self.assertIn('<c><v>-1</v></c>', sheet)  # 数值不加前缀
+
+    def test_bad_parameters(self):
+        self.assertEqual(400, self.client.get(reverse('export', args=['unknown'])).status_code)
+        self.assertEqual(400, self.client.get(reverse('export', args=['devices']), {'format': 'pdf'}).status_code)
+        self.assertEqual(400, self.client.get(reverse('export', args=['devices']), {'after': 'x'}).status_code)
+        self.assertEqual(400, self.client.get(reverse('export', args=['devices']), {'limit': '-1'}).status_code)
+
+
+job_calls = []
+
+
+@job('tests.record')
+def record_job(value, fail_times=0):
+    job_calls.append(value)
+    if job_calls.count(value) <= fail_times:
+        raise RuntimeError('boom')
+
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        job_calls.clear()
+
+    def test_idempotency_key(self):
+        first = enqueue('tests.record', {'value': 'a'}, key='record:a')
+        second = enqueue('tests.record', {'value': 'b'}, key='record:a')
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual((1, 0), run_due_jobs())
+        self.assertEqual(['a'], job_calls)
+        self.assertEqual((0, 0), run_due_jobs())
+
+    def test_retry_with_backoff_then_fail(self):
+        queued = enqueue('tests.record', {'value': 'x', 'fail_times': 5}, max_attempts=2)
+        self.assertEqual((0, 1), run_due_jobs())
+        queued.refresh_from_db()
+        self.assertEqual(Job.Status.PENDING, queued.status)
+        self.assertGreater(queued.run_at, timezone.now())
+        self.assertIn('boom', queued.last_error)
+        self.assertEqual((0, 0), run_due_jobs())  # 还没到重试时间
+
+        Job.objects.filter(pk=queued.pk).update(run_at=timezone.now())
+        self.assertEqual((0, 1), run_due_jobs())
+        queued.refresh_from_db()
+        self.assertEqual((Job.Status.FAILED, 2), (queued.status, queued.attempts))
+        self.assertEqual(['x', 'x'], job_calls)
+
+    def test_enqueue_rolls_back_with_transaction(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                enqueue('tests.record', {'value': 'r'})
+                raise RuntimeError('transition failed')
+        self.assertFalse(Job.objects.exists())
+
+    @override_settings(JOBS_EAGER=True)
+    def test_eager_runs_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            queued = enqueue('tests.record', {'value': 'e'})
+            self.assertEqual([], job_calls)
+        queued.refresh_from_db()
+        self.assertEqual((Job.Status.DONE, ['e']), (queued.status, job_calls))
+
+    def test_process_chatroom_created_by_worker(self):
+        from chat.models import Chatroom
+        process = DeviceProcess.objects.create(device=Device.objects.create(sn='JOB0001'),
+                                               flow_class=DeviceInvestigationFlow)
+        self.assertFalse(Chatroom.objects.filter(object_id=process.pk).exists())
+        out = io.StringIO()
+        call_command('run_jobs', '--once', stdout=out)
+        self.assertIn('Successfully run 1 jobs, 0 failed', out.getvalue())
+        self.assertEqual(1, Chatroom.objects.filter(object_id=process.pk).count())
+
+    def test_worker_discards_broken_connections_each_poll(self):
+        out = io.StringIO()
+        with mock.patch('workflows.management.commands.run_jobs.close_old_connections') as close:
+            call_command('run_jobs', '--once', stdout=out)
+        self.assertEqual(1, close.call_count)
+
+
+class ThreadLocalMiddlewareTest(TestCase):
+    def setUp(self):
+        self.users = [create_employee('ctx_a'), create_employee('ctx_b')]
+
+    def request_for(self, user):
+        request = RequestFactory().get('/')
+        request.user = user
+        return request
+
+    def test_sync_request_is_cleared_even_on_error(self):
+        seen = []
+
+        def view(request):
+            seen.append(get_current_user())
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            ThreadLocalMiddleware(view)(self.request_for(self.users[0]))
+        self.assertEqual([self.users[0]], seen)
+        self.assertIsNone(get_current_request())
+
+    def test_async_requests_sharing_a_thread_see_their_own_user(self):
+        async def view(request):
+            await asyncio.sleep(0)  # 让两个请求交错执行
+            # 同步代码在线程池中执行（thread_sensitive：两个请求共用同一个线程）
+            user = await sync_to_async(get_current_user)()
+            return HttpResponse(user.username)
+
+        middleware = ThreadLocalMiddleware(view)
+        self.assertTrue(middleware.async_mode)
+
+        async def serve():
+            return await asyncio.gather(*(middleware(self.request_for(user)) for user in self.users))
+
+        responses = async_to_sync(serve)()
+        self.assertEqual([b'ctx_a', b'ctx_b'], [response.content for response in responses])
+        self.assertIsNone(get_current_request())
+
+    async def test_workflow_dashboard_over_asgi(self):
+        # 经过ASGIHandler和完整的中间件栈（异步模式），同步视图在线程池中执行，任务卡片的操作按当前用户计算
+        user = await sync_to_async(create_employee)('ctx_admin', is_superuser=True, is_staff=True)
+        await sync_to_async(create_task)('CTX0001', status=STATUS.ASSIGNED, owner=user)
+        await self.async_client.aforce_login(user)
+        with mock.patch.object(ThreadLocalMiddleware, '__acall__', autospec=True,
+                               side_effect=ThreadLocalMiddleware.__acall__) as acall:
+            response = await self.async_client.get(reverse('deviceinvestigation:index'))
+        self.assertEqual(200, response.status_code)
+        # 中间件栈确实是异步的：ThreadLocalMiddleware走的是__acall__，而不是被整体降级到同步线程里的__call__
+        self.assertEqual(1, acall.call_count)
+        self.assertContains(response, 'Upload Data')  # 当前用户是处理人时才有的操作
+
+
+class AsyncProcessListViewTest(TestCase):
+    def setUp(self):
+        self.user = create_employee('async_viewer')
+        self.tasks = [create_task(f'ASYNC{i:04d}') for i in range(25)]
+
+    async def test_pages_match_sync_view(self):
+        await self.async_client.aforce_login(self.user)
+        for params in ({}, {'page': 2}, {'after': self.tasks[15].process_id}, {'after': self.tasks[5].process_id}):
+            sync = await self.async_client.get(reverse('process_list'), params)
+            response = await self.async_client.get(reverse('process_list_async'), params)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual([p.pk for p in sync.context['processes']], [p.pk for p in response.context['processes']])
+            self.assertEqual(sync.context['next_cursor'], response.context['next_cursor'])
+        self.assertContains(response, 'Production Test Fail')
+        # 异步中间件栈：请求ID和耗时响应头照常添加
+        self.assertTrue(response['X-Request-ID'].startswith('req_'))
+        self.assertIn('X-Request-Duration', response)
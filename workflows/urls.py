@@ -1,14 +1,21 @@
 # workflows/urls.py
+import logging
+
 from django.urls import path, include
 from viewflow.urls import Site
 from viewflow.workflow.flow.viewset import FlowViewset
-from workflows.BaseView import DirectAssignView, BaseApprovalView, ProcessListView, ProcessDetailView
+from workflows.BaseView import DirectAssignView, BaseApprovalView, ProcessListView, ProcessDetailView, \
+    AsyncProcessListView, DeviceDashboardView, DeviceIntakeView, ExportView
 from workflows.flows import DeviceInvestigationFlow
 
+logger = logging.getLogger(__name__)
+
 
 class DeviceInvestigationFlowViewSet(FlowViewset):
     # 定义流程类属性
     flow_class = DeviceInvestigationFlow
+    # 替换viewflow默认的dashboard视图，批量计算任务卡片的操作按钮
+    dashboard_view_class = DeviceDashboardView
     '''
         FlowViewset是viewflow的默认视图集，由于viewflow自身业务的硬约束，flow_class是FlowViewset的__init__的必选参数，
         但是Django 框架的通用执行逻辑是 所有注册到路由 / 管理器的视图集类，框架都会在生成路由 / 处理第一个请求时，自动执行无参实例化，
@@ -31,7 +38,7 @@ if site.viewsets is None:
 '''
 site.register(DeviceInvestigationFlowViewSet)
 
-print("注册后的 viewsets:", site.viewsets)
+logger.debug("注册后的 viewsets: %s", site.viewsets)
 # 拆分 site.urls（处理 Django 版本兼容）
 try:
     # 尝试解析 3 元组 (url_patterns, app_name, namespace)
@@ -65,12 +72,30 @@ urlpatterns = [
         name="process_list",
     ),   # process列表，默认的视图展示数据不符合业务需求
 
+    path(
+        "deviceinvestigation/flows/async/",
+        AsyncProcessListView.as_view(),
+        name="process_list_async",
+    ),   # process列表的异步版本（ASGI）
+
     path(
         "deviceinvestigation/<int:pk>/",
         ProcessDetailView.as_view(),
         name="process_detail",
     ),   # process相关数据展示，默认的视图展示数据不符合业务需求
 
+    path(
+        "deviceinvestigation/intake/",
+        DeviceIntakeView.as_view(),
+        name="device_intake",
+    ),   # 产线异常设备批量入库（CSV/JSON），批量upsert设备并启动流程
+
+    path(
+        "deviceinvestigation/export/<str:dataset>/",
+        ExportView.as_view(),
+        name="export",
+    ),   # 设备/流程/操作记录/分析结果流式导出（CSV/XLSX）
+
     # 包含 Viewflow 自动生成的所有流程路由，包括启动节点 --> 节点视图，一条路由即可生成
     path('', include((url_patterns, app_name), namespace=namespace))
 
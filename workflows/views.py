@@ -1,5 +1,7 @@
 # Create your views here.
 # workflows/views.py
+import logging
+
 from django.db import transaction
 from django.shortcuts import redirect, render
 from django.views.generic import FormView
@@ -12,6 +14,9 @@ from .BaseView import CustomProcessView
 from .forms import DeviceStartForm, ProductionTestFailForm, FAERetestForm, XRayTestForm, EngineeringAnalysisForm, \
     UploadOperationRecordForm, UploadAnalysisResultForm, MeAnalysisForm, FinalRetestForm, ScrappedForm, \
     ReturnNormalFlowForm
+from .state import refresh_device_states
+
+logger = logging.getLogger(__name__)
 
 
 class StartProcessView(CreateProcessView):
@@ -23,7 +28,10 @@ class StartProcessView(CreateProcessView):
     def form_valid(self, form):
         device = form.cleaned_data['device']
         form.instance.device = device
-        return super().form_valid(form) # 父类会完成instance.save()操作
+        with transaction.atomic():
+            response = super().form_valid(form) # 父类会完成instance.save()操作
+            refresh_device_states(device.pk)  # 流程启动后更新设备当前状态投影
+        return response
 
 
 
@@ -179,21 +187,10 @@ class EngineeringAnalysisView(CustomProcessView):
     def form_invalid(self, form):
         """
         表单验证失败时调用：
-        1. 打印错误信息到控制台（调试用）
+        1. 错误信息记DEBUG日志（调试用，生产环境LOG_LEVEL=INFO时不输出）
         2. 返回带错误的表单页面（前端展示）
         """
-        # ========== 1. 打印错误信息（调试用，多种格式可选） ==========
-        print("===== 表单验证错误（form_invalid） =====")
-        # 格式1：HTML格式的错误字典（适合前端展示）
-        print("错误信息（HTML格式）：", form.errors)
-        # 格式2：结构化错误（列表+异常，适合调试）
-        print("错误信息（结构化）：", form.errors.as_data())
-        # 格式3：JSON格式（适合AJAX请求）
-        print("错误信息（JSON格式）：", form.errors.as_json())
-        # 格式4：单个字段的错误（精准调试）
-        for field in form.fields:
-            if field in form.errors:
-                print(f"字段【{field}】的错误：", form.errors[field])
+        logger.debug("表单验证错误（form_invalid） | 表单:%s 错误:%s", type(form).__name__, form.errors)  # 只在输出时才格式化
         return render(self.request, self.template_name, {'form': form})
 
     def get_context_data(self, **kwargs):